@@ -0,0 +1,41 @@
+"""balance snapshots
+
+Revision ID: 5c1f7e2a9b34
+Revises: 0ebaa362d4ec
+Create Date: 2026-10-18 10:12:41.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1f7e2a9b34'
+down_revision = '0ebaa362d4ec'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 0ebaa362d4ec creates tables from the current models, so on a fresh database the table already exists
+    if 'balance_snapshots' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        'balance_snapshots',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('balance_id', sa.Integer(), nullable=False),
+        sa.Column('amount', sa.Numeric(), nullable=False),
+        sa.Column('last_operation_id', sa.Integer(), nullable=False),
+        sa.Column('created', sa.DateTime(timezone=True), nullable=False),
+        sa.ForeignKeyConstraint(['balance_id'], ['balances.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_balance_snapshots_id'), 'balance_snapshots', ['id'], unique=False)
+    op.create_index('ix_balance_snapshots_balance_id_last_operation_id', 'balance_snapshots',
+                    ['balance_id', 'last_operation_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_balance_snapshots_balance_id_last_operation_id', table_name='balance_snapshots')
+    op.drop_index(op.f('ix_balance_snapshots_id'), table_name='balance_snapshots')
+    op.drop_table('balance_snapshots')
@@ -0,0 +1,34 @@
+"""ledger watermarks
+
+Revision ID: 8d2e4b6f1a07
+Revises: 5c1f7e2a9b34
+Create Date: 2026-10-18 11:03:17.902466
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2e4b6f1a07'
+down_revision = '5c1f7e2a9b34'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 0ebaa362d4ec creates tables from the current models, so on a fresh database the table already exists
+    if 'ledger_watermarks' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        'ledger_watermarks',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('operation_id', sa.Integer(), nullable=False),
+        sa.Column('amount', sa.Numeric(), nullable=False),
+        sa.Column('updated', sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('ledger_watermarks')
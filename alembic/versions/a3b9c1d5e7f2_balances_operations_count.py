@@ -0,0 +1,32 @@
+"""balances operations count
+
+Revision ID: a3b9c1d5e7f2
+Revises: 8d2e4b6f1a07
+Create Date: 2026-10-18 11:48:05.334190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3b9c1d5e7f2'
+down_revision = '8d2e4b6f1a07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 0ebaa362d4ec creates tables from the current models, so on a fresh database the column already exists
+    columns = [c['name'] for c in sa.inspect(op.get_bind()).get_columns('balances')]
+    if 'operations_count' not in columns:
+        op.add_column('balances', sa.Column('operations_count', sa.Integer(), nullable=False, server_default='0'))
+    op.execute(
+        'UPDATE balances b SET operations_count = c.operations_count '
+        'FROM (SELECT owner_balance_id, count(*) AS operations_count FROM operations GROUP BY owner_balance_id) c '
+        'WHERE c.owner_balance_id = b.id'
+    )
+
+
+def downgrade():
+    op.drop_column('balances', 'operations_count')
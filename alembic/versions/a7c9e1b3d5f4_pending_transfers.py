@@ -0,0 +1,46 @@
+"""pending transfers
+
+Revision ID: a7c9e1b3d5f4
+Revises: f2a4c6e8b0d3
+Create Date: 2026-10-18 17:26:51.640118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c9e1b3d5f4'
+down_revision = 'f2a4c6e8b0d3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 0ebaa362d4ec creates tables from the current models, so on a fresh database the table may already exist
+    if 'pending_transfers' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        'pending_transfers',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('from_balance_id', sa.Integer(), nullable=False),
+        sa.Column('to_balance_id', sa.Integer(), nullable=False),
+        sa.Column('amount', sa.Numeric(), nullable=False),
+        sa.Column('status', sa.Enum('PENDING', 'DONE', 'FAILED', name='pendingtransferstatus'), nullable=False),
+        sa.Column('detail', sa.String(), nullable=True),
+        sa.Column('created', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('processed', sa.DateTime(timezone=True), nullable=True),
+        sa.ForeignKeyConstraint(['from_balance_id'], ['balances.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['to_balance_id'], ['balances.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_pending_transfers_id'), 'pending_transfers', ['id'], unique=False)
+    op.create_index('ix_pending_transfers_pending', 'pending_transfers', ['id'], unique=False,
+                    postgresql_where=sa.text("status = 'PENDING'"))
+
+
+def downgrade():
+    op.drop_index('ix_pending_transfers_pending', table_name='pending_transfers')
+    op.drop_index(op.f('ix_pending_transfers_id'), table_name='pending_transfers')
+    op.drop_table('pending_transfers')
+    sa.Enum(name='pendingtransferstatus').drop(op.get_bind())
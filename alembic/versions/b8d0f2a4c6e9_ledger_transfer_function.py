@@ -0,0 +1,58 @@
+"""ledger_transfer function
+
+Revision ID: b8d0f2a4c6e9
+Revises: a7c9e1b3d5f4
+Create Date: 2026-10-18 18:12:40.551927
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8d0f2a4c6e9'
+down_revision = 'a7c9e1b3d5f4'
+branch_labels = None
+depends_on = None
+
+
+LEDGER_TRANSFER_FUNCTION = """
+CREATE OR REPLACE FUNCTION ledger_transfer(p_from integer, p_to integer, p_amount numeric,
+                                           p_check_funds boolean DEFAULT true)
+RETURNS TABLE (from_amount numeric, to_amount numeric)
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_from numeric;
+BEGIN
+    IF p_amount <= 0 THEN
+        RAISE EXCEPTION USING MESSAGE = 'Amount must be positive: ' || p_amount;
+    END IF;
+    PERFORM 1 FROM balances WHERE id IN (p_from, p_to) ORDER BY id FOR UPDATE;
+    SELECT amount INTO v_from FROM balances WHERE id = p_from;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION USING MESSAGE = 'Not found balance id: ' || p_from;
+    END IF;
+    PERFORM 1 FROM balances WHERE id = p_to;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION USING MESSAGE = 'Not found recipient''s balance id: ' || p_to;
+    END IF;
+    IF p_check_funds AND v_from < p_amount THEN
+        RAISE EXCEPTION USING MESSAGE = 'Insufficient funds on the balance: ' || p_from;
+    END IF;
+    INSERT INTO operations (owner_balance_id, more_balance_id, amount, operation_type, created)
+    VALUES (p_from, p_to, p_amount, 'DEBIT', now()), (p_to, p_from, p_amount, 'CREDIT', now());
+    UPDATE balances SET amount = amount - p_amount, operations_count = operations_count + 1
+    WHERE id = p_from RETURNING amount INTO from_amount;
+    UPDATE balances SET amount = amount + p_amount, operations_count = operations_count + 1
+    WHERE id = p_to RETURNING amount INTO to_amount;
+    RETURN NEXT;
+END
+$$
+"""
+
+
+def upgrade():
+    op.execute(LEDGER_TRANSFER_FUNCTION)
+
+
+def downgrade():
+    op.execute('DROP FUNCTION IF EXISTS ledger_transfer(integer, integer, numeric, boolean)')
@@ -0,0 +1,51 @@
+"""operations composite indexes
+
+Revision ID: c4e8f0a2b6d1
+Revises: a3b9c1d5e7f2
+Create Date: 2026-10-18 12:26:52.071843
+
+Indexes are built CONCURRENTLY, outside of the migration transaction, so the
+revision can run against a live database. If a build is interrupted, Postgres
+leaves an INVALID index behind: drop it before running the upgrade again.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8f0a2b6d1'
+down_revision = 'a3b9c1d5e7f2'
+branch_labels = None
+depends_on = None
+
+INDEXES = (
+    ('ix_operations_owner_balance_id_operation_type',
+     '(owner_balance_id, operation_type) INCLUDE (amount)'),
+    ('ix_operations_owner_balance_id_id',
+     '(owner_balance_id, id) INCLUDE (operation_type, amount)'),
+    ('ix_operations_owner_balance_id_created_id',
+     '(owner_balance_id, created, id)'),
+    ('ix_operations_owner_balance_id_more_balance_id',
+     '(owner_balance_id, more_balance_id, operation_type) INCLUDE (amount)'),
+)
+
+
+def _concurrently():
+    # indexes of a partitioned table (see e1f3a5c7d9b2 and fresh databases) can not be built concurrently
+    relkind = op.get_bind().execute("SELECT relkind FROM pg_class WHERE oid = 'operations'::regclass").scalar()
+    return 'CONCURRENTLY' if relkind == 'r' else ''
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        concurrently = _concurrently()
+        for name, columns in INDEXES:
+            op.execute(f'CREATE INDEX {concurrently} IF NOT EXISTS {name} ON operations {columns}')
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        concurrently = _concurrently()
+        for name, _ in INDEXES:
+            op.execute(f'DROP INDEX {concurrently} IF EXISTS {name}')
@@ -0,0 +1,29 @@
+"""unique balances.user_id
+
+Revision ID: c9e1a3b5d7f0
+Revises: b8d0f2a4c6e9
+Create Date: 2026-10-18 21:24:51.306418
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9e1a3b5d7f0'
+down_revision = 'b8d0f2a4c6e9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 0ebaa362d4ec creates tables from the current models, so on a fresh database the constraint may already exist;
+    # fails if some user already has several wallets, they have to be merged by hand first
+    constraints = sa.inspect(op.get_bind()).get_unique_constraints('balances')
+    if any(c['column_names'] == ['user_id'] for c in constraints):
+        return
+    op.create_unique_constraint('balances_user_id_key', 'balances', ['user_id'])
+
+
+def downgrade():
+    op.drop_constraint('balances_user_id_key', 'balances', type_='unique')
@@ -0,0 +1,111 @@
+"""partition operations by month
+
+Revision ID: e1f3a5c7d9b2
+Revises: c4e8f0a2b6d1
+Create Date: 2026-10-18 13:40:22.640519
+
+Converts operations into a table range-partitioned on created: monthly
+partitions from the oldest operation up to three months ahead plus a default
+partition. Rows are copied while the old table is locked, so on a large
+ledger run it in a maintenance window. Further partitions are created by
+python -m app.commands.partitions.
+
+"""
+from datetime import date
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1f3a5c7d9b2'
+down_revision = 'c4e8f0a2b6d1'
+branch_labels = None
+depends_on = None
+
+COLUMNS = 'id, owner_balance_id, created, operation_type, amount, more_balance_id'
+
+INDEXES = (
+    ('ix_operations_id', '(id)'),
+    ('ix_operations_operation_type', '(operation_type)'),
+    ('ix_operations_owner_balance_id_operation_type', '(owner_balance_id, operation_type) INCLUDE (amount)'),
+    ('ix_operations_owner_balance_id_id', '(owner_balance_id, id) INCLUDE (operation_type, amount)'),
+    ('ix_operations_owner_balance_id_created_id', '(owner_balance_id, created, id)'),
+    ('ix_operations_owner_balance_id_more_balance_id',
+     '(owner_balance_id, more_balance_id, operation_type) INCLUDE (amount)'),
+)
+
+
+def _relkind():
+    return op.get_bind().execute("SELECT relkind FROM pg_class WHERE oid = 'operations'::regclass").scalar()
+
+
+def _month_start(day, shift=0):
+    month = day.year * 12 + day.month - 1 + shift
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def _move_to_legacy():
+    op.execute('ALTER TABLE operations RENAME TO operations_legacy')
+    op.execute('ALTER TABLE operations_legacy RENAME CONSTRAINT operations_pkey TO operations_legacy_pkey')
+    for name, _ in INDEXES:
+        op.execute(f'DROP INDEX IF EXISTS {name}')
+    op.execute('ALTER SEQUENCE operations_id_seq OWNED BY NONE')
+
+
+def _finish_from_legacy():
+    op.execute('ALTER SEQUENCE operations_id_seq OWNED BY operations.id')
+    op.execute('DROP TABLE operations_legacy')
+    for name, columns in INDEXES:
+        op.execute(f'CREATE INDEX {name} ON operations {columns}')
+
+
+def upgrade():
+    # 0ebaa362d4ec creates tables from the current models, so on a fresh database the table is already partitioned
+    if _relkind() == 'p':
+        return
+    _move_to_legacy()
+    op.execute(f'''
+        CREATE TABLE operations (
+            id INTEGER NOT NULL DEFAULT nextval('operations_id_seq'),
+            owner_balance_id INTEGER REFERENCES balances (id) ON DELETE SET NULL,
+            created TIMESTAMP WITH TIME ZONE NOT NULL,
+            operation_type operationstype NOT NULL,
+            amount NUMERIC NOT NULL,
+            more_balance_id INTEGER REFERENCES balances (id) ON DELETE SET NULL,
+            PRIMARY KEY (id, created)
+        ) PARTITION BY RANGE (created)
+    ''')
+    op.execute('CREATE TABLE operations_default PARTITION OF operations DEFAULT')
+    oldest = op.get_bind().execute('SELECT MIN(created) FROM operations_legacy').scalar()
+    month = _month_start(oldest or date.today())
+    last_month = _month_start(date.today(), 3)
+    while month <= last_month:
+        next_month = _month_start(month, 1)
+        op.execute(f"CREATE TABLE operations_y{month.year}m{month.month:02d} PARTITION OF operations "
+                   f"FOR VALUES FROM ('{month}') TO ('{next_month}')")
+        month = next_month
+    # operations without created land in the default partition
+    op.execute(f'''
+        INSERT INTO operations ({COLUMNS})
+        SELECT id, owner_balance_id, COALESCE(created, to_timestamp(0)), operation_type, amount, more_balance_id
+        FROM operations_legacy
+    ''')
+    _finish_from_legacy()
+
+
+def downgrade():
+    if _relkind() != 'p':
+        return
+    _move_to_legacy()
+    op.execute('''
+        CREATE TABLE operations (
+            id INTEGER NOT NULL DEFAULT nextval('operations_id_seq') PRIMARY KEY,
+            owner_balance_id INTEGER REFERENCES balances (id) ON DELETE SET NULL,
+            created TIMESTAMP WITH TIME ZONE,
+            operation_type operationstype NOT NULL,
+            amount NUMERIC NOT NULL,
+            more_balance_id INTEGER REFERENCES balances (id) ON DELETE SET NULL
+        )
+    ''')
+    op.execute(f'INSERT INTO operations ({COLUMNS}) SELECT {COLUMNS} FROM operations_legacy')
+    _finish_from_legacy()
@@ -0,0 +1,38 @@
+"""idempotency keys
+
+Revision ID: f2a4c6e8b0d3
+Revises: e1f3a5c7d9b2
+Create Date: 2026-10-18 15:42:08.117302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a4c6e8b0d3'
+down_revision = 'e1f3a5c7d9b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 0ebaa362d4ec creates tables from the current models, so on a fresh database the table may already exist
+    if 'idempotency_keys' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        'idempotency_keys',
+        sa.Column('key', sa.String(length=255), nullable=False),
+        sa.Column('fingerprint', sa.String(length=64), nullable=False),
+        sa.Column('status_code', sa.Integer(), nullable=False),
+        sa.Column('response', postgresql.JSONB(), nullable=True),
+        sa.Column('created', sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('key')
+    )
+    op.create_index(op.f('ix_idempotency_keys_created'), 'idempotency_keys', ['created'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_idempotency_keys_created'), table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
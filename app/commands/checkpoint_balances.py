@@ -0,0 +1,92 @@
+"""
+checkpoint_balances.py
+====================================
+Периодические снимки остатков кошельков (balance_snapshots)
+
+Каждый запуск сохраняет новый снимок для кошельков, по которым появились
+операции после предыдущего снимка. Пересчет остатков, сверка и остаток
+на момент времени начинают со снимка и суммируют только более новые операции.
+
+Запуск:
+    python -m app.commands.checkpoint_balances [--lag 60] [--interval 300]
+"""
+import sys
+import time
+import argparse
+from datetime import datetime, timedelta
+
+from sqlalchemy.orm import Session
+
+from app.connects.postgres.session import Session as DBSession
+
+CHECKPOINT_LOCK_ID = 7001
+
+SQL_CREATE_SNAPSHOTS = '''
+    INSERT INTO balance_snapshots (balance_id, amount, last_operation_id, created)
+    SELECT l.balance_id, COALESCE(s.amount, 0) + l.amount, :last_operation_id, :created
+    FROM (
+        SELECT o.owner_balance_id AS balance_id,
+               SUM(CASE WHEN o.operation_type = 'CREDIT' THEN o.amount ELSE -o.amount END) AS amount
+        FROM operations o
+        WHERE o.id > :previous_operation_id AND o.id <= :last_operation_id
+          AND o.owner_balance_id IS NOT NULL
+        GROUP BY o.owner_balance_id
+    ) l
+    LEFT JOIN LATERAL (
+        SELECT bs.amount FROM balance_snapshots bs
+        WHERE bs.balance_id = l.balance_id
+        ORDER BY bs.last_operation_id DESC LIMIT 1
+    ) s ON true
+'''
+
+
+def create_snapshots(db_session: Session, lag: int = 60) -> int:
+    """Создает снимки остатков по операциям, появившимся после предыдущего запуска
+
+    Args:
+        db_session: сессия к БД postgres
+        lag: не включать операции моложе lag секунд, чтобы не пропустить
+             id из еще не закоммиченных транзакций
+
+    Returns:
+        кол-во созданных снимков
+    """
+    db_session.execute('SELECT pg_advisory_xact_lock(:lock_id)', {'lock_id': CHECKPOINT_LOCK_ID})
+    created = datetime.now()
+    previous_operation_id = db_session.execute(
+        'SELECT COALESCE(MAX(last_operation_id), 0) FROM balance_snapshots'
+    ).scalar()
+    last_operation_id = db_session.execute(
+        'SELECT MAX(id) FROM operations WHERE id > :previous_operation_id AND created <= :created',
+        {'previous_operation_id': previous_operation_id, 'created': created - timedelta(seconds=lag)}
+    ).scalar()
+    if last_operation_id is None:
+        db_session.commit()
+        return 0
+    result = db_session.execute(SQL_CREATE_SNAPSHOTS, {
+        'previous_operation_id': previous_operation_id,
+        'last_operation_id': last_operation_id,
+        'created': created
+    })
+    db_session.commit()
+    return result.rowcount
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Снимки остатков кошельков')
+    parser.add_argument('--lag', type=int, default=60, help='не включать операции моложе N секунд')
+    parser.add_argument('--interval', type=int, default=0, help='повторять каждые N секунд')
+    args = parser.parse_args()
+    while True:
+        db_session = DBSession()
+        try:
+            print(f"snapshots created: {create_snapshots(db_session, args.lag)}")
+        finally:
+            db_session.close()
+        if not args.interval:
+            return 0
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
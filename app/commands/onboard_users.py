@@ -0,0 +1,93 @@
+"""
+onboard_users.py
+====================================
+Создание пользователей с кошельками из файла логинов (перенос пользователей партнера)
+
+Логины читаются построчно (файл или stdin) и пишутся пачками по --batch-size,
+каждая пачка - своя транзакция: прерванный перенос можно запустить заново с тем же
+файлом, уже созданные пользователи получат свои кошельки с created=false.
+В stdout - CSV username,balance_id,created в порядке входного файла.
+
+Запуск:
+    python -m app.commands.onboard_users usernames.txt [--batch-size 10000] [--inactive] > balances.csv
+    cat usernames.txt | python -m app.commands.onboard_users -
+"""
+import csv
+import sys
+import time
+import argparse
+from itertools import islice
+from typing import Iterable, Iterator, List, TextIO, Tuple
+
+from sqlalchemy.orm import Session
+
+from app import settings
+from app.connects.postgres.session import Session as DBSession
+from app.models.balance import Balance
+from app.utils.retry import run_in_transaction
+
+
+def read_usernames(lines: Iterable[str]) -> Iterator[str]:
+    for line in lines:
+        username = line.strip()
+        if username:
+            yield username
+
+
+def iter_batches(usernames: Iterable[str], batch_size: int) -> Iterator[List[str]]:
+    usernames = iter(usernames)
+    while True:
+        batch = list(islice(usernames, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def onboard(db_session: Session, lines: Iterable[str], output: TextIO, batch_size: int,
+            is_active: bool = True) -> Tuple[int, int]:
+    """Создает пользователей с кошельками пачками
+
+    Args:
+        db_session: сессия к БД postgres
+        lines: строки с логинами
+        output: куда писать CSV username,balance_id,created
+        batch_size: кол-во логинов в транзакции
+        is_active: активность новых пользователей
+
+    Returns:
+        (всего логинов, создано кошельков)
+    """
+    writer = csv.writer(output)
+    writer.writerow(('username', 'balance_id', 'created'))
+    total = created = 0
+    for batch in iter_batches(read_usernames(lines), batch_size):
+        balances = run_in_transaction(db_session, lambda: Balance.create_for_users(
+            db_session, batch, is_active=is_active, chunk_size=settings.AUTH_BULK_CHUNK_SIZE
+        ))
+        writer.writerows((username, balance_id, 'true' if is_created else 'false')
+                         for username, balance_id, is_created in balances)
+        total += len(balances)
+        created += sum(is_created for _, _, is_created in balances)
+    return total, created
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Создание пользователей с кошельками из файла логинов')
+    parser.add_argument('file', type=argparse.FileType('r'), help='файл с логином на строку, - для stdin')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--inactive', action='store_true', help='создавать пользователей неактивными')
+    args = parser.parse_args()
+    started = time.perf_counter()
+    db_session = DBSession()
+    try:
+        total, created = onboard(db_session, args.file, sys.stdout, args.batch_size, is_active=not args.inactive)
+    finally:
+        db_session.close()
+    elapsed = time.perf_counter() - started
+    print(f"usernames: {total}, balances created: {created}, {total / max(elapsed, 1e-9):.0f} users/s",
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""
+partitions.py
+====================================
+Обслуживание месячных секций таблицы operations
+
+    * создает секции на текущий и N следующих месяцев, перенося в них строки,
+      которые успели попасть в секцию по умолчанию (operations_default);
+    * отсоединяет секции старше срока хранения и переносит их в схему archive
+      (или удаляет с --drop).
+
+Перед отсоединением старых секций нужно сделать снимки остатков
+(checkpoint_balances): пересчет остатков по операциям начинается со снимка.
+Счетчик operations_count кошелька уменьшается на число отсоединенных операций
+в той же транзакции, что и отсоединение.
+
+Запуск:
+    python -m app.commands.partitions [--months-ahead 3] [--retention-months 0] [--drop]
+"""
+import re
+import sys
+import argparse
+from datetime import date
+from typing import List
+
+from sqlalchemy.orm import Session
+
+from app.connects.postgres.session import Session as DBSession
+
+ARCHIVE_SCHEMA = 'archive'
+PARTITION_NAME = re.compile(r'^operations_y(\d{4})m(\d{2})$')
+
+
+def month_start(day: date, shift: int = 0) -> date:
+    """Первое число месяца, сдвинутого на shift месяцев"""
+    month = day.year * 12 + day.month - 1 + shift
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f'operations_y{month.year}m{month.month:02d}'
+
+
+def get_partitions(db_session: Session) -> List[str]:
+    """Месячные секции operations"""
+    rows = db_session.execute(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'operations'::regclass ORDER BY c.relname"
+    )
+    return [name for name, in rows if PARTITION_NAME.match(name)]
+
+
+def create_partition(db_session: Session, month: date) -> bool:
+    """Создает секцию на месяц
+
+    Returns:
+        True, если секция создана
+    """
+    name = partition_name(month)
+    if name in get_partitions(db_session):
+        return False
+    bounds = {'start': month, 'end': month_start(month, 1)}
+    create = f"CREATE TABLE {name} PARTITION OF operations FOR VALUES FROM ('{month}') TO ('{bounds['end']}')"
+    default_rows = db_session.execute(
+        'SELECT count(*) FROM operations_default WHERE created >= :start AND created < :end', bounds
+    ).scalar()
+    if not default_rows:
+        db_session.execute(create)
+        return True
+    # the default partition may not keep rows of a new partition's range
+    db_session.execute('ALTER TABLE operations DETACH PARTITION operations_default')
+    db_session.execute(create)
+    db_session.execute(
+        f'INSERT INTO {name} SELECT * FROM operations_default WHERE created >= :start AND created < :end', bounds
+    )
+    db_session.execute('DELETE FROM operations_default WHERE created >= :start AND created < :end', bounds)
+    db_session.execute('ALTER TABLE operations ATTACH PARTITION operations_default DEFAULT')
+    return True
+
+
+def create_partitions(db_session: Session, months_ahead: int = 3, today: date = None) -> List[str]:
+    """Создает секции на текущий и months_ahead следующих месяцев
+
+    Returns:
+        имена созданных секций
+    """
+    current = month_start(today or date.today())
+    created = []
+    for shift in range(months_ahead + 1):
+        month = month_start(current, shift)
+        if create_partition(db_session, month):
+            created.append(partition_name(month))
+    db_session.commit()
+    return created
+
+
+def detach_partitions(db_session: Session, retention_months: int, drop: bool = False,
+                      today: date = None) -> List[str]:
+    """Отсоединяет секции, которые целиком старше retention_months месяцев
+
+    Счетчики operations_count кошельков уменьшаются на операции отсоединенных секций.
+
+    Args:
+        db_session: сессия к БД postgres
+        retention_months: сколько месяцев хранить, считая текущий
+        drop: удалить секции вместо переноса в схему archive
+
+    Returns:
+        имена отсоединенных секций
+    """
+    oldest = month_start(today or date.today(), -retention_months + 1)
+    detached = []
+    for name in get_partitions(db_session):
+        year, month = PARTITION_NAME.match(name).groups()
+        if date(int(year), int(month), 1) >= oldest:
+            continue
+        # the list endpoint takes totalCount from operations_count, it must match the attached rows
+        db_session.execute(
+            f'UPDATE balances b SET operations_count = b.operations_count - c.operations '
+            f'FROM (SELECT owner_balance_id, count(*) AS operations FROM {name} GROUP BY owner_balance_id) c '
+            f'WHERE b.id = c.owner_balance_id'
+        )
+        db_session.execute(f'ALTER TABLE operations DETACH PARTITION {name}')
+        if drop:
+            db_session.execute(f'DROP TABLE {name}')
+        else:
+            db_session.execute(f'CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}')
+            db_session.execute(f'ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA}')
+        detached.append(name)
+    db_session.commit()
+    return detached
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Секции таблицы operations')
+    parser.add_argument('--months-ahead', type=int, default=3, help='создать секции на N месяцев вперед')
+    parser.add_argument('--retention-months', type=int, default=0,
+                        help='отсоединить секции старше N месяцев (0 - хранить все)')
+    parser.add_argument('--drop', action='store_true', help='удалять старые секции вместо переноса в archive')
+    args = parser.parse_args()
+    db_session = DBSession()
+    try:
+        for name in create_partitions(db_session, args.months_ahead):
+            print(f"created: {name}")
+        if args.retention_months:
+            for name in detach_partitions(db_session, args.retention_months, args.drop):
+                print(f"detached: {name}")
+    finally:
+        db_session.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,27 @@
+"""
+purge_idempotency_keys.py
+====================================
+Удаление просроченных ключей идемпотентности (старше IDEMPOTENCY_TTL)
+
+Запуск:
+    python -m app.commands.purge_idempotency_keys
+"""
+import sys
+
+from app.connects.postgres.session import Session as DBSession
+from app.utils.idempotency import purge_expired
+
+
+def main() -> int:
+    db_session = DBSession()
+    try:
+        deleted = purge_expired(db_session)
+        db_session.commit()
+    finally:
+        db_session.close()
+    print(f"expired idempotency keys deleted: {deleted}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
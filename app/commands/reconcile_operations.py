@@ -0,0 +1,150 @@
+"""
+reconcile_operations.py
+====================================
+Фоновая сверка двойной записи по журналу операций
+
+Проверяет операции, появившиеся после отметки (ledger_watermarks), пачками:
+    * для каждой затронутой пары кошельков сумма DEBIT отправителя
+      равна сумме CREDIT получателя;
+    * сумма всех операций со знаком и сумма всех остатков равны нулю.
+
+Запуск:
+    python -m app.commands.reconcile_operations [--batch-size 10000] [--lag 60] [--interval 60]
+"""
+import sys
+import time
+import argparse
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.connects.postgres.session import Session as DBSession
+from app.models.balance import LedgerWatermark
+
+WATERMARK_NAME = 'reconcile_operations'
+
+SQL_SIGNED_AMOUNT = "CASE WHEN o.operation_type = 'CREDIT' THEN o.amount ELSE -o.amount END"
+
+SQL_BATCH_END = '''
+    SELECT MAX(id) FROM (
+        SELECT id FROM operations
+        WHERE id > :operation_id AND id <= :last_operation_id
+        ORDER BY id LIMIT :batch_size
+    ) batch
+'''
+
+SQL_BATCH_AMOUNT = f'''
+    SELECT COALESCE(SUM({SQL_SIGNED_AMOUNT}), 0) FROM operations o
+    WHERE o.id > :operation_id AND o.id <= :batch_end
+'''
+
+SQL_PAIR_MISMATCHES = '''
+    WITH pairs AS (
+        SELECT DISTINCT
+            CASE WHEN operation_type = 'DEBIT' THEN owner_balance_id ELSE more_balance_id END AS from_id,
+            CASE WHEN operation_type = 'DEBIT' THEN more_balance_id ELSE owner_balance_id END AS to_id
+        FROM operations
+        WHERE id > :operation_id AND id <= :batch_end
+    ), totals AS (
+        SELECT p.from_id, p.to_id,
+            (SELECT COALESCE(SUM(o.amount), 0) FROM operations o
+             WHERE o.owner_balance_id = p.from_id AND o.more_balance_id = p.to_id
+               AND o.operation_type = 'DEBIT') AS debit,
+            (SELECT COALESCE(SUM(o.amount), 0) FROM operations o
+             WHERE o.owner_balance_id = p.to_id AND o.more_balance_id = p.from_id
+               AND o.operation_type = 'CREDIT') AS credit
+        FROM pairs p
+    )
+    SELECT from_id, to_id, debit, credit FROM totals WHERE debit != credit ORDER BY from_id, to_id
+'''
+
+SQL_TOTALS = f'''
+    SELECT
+        (SELECT COALESCE(SUM({SQL_SIGNED_AMOUNT}), 0) FROM operations o WHERE o.id > :operation_id),
+        (SELECT COALESCE(SUM(amount), 0) FROM balances)
+'''
+
+
+def _get_watermark(db_session: Session) -> LedgerWatermark:
+    """Отметка сверки, заблокированная до конца транзакции"""
+    db_session.execute(
+        'INSERT INTO ledger_watermarks (name, operation_id, amount, updated) '
+        'VALUES (:name, 0, 0, :updated) ON CONFLICT (name) DO NOTHING',
+        {'name': WATERMARK_NAME, 'updated': datetime.now()}
+    )
+    return db_session.query(LedgerWatermark).filter(
+        LedgerWatermark.name == WATERMARK_NAME
+    ).with_for_update().one()
+
+
+def reconcile(db_session: Session, batch_size: int = 10000, lag: int = 60) -> List[Tuple]:
+    """Сверяет операции после отметки и сдвигает отметку
+
+    Args:
+        db_session: сессия к БД postgres
+        batch_size: кол-во операций в одной пачке
+        lag: не проверять операции моложе lag секунд, чтобы не пропустить
+             id из еще не закоммиченных транзакций
+
+    Returns:
+        список расхождений:
+            ('pair', id отправителя, id получателя, сумма DEBIT, сумма CREDIT)
+            ('operations', сумма всех операций со знаком)
+            ('balances', сумма всех остатков)
+    """
+    mismatches = []
+    watermark = _get_watermark(db_session)
+    last_operation_id = db_session.execute(
+        'SELECT MAX(id) FROM operations WHERE id > :operation_id AND created <= :created',
+        {'operation_id': watermark.operation_id, 'created': datetime.now() - timedelta(seconds=lag)}
+    ).scalar()
+    while last_operation_id is not None and watermark.operation_id < last_operation_id:
+        params = {
+            'operation_id': watermark.operation_id,
+            'last_operation_id': last_operation_id,
+            'batch_size': batch_size
+        }
+        params['batch_end'] = db_session.execute(SQL_BATCH_END, params).scalar()
+        for row in db_session.execute(SQL_PAIR_MISMATCHES, params):
+            mismatches.append(('pair', ) + tuple(row))
+        watermark.amount += db_session.execute(SQL_BATCH_AMOUNT, params).scalar()
+        watermark.operation_id = params['batch_end']
+        watermark.updated = datetime.now()
+        db_session.commit()
+        watermark = _get_watermark(db_session)
+
+    # the tail after the watermark is summed in the same statement as balances,
+    # so both rows of every committed transfer are either counted or not
+    operations_amount, balances_amount = db_session.execute(
+        SQL_TOTALS, {'operation_id': watermark.operation_id}
+    ).first()
+    db_session.commit()
+    if watermark.amount + operations_amount != 0:
+        mismatches.append(('operations', watermark.amount + operations_amount))
+    if balances_amount != 0:
+        mismatches.append(('balances', balances_amount))
+    return mismatches
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Сверка двойной записи')
+    parser.add_argument('--batch-size', type=int, default=10000, help='кол-во операций в пачке')
+    parser.add_argument('--lag', type=int, default=60, help='не проверять операции моложе N секунд')
+    parser.add_argument('--interval', type=int, default=0, help='повторять каждые N секунд')
+    args = parser.parse_args()
+    while True:
+        db_session = DBSession()
+        try:
+            mismatches = reconcile(db_session, args.batch_size, args.lag)
+        finally:
+            db_session.close()
+        for mismatch in mismatches:
+            print('mismatch:', *mismatch)
+        if not args.interval:
+            return 1 if mismatches else 0
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""
+transfer_worker.py
+====================================
+Запись в журнал переводов, принятых через POST /v1/transfers/async
+
+Воркер забирает пачку PENDING переводов (FOR UPDATE SKIP LOCKED), записывает
+прошедшие проверку парами DEBIT/CREDIT и проставляет статус в той же транзакции.
+Несколько воркеров могут работать параллельно: пачки не пересекаются, а при
+падении воркера транзакция откатывается и переводы остаются PENDING.
+
+Запуск:
+    python -m app.commands.transfer_worker [--batch-size 500] [--interval 0.2] [--once]
+"""
+import sys
+import time
+import argparse
+from typing import Tuple
+
+from sqlalchemy.orm import Session
+
+from app.connects.postgres.session import Session as DBSession
+from app.utils import balance_cache
+from app.utils.ledger import apply_entries
+from app.utils.retry import run_in_transaction
+
+SQL_PENDING = '''
+    SELECT id, from_balance_id, to_balance_id, amount FROM pending_transfers
+    WHERE status = 'PENDING'
+    ORDER BY id
+    LIMIT :batch_size
+    FOR UPDATE SKIP LOCKED
+'''
+
+
+def process_pending(db_session: Session, batch_size: int = 500) -> Tuple[int, int]:
+    """Записывает пачку ожидающих переводов в порядке поступления
+
+    Args:
+        db_session: сессия к БД postgres
+        batch_size: кол-во переводов в одной транзакции
+
+    Returns:
+        (записано, отклонено)
+    """
+    def _process():
+        rows = db_session.execute(SQL_PENDING, {'batch_size': batch_size}).fetchall()
+        if not rows:
+            return 0, 0
+        errors, _ = apply_entries(db_session, None, [(row.from_balance_id, row.to_balance_id, row.amount)
+                                                     for row in rows])
+        params = {}
+        values = []
+        for i, (row, error) in enumerate(zip(rows, errors)):
+            values.append(f"(:id_{i}, :status_{i}, :detail_{i})")
+            params.update({f"id_{i}": row.id, f"status_{i}": 'FAILED' if error else 'DONE', f"detail_{i}": error})
+        db_session.execute(f'''
+            UPDATE pending_transfers p
+            SET status = CAST(v.status AS pendingtransferstatus), detail = v.detail, processed = now()
+            FROM (VALUES {", ".join(values)}) AS v (id, status, detail)
+            WHERE p.id = v.id''', params)
+        failed = len(errors) - errors.count(None)
+        return len(rows) - failed, failed
+
+    return run_in_transaction(db_session, _process)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Запись асинхронных переводов')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--interval', type=float, default=0.2, help='пауза, когда очередь пуста')
+    parser.add_argument('--once', action='store_true', help='обработать очередь и выйти')
+    args = parser.parse_args()
+    # измененные остатки сбрасываются из кэша API процессов через NOTIFY при commit
+    balance_cache.start(listen=False)
+    try:
+        while True:
+            db_session = DBSession()
+            try:
+                done, failed = process_pending(db_session, args.batch_size)
+            finally:
+                db_session.close()
+            if done or failed:
+                print(f"transfers done: {done}, failed: {failed}")
+            elif args.once:
+                return 0
+            else:
+                time.sleep(args.interval)
+    finally:
+        balance_cache.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""
+verify_balances.py
+====================================
+Офлайн сверка остатков кошельков с историей операций
+
+Запуск:
+    python -m app.commands.verify_balances
+"""
+import sys
+from decimal import Decimal
+from typing import List, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.connects.postgres.session import Session as DBSession
+
+
+SQL_MISMATCHES = '''
+    SELECT b.id, b.amount, COALESCE(s.amount, 0) + COALESCE(l.amount, 0) AS expected
+    FROM balances b
+    LEFT JOIN LATERAL (
+        SELECT bs.amount, bs.last_operation_id FROM balance_snapshots bs
+        WHERE bs.balance_id = b.id
+        ORDER BY bs.last_operation_id DESC LIMIT 1
+    ) s ON true
+    LEFT JOIN LATERAL (
+        SELECT SUM(CASE WHEN o.operation_type = 'CREDIT' THEN o.amount ELSE -o.amount END) AS amount
+        FROM operations o
+        WHERE o.owner_balance_id = b.id AND o.id > COALESCE(s.last_operation_id, 0)
+    ) l ON true
+    WHERE b.amount != COALESCE(s.amount, 0) + COALESCE(l.amount, 0)
+    ORDER BY b.id
+'''
+
+
+def get_mismatches(db_session: Session) -> List[Tuple[int, Decimal, Decimal]]:
+    """Находит кошельки, остаток которых не совпадает с суммой операций
+
+    Сверка начинается с последнего снимка кошелька (см. checkpoint_balances).
+
+    Args:
+        db_session: сессия к БД postgres
+
+    Returns:
+        список (id кошелька, сохраненный остаток, остаток по операциям)
+    """
+    return [tuple(row) for row in db_session.execute(SQL_MISMATCHES)]
+
+
+def main() -> int:
+    db_session = DBSession()
+    try:
+        mismatches = get_mismatches(db_session)
+    finally:
+        db_session.close()
+    for balance_id, amount, expected in mismatches:
+        print(f"balance {balance_id}: stored {amount}, by operations {expected}")
+    print(f"mismatches: {len(mismatches)}")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+"""
+pool.py
+====================================
+Пул соединений с подсчётом ожиданий и таймаутов выдачи соединения
+"""
+import os
+import time
+import threading
+
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+
+class PoolStats:
+    """Счётчики выдачи соединений из пула, общие для всех потоков процесса"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def add(self, wait: float, timeout: bool = False):
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timeout
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool, который замеряет время получения соединения (ожидание в очереди и открытие нового)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.add(time.perf_counter() - started, timeout=True)
+            raise
+        self.stats.add(time.perf_counter() - started)
+        return conn
+
+
+def get_pool_stats(pool: InstrumentedQueuePool) -> dict:
+    """Текущее состояние пула соединений процесса
+
+    Args:
+        pool: пул соединений engine
+
+    Returns:
+        размеры пула, занятые соединения и счётчики ожиданий (время в миллисекундах)
+    """
+    stats = pool.stats
+    with stats._lock:
+        checkouts, timeouts, wait_total, wait_max = stats.checkouts, stats.timeouts, stats.wait_total, stats.wait_max
+    return {
+        'pid': os.getpid(),
+        'size': pool.size(),
+        'max_overflow': pool._max_overflow,
+        'timeout': pool.timeout(),
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': max(pool.overflow(), 0),
+        'checkouts': checkouts,
+        'checkout_timeouts': timeouts,
+        'wait_avg_ms': wait_total / checkouts * 1000 if checkouts else 0.0,
+        'wait_max_ms': wait_max * 1000,
+    }
@@ -1,5 +1,14 @@
-from starlette.requests import Request
+from app.connects.postgres.session import Session
 
-def get_db(request: Request):
-    return request.state.db
 
+def get_db():
+    """Сессия к БД на время запроса
+
+    Создаётся только для обработчиков, которые от неё зависят, и закрывается после ответа,
+    в том числе если обработчик упал. Соединение берётся из пула при первом запросе к БД.
+    """
+    db = Session()
+    try:
+        yield db
+    finally:
+        db.close()
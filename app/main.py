@@ -1,11 +1,12 @@
+from anyio import to_thread
 from uvicorn import run
 
-from starlette.requests import Request
 from fastapi import FastAPI
 
 from app import settings
 from app.routers.v1 import router as api_router
-from app.connects.postgres.session import Session, engine
+from app.utils import balance_cache, coalescer
+from app.connects.postgres.session import engine
 from app.connects.postgres.base import DBBase
 
 DBBase.metadata.create_all(bind=engine)
@@ -18,19 +19,21 @@ def get_application() -> FastAPI:
     application.include_router(
         api_router, prefix=settings.API_PREFIX,
     )
+    application.add_event_handler("startup", set_threadpool_size)
+    application.add_event_handler("startup", balance_cache.start)
+    application.add_event_handler("startup", coalescer.start)
+    application.add_event_handler("shutdown", coalescer.stop)
+    application.add_event_handler("shutdown", balance_cache.stop)
     return application
 
 
-app = get_application()
+def set_threadpool_size():
+    """Размер пула потоков, в котором выполняются синхронные обработчики"""
+    to_thread.current_default_thread_limiter().total_tokens = settings.THREADPOOL_SIZE
 
-@app.middleware("http")
-async def db_session_middleware(request: Request, call_next):
 
-    request.state.db = Session()
-    response = await call_next(request)
-    request.state.db.close()
+app = get_application()
 
-    return response
 # debug only
 if __name__ == "__main__":
     run(app, host="0.0.0.0", port=8000)
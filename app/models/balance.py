@@ -1,12 +1,88 @@
 import enum
+from itertools import count
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Enum, Numeric
+from decimal import Decimal
+from typing import Dict, List, Tuple
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Enum, Numeric, Index, DDL, case, event, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
+from app import settings
 from app.connects.postgres.base import DBBase
 from app.models.auth import User
+from app.utils import balance_cache
 from app.utils.db_utils import get_or_create
+from app.utils.prepared import PreparedStatement
+
+SYSTEM_USERNAME = 'system_user'
+_system_shard_counter = count()
+
+# пользователь и кошелек: INSERT ... ON CONFLICT DO NOTHING не видит существующие строки
+# (снимок общий на весь запрос), поэтому они добавляются к RETURNING через UNION ALL
+CREATE_USER_BALANCE = text('''
+    WITH new_user AS (
+        INSERT INTO users (username, is_active) VALUES (:username, :is_active)
+        ON CONFLICT (username) DO NOTHING
+        RETURNING id, username, is_active
+    ), db_user AS (
+        SELECT id, username, is_active FROM new_user
+        UNION ALL
+        SELECT id, username, is_active FROM users WHERE username = :username
+    ), new_balance AS (
+        INSERT INTO balances (user_id, amount, currency)
+        SELECT id, 0, 'USD' FROM db_user
+        ON CONFLICT (user_id) DO NOTHING
+        RETURNING id, user_id, amount, currency
+    ), db_balance AS (
+        SELECT id, user_id, amount, currency FROM new_balance
+        UNION ALL
+        SELECT b.id, b.user_id, b.amount, b.currency FROM balances b JOIN db_user u ON u.id = b.user_id
+    )
+    SELECT b.id, u.username, u.is_active, b.amount, CAST(b.currency AS text) AS currency
+    FROM db_balance b JOIN db_user u ON u.id = b.user_id''')
+
+# то же для пачки логинов, по строке на каждый логин пачки без повторов
+CREATE_USERS_BALANCES = text('''
+    WITH input AS (
+        SELECT DISTINCT username FROM unnest(CAST(:usernames AS text[])) AS t (username)
+    ), new_users AS (
+        INSERT INTO users (username, is_active)
+        SELECT username, :is_active FROM input ORDER BY username
+        ON CONFLICT (username) DO NOTHING
+        RETURNING id, username
+    ), db_users AS (
+        SELECT id, username FROM new_users
+        UNION ALL
+        SELECT u.id, u.username FROM users u JOIN input i ON i.username = u.username
+    ), new_balances AS (
+        INSERT INTO balances (user_id, amount, currency)
+        SELECT id, 0, 'USD' FROM db_users ORDER BY id
+        ON CONFLICT (user_id) DO NOTHING
+        RETURNING id, user_id
+    ), db_balances AS (
+        SELECT id, user_id, true AS created FROM new_balances
+        UNION ALL
+        SELECT b.id, b.user_id, false FROM balances b JOIN db_users u ON u.id = b.user_id
+    )
+    SELECT u.username, b.id, b.created FROM db_users u JOIN db_balances b ON b.user_id = u.id''')
+
+# частые запросы одиночных переводов и зачислений, см. app/utils/prepared.py
+# enum отдается текстом: у пересозданного типа другой oid, и готовый запрос упал бы
+# с "cached plan must not change result type"
+SELECT_BALANCE = PreparedStatement('balance_select', '''
+    SELECT b.id, b.amount, CAST(b.currency AS text) AS currency, u.username
+    FROM balances b JOIN users u ON u.id = b.user_id
+    WHERE b.id = :balance_id''', balance_id='integer')
+CHANGE_AMOUNTS = PreparedStatement('balance_change_amounts', '''
+    UPDATE balances b
+    SET amount = b.amount + v.amount, operations_count = b.operations_count + v.operations
+    FROM unnest(:balance_ids, :amounts, :operations) AS v (id, amount, operations)
+    WHERE b.id = v.id
+    RETURNING b.id, b.amount''', balance_ids='integer[]', amounts='numeric[]', operations='integer[]')
+INSERT_TRANSFER = PreparedStatement('operations_insert_transfer', '''
+    INSERT INTO operations (amount, operation_type, owner_balance_id, more_balance_id, created)
+    VALUES (:amount, 'DEBIT', :from_id, :to_id, :created), (:amount, 'CREDIT', :to_id, :from_id, :created)''',
+    amount='numeric', from_id='integer', to_id='integer', created='timestamptz')
 
 
 class Сurrency(enum.Enum):
@@ -18,44 +94,334 @@ class Balance(DBBase):
     __tablename__ = "balances"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
+    user_id = Column(Integer, ForeignKey('users.id'), unique=True)
+    """int: у пользователя один кошелек"""
     user = relationship("User", back_populates="balance")
     amount = Column(Numeric, nullable=False, default=0)
     currency = Column(Enum(Сurrency), nullable=False, default=Сurrency.USD)
+    operations_count = Column(Integer, nullable=False, default=0, server_default='0')
+    """int: кол-во операций кошелька, обновляется вместе со вставкой Operations"""
+
+    @classmethod
+    def get_system_usernames(cls) -> List[str]:
+        """Логины владельцев системных кошельков (шардов)"""
+        return [SYSTEM_USERNAME if shard == 0 else f'{SYSTEM_USERNAME}_{shard}'
+                for shard in range(max(settings.SYSTEM_BALANCE_SHARDS, 1))]
+
+    @classmethod
+    def get_system_shard(cls, key: int = None) -> int:
+        """Выбор системного кошелька: по хешу ключа или по кругу
+
+        Args:
+            key: ключ шардирования (например id пополняемого кошелька)
+        """
+        shards = max(settings.SYSTEM_BALANCE_SHARDS, 1)
+        if key is None or settings.SYSTEM_BALANCE_STRATEGY == 'round_robin':
+            return next(_system_shard_counter) % shards
+        return hash(key) % shards
+
+    @classmethod
+    def create_for_user(cls, db_session, username: str, is_active: bool = True):
+        """Пользователь с кошельком одним запросом: создает недостающее, существующее не меняет
+
+        Returns:
+            строка (id, username, is_active, amount, currency) кошелька
+        """
+        for _ in range(2):
+            row = db_session.execute(CREATE_USER_BALANCE, {'username': username, 'is_active': is_active}).first()
+            if row:
+                return row
+        # пользователя создал параллельный запрос после снимка нашего запроса, повтор его уже увидит
+        raise RuntimeError(f'Could not create balance for user: {username}')
+
+    @classmethod
+    def create_for_users(cls, db_session, usernames: List[str], is_active: bool = True,
+                         chunk_size: int = 5000) -> List[Tuple[str, int, bool]]:
+        """Пользователи с кошельками пачкой: один INSERT ... SELECT FROM unnest на chunk_size логинов
+
+        Пользователи вставляются по возрастанию логина, кошельки - по возрастанию id
+        пользователя, чтобы параллельные пачки не блокировали друг друга встречно.
+
+        Args:
+            db_session: сессия к БД postgres
+            usernames: логины, могут повторяться и уже существовать
+            is_active: активность новых пользователей
+            chunk_size: кол-во логинов в одном запросе
+
+        Returns:
+            (логин, id кошелька, кошелек создан) на каждый логин в порядке usernames
+        """
+        balances = {}
+        for start in range(0, len(usernames), chunk_size):
+            chunk = usernames[start:start + chunk_size]
+            # the second pass sees users committed by a concurrent batch after the snapshot of the first one
+            for _ in range(2):
+                missing = set(chunk) - balances.keys()
+                if missing:
+                    rows = db_session.execute(CREATE_USERS_BALANCES, {'usernames': list(missing), 'is_active': is_active})
+                    balances.update((row.username, (row.id, row.created)) for row in rows)
+            if set(chunk) - balances.keys():
+                raise RuntimeError('Could not create balances for all users of the batch')
+        result = []
+        seen = set()
+        for username in usernames:
+            balance_id, created = balances[username]
+            result.append((username, balance_id, created and username not in seen))
+            seen.add(username)
+        return result
+
+    @classmethod
+    def select(cls, db_session, balance_id: int):
+        """Остаток, валюта и владелец кошелька одним запросом, без загрузки ORM объектов
+
+        Returns:
+            строка (id, amount, currency, username) или None
+        """
+        return SELECT_BALANCE.execute(db_session, balance_id=balance_id).first()
 
     @classmethod
-    def get_system_balance(cls, db_session):
-        db_user, _ = get_or_create(db_session, User, defaults={"is_active": False}, username='system_user')
+    def get_system_balance(cls, db_session, key: int = None):
+        """Системный кошелек, с которого списываются зачисления
+
+        Args:
+            db_session: сессия к БД postgres
+            key: ключ шардирования, см. get_system_shard
+        """
+        username = cls.get_system_usernames()[cls.get_system_shard(key)]
+        db_user, _ = get_or_create(db_session, User, defaults={"is_active": False}, username=username)
         db_balance, _ = get_or_create(db_session, cls, user_id=db_user.id)
         return db_balance
 
-    def set_amount(self, db_session):
-        debit = db_session.query(func.sum(Operations.amount)).filter_by(owner_balance=self, operation_type=Operations.OperationsType.DEBIT).first()[0]
-        credit = db_session.query(func.sum(Operations.amount)).filter_by(owner_balance=self, operation_type=Operations.OperationsType.CREDIT).first()[0]
-        debit = 0.0 if debit is None else float(debit)
-        credit = 0.0 if credit is None else float(credit)
-        self.amount = credit - debit
+    @classmethod
+    def get_system_amount(cls, db_session) -> Decimal:
+        """Суммарный остаток всех системных кошельков"""
+        amount = db_session.query(func.sum(cls.amount)).join(User).filter(
+            User.username.in_(cls.get_system_usernames())
+        ).scalar()
+        return Decimal(0) if amount is None else amount
+
+    @classmethod
+    def change_amount(cls, db_session, balance_id: int, amount: Decimal, operations: int = 1) -> Decimal:
+        """Атомарно изменяет остаток кошелька на amount (amount = amount + :amount)
+
+        Вызывается в той же транзакции, что и вставка Operations,
+        кэш кошелька сбрасывается после commit (см. app/utils/balance_cache.py).
+
+        Args:
+            db_session: сессия к БД postgres
+            balance_id: id кошелька
+            amount: изменение остатка (отрицательное для списания)
+            operations: кол-во добавленных операций кошелька
+
+        Returns:
+            новый остаток кошелька
+        """
+        stmt = cls.__table__.update().where(cls.id == balance_id).values(
+            amount=cls.amount + amount,
+            operations_count=cls.operations_count + operations
+        ).returning(cls.amount)
+        balance_cache.invalidate(db_session, [balance_id])
+        return db_session.execute(stmt).scalar()
+
+    @classmethod
+    def change_amounts(cls, db_session, changes: List[Tuple[int, Decimal]], chunk_size: int = 1000) -> Dict[int, Decimal]:
+        """Атомарно изменяет остатки нескольких кошельков
+
+        Изменения одного кошелька суммируются и применяются одним
+        UPDATE ... FROM unnest(...) на chunk_size кошельков, кошельки идут
+        по возрастанию id. Чтобы строки гарантированно блокировались в этом
+        порядке, их нужно заранее заблокировать (см. app/utils/ledger.py).
 
-    def check_operation(self, more_balance, db_session):
-        debit = db_session.query(func.sum(Operations.amount)).filter_by(owner_balance=self, operation_type=Operations.OperationsType.CREDIT, more_balance=more_balance).first()[0]
-        credit = db_session.query(func.sum(Operations.amount)).filter_by(owner_balance=more_balance, operation_type=Operations.OperationsType.DEBIT, more_balance=self).first()[0]
-        return debit == credit
+        Args:
+            db_session: сессия к БД postgres
+            changes: список (id кошелька, сумма операции со знаком), по элементу на операцию
+            chunk_size: кол-во кошельков в одном UPDATE
+
+        Returns:
+            {id кошелька: новый остаток}
+        """
+        amounts, operations = {}, {}
+        for balance_id, amount in changes:
+            amounts[balance_id] = amounts.get(balance_id, 0) + amount
+            operations[balance_id] = operations.get(balance_id, 0) + 1
+        balance_ids = sorted(amounts)
+        if len(balance_ids) == 1:
+            balance_id = balance_ids[0]
+            return {balance_id: cls.change_amount(db_session, balance_id, amounts[balance_id], operations[balance_id])}
+        balance_cache.invalidate(db_session, balance_ids)
+        result = {}
+        for start in range(0, len(balance_ids), chunk_size):
+            chunk = balance_ids[start:start + chunk_size]
+            rows = CHANGE_AMOUNTS.execute(db_session, balance_ids=chunk,
+                                          amounts=[amounts[balance_id] for balance_id in chunk],
+                                          operations=[operations[balance_id] for balance_id in chunk])
+            result.update((row.id, row.amount) for row in rows)
+        return result
+
+    def get_snapshot(self, db_session, at: datetime = None):
+        """Последний снимок остатка кошелька
+
+        Args:
+            db_session: сессия к БД postgres
+            at: последний снимок, сделанный не позже этого момента
+        """
+        query = db_session.query(BalanceSnapshot).filter(BalanceSnapshot.balance_id == self.id)
+        if at is not None:
+            query = query.filter(BalanceSnapshot.created <= at)
+        return query.order_by(BalanceSnapshot.last_operation_id.desc()).first()
+
+    def calculate_amount(self, db_session, at: datetime = None) -> Decimal:
+        """Пересчитывает остаток по операциям (только для офлайн сверки и истории)
+
+        Начинает с последнего снимка и суммирует только более новые операции.
+
+        Args:
+            db_session: сессия к БД postgres
+            at: остаток на этот момент, по умолчанию текущий
+        """
+        snapshot = self.get_snapshot(db_session, at)
+        query = db_session.query(func.sum(Operations.signed_amount())).filter(
+            Operations.owner_balance_id == self.id
+        )
+        if snapshot:
+            query = query.filter(Operations.id > snapshot.last_operation_id)
+        if at is not None:
+            query = query.filter(Operations.created <= at)
+        amount = query.scalar()
+        amount = Decimal(0) if amount is None else amount
+        return amount + snapshot.amount if snapshot else amount
+
+
+class BalanceSnapshot(DBBase):
+    """Модель снимка остатка кошелька
+
+    Снимок хранит остаток с учетом всех операций кошелька с id <= last_operation_id.
+    """
+    __tablename__ = "balance_snapshots"
+    __table_args__ = (
+        Index('ix_balance_snapshots_balance_id_last_operation_id', 'balance_id', 'last_operation_id'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    balance_id = Column(Integer, ForeignKey('balances.id', ondelete='CASCADE'), nullable=False)
+    amount = Column(Numeric, nullable=False, default=0)
+    last_operation_id = Column(Integer, nullable=False, default=0)
+    created = Column(DateTime(True), nullable=False, default=datetime.now)
+
+
+class LedgerWatermark(DBBase):
+    """Модель отметки фоновой сверки: до какой операции проверен журнал
+    """
+    __tablename__ = "ledger_watermarks"
+
+    name = Column(String, primary_key=True)
+    operation_id = Column(Integer, nullable=False, default=0)
+    """int: последняя проверенная операция"""
+    amount = Column(Numeric, nullable=False, default=0)
+    """Decimal: сумма операций со знаком до operation_id"""
+    updated = Column(DateTime(True), nullable=False, default=datetime.now)
 
 
 class Operations(DBBase):
     """Модель операций пользователя
+
+    Таблица секционирована по created (по месяцам), см. app/commands/partitions.py
     """
     __tablename__ = "operations"
+    __table_args__ = {'postgresql_partition_by': 'RANGE (created)'}
 
     class OperationsType(enum.Enum):
         DEBIT = 0
         CREDIT = 1
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
     owner_balance_id = Column(Integer, ForeignKey('balances.id', ondelete='SET NULL'))
     owner_balance = relationship("Balance", backref="owner_operations", foreign_keys=[owner_balance_id])
-    created = Column(DateTime(True), default=datetime.now())
+    # the partition key has to be part of the primary key
+    created = Column(DateTime(True), primary_key=True, default=datetime.now)
     operation_type = Column(Enum(OperationsType), nullable=False, index=True, default=OperationsType.DEBIT)
     amount = Column(Numeric, nullable=False, default=0)
     more_balance_id = Column(Integer, ForeignKey('balances.id', ondelete='SET NULL'))
     more_balance = relationship("Balance", backref="more_operations", foreign_keys=[more_balance_id])
+
+    @classmethod
+    def add_transfer(cls, db_session, from_id: int, to_id: int, amount: Decimal):
+        """Вставляет пару операций перевода: DEBIT отправителя и CREDIT получателя
+
+        Args:
+            db_session: сессия к БД postgres
+            from_id: кошелек отправителя
+            to_id: кошелек получателя
+            amount: сумма перевода
+        """
+        INSERT_TRANSFER.execute(db_session, amount=amount, from_id=from_id, to_id=to_id, created=datetime.now())
+
+    @classmethod
+    def signed_amount(cls):
+        """Сумма операции со знаком: CREDIT - приход, DEBIT - расход"""
+        return case([(cls.operation_type == cls.OperationsType.CREDIT, cls.amount)], else_=-cls.amount)
+
+
+# rows outside of the monthly partitions
+event.listen(Operations.__table__, 'after_create', DDL(
+    'CREATE TABLE IF NOT EXISTS operations_default PARTITION OF operations DEFAULT'
+).execute_if(dialect='postgresql'))
+
+# composite indexes of the hot ledger queries, INCLUDE is not supported by Index in SQLAlchemy 1.3;
+# existing databases get them from alembic revision c4e8f0a2b6d1
+OPERATIONS_INDEXES = (
+    # balance recompute and sums by operation type
+    'CREATE INDEX IF NOT EXISTS ix_operations_owner_balance_id_operation_type '
+    'ON operations (owner_balance_id, operation_type) INCLUDE (amount)',
+    # operations list and snapshots: sorting/paging by id
+    'CREATE INDEX IF NOT EXISTS ix_operations_owner_balance_id_id '
+    'ON operations (owner_balance_id, id) INCLUDE (operation_type, amount)',
+    # operations list: sorting/paging by created
+    'CREATE INDEX IF NOT EXISTS ix_operations_owner_balance_id_created_id '
+    'ON operations (owner_balance_id, created, id)',
+    # double-entry reconciliation and filters by counterparty
+    'CREATE INDEX IF NOT EXISTS ix_operations_owner_balance_id_more_balance_id '
+    'ON operations (owner_balance_id, more_balance_id, operation_type) INCLUDE (amount)',
+)
+for _sql in OPERATIONS_INDEXES:
+    event.listen(Operations.__table__, 'after_create', DDL(_sql).execute_if(dialect='postgresql'))
+
+# перевод одним вызовом: блокировки в порядке id, проверки, пара операций и оба остатка,
+# используется при settings.LEDGER_PROCEDURE (app/utils/ledger.py:call_transfer)
+LEDGER_TRANSFER_FUNCTION = """
+CREATE OR REPLACE FUNCTION ledger_transfer(p_from integer, p_to integer, p_amount numeric,
+                                           p_check_funds boolean DEFAULT true)
+RETURNS TABLE (from_amount numeric, to_amount numeric)
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_from numeric;
+BEGIN
+    IF p_amount <= 0 THEN
+        RAISE EXCEPTION USING MESSAGE = 'Amount must be positive: ' || p_amount;
+    END IF;
+    PERFORM 1 FROM balances WHERE id IN (p_from, p_to) ORDER BY id FOR UPDATE;
+    SELECT amount INTO v_from FROM balances WHERE id = p_from;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION USING MESSAGE = 'Not found balance id: ' || p_from;
+    END IF;
+    PERFORM 1 FROM balances WHERE id = p_to;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION USING MESSAGE = 'Not found recipient''s balance id: ' || p_to;
+    END IF;
+    IF p_check_funds AND v_from < p_amount THEN
+        RAISE EXCEPTION USING MESSAGE = 'Insufficient funds on the balance: ' || p_from;
+    END IF;
+    INSERT INTO operations (owner_balance_id, more_balance_id, amount, operation_type, created)
+    VALUES (p_from, p_to, p_amount, 'DEBIT', now()), (p_to, p_from, p_amount, 'CREDIT', now());
+    UPDATE balances SET amount = amount - p_amount, operations_count = operations_count + 1
+    WHERE id = p_from RETURNING amount INTO from_amount;
+    UPDATE balances SET amount = amount + p_amount, operations_count = operations_count + 1
+    WHERE id = p_to RETURNING amount INTO to_amount;
+    RETURN NEXT;
+END
+$$
+"""
+event.listen(Operations.__table__, 'after_create', DDL(LEDGER_TRANSFER_FUNCTION).execute_if(dialect='postgresql'))
+event.listen(Operations.__table__, 'before_drop', DDL(
+    'DROP FUNCTION IF EXISTS ledger_transfer(integer, integer, numeric, boolean)'
+).execute_if(dialect='postgresql'))
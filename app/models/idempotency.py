@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+from sqlalchemy import Column, String, Integer, DateTime
+from sqlalchemy.dialects.postgresql import JSONB
+
+from app.connects.postgres.base import DBBase
+
+
+class IdempotencyKey(DBBase):
+    """Модель ключа идемпотентности: отпечаток запроса и сохраненный ответ
+    """
+    __tablename__ = "idempotency_keys"
+
+    key = Column(String(255), primary_key=True)
+    """str: значение заголовка Idempotency-Key"""
+    fingerprint = Column(String(64), nullable=False)
+    """str: sha256 обработчика и тела запроса"""
+    status_code = Column(Integer, nullable=False, default=200)
+    response = Column(JSONB)
+    """dict: ответ, записывается в одной транзакции с операциями"""
+    created = Column(DateTime(True), nullable=False, default=datetime.now, index=True)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import enum
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Enum, Numeric, Index
+
+from app.connects.postgres.base import DBBase
+
+
+class PendingTransfer(DBBase):
+    """Модель перевода, принятого в асинхронном режиме (POST /v1/transfers/async)
+
+    Переводы в статусе PENDING записывает в журнал app/commands/transfer_worker.py
+    """
+    __tablename__ = "pending_transfers"
+
+    class Status(enum.Enum):
+        PENDING = 0
+        DONE = 1
+        FAILED = 2
+
+    id = Column(Integer, primary_key=True, index=True)
+    from_balance_id = Column(Integer, ForeignKey('balances.id', ondelete='CASCADE'), nullable=False)
+    to_balance_id = Column(Integer, ForeignKey('balances.id', ondelete='CASCADE'), nullable=False)
+    amount = Column(Numeric, nullable=False)
+    status = Column(Enum(Status, name='pendingtransferstatus'), nullable=False, default=Status.PENDING)
+    detail = Column(String)
+    """str: причина отказа для FAILED"""
+    created = Column(DateTime(True), nullable=False, default=datetime.now)
+    processed = Column(DateTime(True))
+
+    __table_args__ = (
+        # очередь воркера: только необработанные переводы
+        Index('ix_pending_transfers_pending', 'id', postgresql_where=status == Status.PENDING),
+    )
@@ -2,6 +2,8 @@ from fastapi import APIRouter, Depends
 
 from .balance import router as segments_router
 from .auth import router as auth_router
+from .stats import router as stats_router
+from .transfers import router as transfers_router
 
 router = APIRouter()
 
@@ -13,3 +15,11 @@ router.include_router(auth_router,
                       prefix="/auth",
                       tags=["auth"],
                       )
+router.include_router(transfers_router,
+                      prefix="/transfers",
+                      tags=["transfers"],
+                      )
+router.include_router(stats_router,
+                      prefix="/stats",
+                      tags=["stats"],
+                      )
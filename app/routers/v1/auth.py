@@ -1,21 +1,25 @@
 from sqlalchemy.orm import Session
 
-from fastapi import Depends, APIRouter
+from fastapi import Depends, APIRouter, HTTPException
+
+from app import settings
 from app.connects.postgres.utils import get_db
 from app.schemas import (
     CreateBalanceSchema,
-    BalanceSchema
+    BalanceSchema,
+    BulkCreateBalanceSchema,
+    BulkCreateBalanceResponceShema
 )
 from app.models.balance import Balance
-from app.models.auth import User
-from app.utils.db_utils import get_or_create
+from app.utils.responses import ORJSONResponse
+from app.utils.retry import run_in_transaction
 
 
 router = APIRouter()
 
 
 @router.post("/", response_model=BalanceSchema, name="auth:create")
-async def create_balance(*, user: CreateBalanceSchema, pg: Session = Depends(get_db)):
+def create_balance(*, user: CreateBalanceSchema, pg: Session = Depends(get_db)):
     """Создание клиента с кошельком
 
     Args:
@@ -25,22 +29,40 @@ async def create_balance(*, user: CreateBalanceSchema, pg: Session = Depends(get
     Returns:
         BalanceSchema
     """
-    db_user, create = get_or_create(pg, User, defaults={"is_active": True}, username=user.username)
-    if create:
-        pg.add(db_user)
-
-        db_balance = Balance(user=db_user)
-        pg.add(db_balance)
-        pg.commit()
-        pg.refresh(db_user)
-        pg.refresh(db_balance)
-    else:
-        db_balance = db_user.balance
-
-    return BalanceSchema(
-            id=db_balance.id,
-            username=db_user.username,
-            is_active=db_user.is_active,
-            amount=db_balance.amount,
-            currency=db_balance.currency.name
-        )
+    # user and wallet are created (or read) by one statement
+    db_balance = Balance.create_for_user(pg, user.username)
+    pg.commit()
+    return BalanceSchema(**db_balance)
+
+
+@router.post("/bulk", response_model=BulkCreateBalanceResponceShema, name="auth:bulk_create")
+def create_balances_bulk(*, data: BulkCreateBalanceSchema, pg: Session = Depends(get_db)):
+    """Создание клиентов с кошельками пачкой (перенос пользователей партнера)
+
+    Пользователи и кошельки вставляются многострочными INSERT по AUTH_BULK_CHUNK_SIZE
+    логинов, вся пачка - одна транзакция. Существующие логины не меняются, для них
+    отдаются имеющиеся кошельки. Больше AUTH_BULK_MAX_ITEMS логинов - несколько запросов
+    или python -m app.commands.onboard_users.
+
+    Args:
+        data: логины
+        pg: сессия к БД postgres
+
+    Returns:
+        BulkCreateBalanceResponceShema: кошелек на каждый логин в порядке data.usernames,
+        created - кошелек создан этим запросом
+    """
+    if len(data.usernames) > settings.AUTH_BULK_MAX_ITEMS:
+        raise HTTPException(status_code=400,
+                            detail=f"Too many usernames in the batch, max: {settings.AUTH_BULK_MAX_ITEMS}")
+    try:
+        balances = run_in_transaction(pg, lambda: Balance.create_for_users(pg, data.usernames,
+                                                                           chunk_size=settings.AUTH_BULK_CHUNK_SIZE))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # up to AUTH_BULK_MAX_ITEMS items, encoded without per-item pydantic models
+    return ORJSONResponse({
+        'items': [{'username': username, 'id': balance_id, 'created': created}
+                  for username, balance_id, created in balances],
+        'created': sum(created for _, _, created in balances),
+    })
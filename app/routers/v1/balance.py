@@ -1,10 +1,14 @@
-from typing import List
+import time
+from typing import List, Optional
 from datetime import datetime
+from decimal import Decimal
 
-from fastapi import FastAPI, Depends, APIRouter, HTTPException, Query
+from fastapi import FastAPI, Depends, APIRouter, HTTPException, Query, Header
+from fastapi.responses import StreamingResponse
 
 from sqlalchemy.orm import Session
 
+from app import settings
 from app.connects.postgres.utils import get_db
 from app.schemas import (
     BalanceSchema,
@@ -12,33 +16,108 @@ from app.schemas import (
     AddBalanceResponceShema,
     TransferBalanceSchema,
     TransferBalanceResponceShema,
-    OperationsListSchema
+    OperationsListSchema,
+    SystemBalanceSchema,
+    CountMode,
+    BatchDepositSchema,
+    BatchDepositItemResponceShema,
+    BatchDepositResponceShema,
+    BatchTransferSchema,
+    BatchTransferItemResponceShema,
+    BatchTransferResponceShema
 )
-from app.models.balance import Balance, Operations
+from app.models.balance import Balance, Operations, Сurrency
 from app.models.auth import User
+from app.utils import balance_cache, coalescer
+from app.utils.ledger import LedgerError, apply_deposits, apply_transfers, call_transfer, lock_balances
+from app.utils.retry import run_in_transaction
+from app.utils.idempotency import (
+    IdempotencyError,
+    get_fingerprint,
+    get_response,
+    claim_key,
+    save_response,
+    remember
+)
+from app.utils.responses import ORJSONResponse, rows_to_dicts
+from app.utils.export import ExportFormat, MEDIA_TYPES, stream_rows, iter_csv, iter_ndjson
 from app.utils.request import get_filters_for_list_values
-from app.utils.pgsql import generate_filter, generate_order_by
+from app.utils.prepared import PreparedShapes
+from app.utils.pgsql import (
+    FilterCompiler,
+    generate_order_by,
+    get_keyset_fields,
+    generate_keyset,
+    encode_cursor,
+    decode_cursor
+)
 
 
 router = APIRouter()
 
+
+def get_replay(pg: Session, idempotency_key: Optional[str], fingerprint: str) -> Optional[dict]:
+    """Сохраненный ответ на запрос с тем же Idempotency-Key"""
+    try:
+        return get_response(pg, idempotency_key, fingerprint)
+    except IdempotencyError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@router.get("/system", response_model=SystemBalanceSchema, name="balances:system")
+def get_system_balance(*, pg: Session = Depends(get_db)):
+    """Суммарный остаток системных кошельков"""
+    return SystemBalanceSchema(
+                        amount=Balance.get_system_amount(pg),
+                        shards=len(Balance.get_system_usernames()),
+                        currency=Сurrency.USD.name
+                    )
+
 @router.get("/{balance_id}", response_model=BalanceSchema, name="balances:details")
-async def get_balance_by_id(*, balance_id: int, pg: Session = Depends(get_db)):
-    """Просмотр баланса"""
+def get_balance_by_id(*, balance_id: int, at: datetime = Query(None), max_age: float = Query(None, ge=0),
+                      pg: Session = Depends(get_db)):
+    """Просмотр баланса
+
+    Args:
+        balance_id: id баланса
+        at: остаток на момент времени (считается от ближайшего снимка)
+        max_age: допустимый возраст ответа из кэша в секундах, 0 - читать из БД
+        pg: сессия к БД postgres
+    """
+    if at is None:
+        cached = balance_cache.get(balance_id, max_age)
+        if cached is not None:
+            return ORJSONResponse(cached)
+    started = time.monotonic()
     db_balance = pg.query(Balance).join(User).filter(Balance.id == balance_id).first()
     if not db_balance:
         raise HTTPException(status_code=400, detail=f"Not found balance id: {balance_id}")
 
-    return BalanceSchema(
+    balance = BalanceSchema(
                         id=db_balance.id,
                         username=db_balance.user.username,
                         is_active=db_balance.user.is_active,
-                        amount=db_balance.amount,
+                        amount=db_balance.amount if at is None else db_balance.calculate_amount(pg, at),
                         currency=db_balance.currency.name
                     )
+    payload = balance.dict()
+    if at is None:
+        balance_cache.put(balance_id, payload, started)
+    return ORJSONResponse(payload)
+
+# поля, по которым разрешена фильтрация списка операций (?field=)
+OPERATIONS_FILTER = FilterCompiler(Operations.__table__,
+                                   ('id', 'created', 'operation_type', 'amount', 'owner_balance_id', 'more_balance_id'),
+                                   table_pre='o')
+# курсор только по NOT NULL полям: сравнение (поле, id) > (...) не находит строк с NULL в поле
+OPERATIONS_CURSOR_SORT = tuple(f for f in OPERATIONS_FILTER.types if not Operations.__table__.c[f].nullable)
+# списки и подсчеты операций готовятся на сервере по форме запроса (фильтры, сортировка, курсор)
+OPERATIONS_LIST = PreparedShapes('operations_list')
+OPERATIONS_COUNT = PreparedShapes('operations_count')
+
 
 @router.get("/operations/{balance_id}", response_model=OperationsListSchema, name="operations:list")
-async def get_segments(*,
+def get_segments(*,
                       balance_id: int, 
                       limit: int = Query(20),
                       offset: int = Query(0),
@@ -47,6 +126,10 @@ async def get_segments(*,
                       op: List[str] = Query(None),
                       sort_by: List[str] = Query(None),
                       sort_order: List[str] = Query(None),
+                      cursor: str = Query(None),
+                      count: CountMode = Query(CountMode.exact),
+                      date_from: datetime = Query(None),
+                      date_to: datetime = Query(None),
                       pg: Session = Depends(get_db)
                       ):
     """Получить список операций
@@ -57,9 +140,17 @@ async def get_segments(*,
         offset: начать с № записи
         field: фильтрация, указать название поля(ей - через ,)
         value: фильтрация, указать значение(я - через ,)
-        op: фильтрация, указать операцию(через , ('=', '!=', '>', '<'))
+        op: фильтрация, указать операцию(через , ('=', '!=', '>', '<', 'in', 'between', 'like' ...,
+            см. app/utils/pgsql.py:FILTER_OPS); для in и between значения через |
         sort_by: поле по которому сортировать: ?sort_by=id (название поле)
         sort_order: направление сортировки: ?sort_order=asc (asc\desc)
+        cursor: постраничная выборка по ключу вместо offset: пустой для первой страницы,
+                далее next_cursor из предыдущего ответа
+        count: как считать totalCount при фильтрации: exact - count(*), estimate - оценка
+               планировщика, none - не считать; без фильтров берется счетчик кошелька
+        date_from: операции начиная с момента (включительно)
+        date_to: операции до момента (не включительно); с date_from/date_to
+                 читаются только секции operations за этот период
         pg: конектор к postgres
 
     Example:
@@ -70,136 +161,359 @@ async def get_segments(*,
         Фильтр передается:
             ?id=123 (единичное значение)
             ?id=123|456|444 (множественное значение)
+        Выборка по курсору (стоимость страницы не зависит от ее номера):
+            ?limit=100&cursor= , затем ?limit=100&cursor=<next_cursor>
+            сортировка по одному NOT NULL полю (id, created, operation_type, amount), при равенстве по id
     """
     db_balance = pg.query(Balance).filter(Balance.id == balance_id).first()
     if not db_balance:
         raise HTTPException(status_code=400, detail=f"Not found balance id: {balance_id}")
     filters = get_filters_for_list_values({'field': field, 'value': value, 'op': op})
     try:
-        where = f"WHERE o.owner_balance_id={balance_id}"
+        where = "WHERE o.owner_balance_id = :balance_id"
+        where_params = {'balance_id': balance_id}
+        bind_types = {'balance_id': 'integer', 'date_from': OPERATIONS_FILTER.types['created'],
+                      'date_to': OPERATIONS_FILTER.types['created'], 'limit': 'bigint', 'offset': 'bigint'}
         if len(filters) > 0:
-            where_clause = []
-            for w in filters:
-                where_clause.append(generate_filter("o.{}".format(w['field']), w['value'], w['op']))
-            where = f"{where} AND " + " AND ".join(where_clause)
-        order_by = generate_order_by(sort_by, sort_order, table_pre='o')
-        sql = ''' SELECT o.id, o.created, o.operation_type, o.amount, o.owner_balance_id, o.more_balance_id
-                  FROM operations o {where} {order_by} LIMIT :limit OFFSET :offset'''.format(where=where,
-                                                                                                  order_by=order_by
-                                                                                                  )
-        sql_count = ''' SELECT count(o.id) as count_r FROM public.operations o {where}'''.format(where=where)
-        count_rows = pg.execute(sql_count).first()[0]
-        return_data = {'items': [], 'totalCount': 0}
-        if count_rows:
-            db_rows = pg.execute(sql, {'limit': limit, 'offset': offset})
-            return_data = {'items': [dict(row)for row in db_rows], 'totalCount': count_rows}
+            filter_sql, filter_params = OPERATIONS_FILTER.compile(filters)
+            where = f"{where} AND {filter_sql}"
+            where_params.update(filter_params)
+            bind_types.update(OPERATIONS_FILTER.bind_types(filter_params))
+        if date_from is not None:
+            where = f"{where} AND o.created >= :date_from"
+            where_params['date_from'] = date_from
+        if date_to is not None:
+            where = f"{where} AND o.created < :date_to"
+            where_params['date_to'] = date_to
+        # totalCount is the whole filtered set: the keyset condition below is not part of it
+        count_where = where
+        sql_count = ''' SELECT count(o.id) as count_r FROM public.operations o {where}'''.format(where=count_where)
+        params = {'limit': limit, 'offset': offset, **where_params}
+        paging = 'LIMIT :limit OFFSET :offset'
+        if cursor is None:
+            order_by = generate_order_by(sort_by, sort_order, table_pre='o', allowed=OPERATIONS_FILTER.types)
+        else:
+            keyset_fields, keyset_order = get_keyset_fields(sort_by, sort_order, allowed=OPERATIONS_CURSOR_SORT)
+            order_by = generate_order_by(keyset_fields, [keyset_order] * len(keyset_fields), table_pre='o')
+            if cursor:
+                keyset, keyset_params = generate_keyset(keyset_fields, keyset_order,
+                                                        decode_cursor(cursor, keyset_fields, keyset_order),
+                                                        table_pre='o', types=OPERATIONS_FILTER.types)
+                where = f"{where} AND {keyset}"
+                params.update(keyset_params)
+                bind_types.update(dict.fromkeys(keyset_params, 'text'))
+            # one extra row tells whether there is a next page
+            params['limit'] = limit + 1
+            paging = 'LIMIT :limit'
+        # operation_type as text: a prepared statement must keep its result types
+        sql = ''' SELECT o.id, o.created, CAST(o.operation_type AS text) AS operation_type, o.amount,
+                         o.owner_balance_id, o.more_balance_id
+                  FROM operations o {where} {order_by} {paging}'''.format(where=where,
+                                                                          order_by=order_by,
+                                                                          paging=paging
+                                                                          )
+        if not filters and date_from is None and date_to is None:
+            count_rows = db_balance.operations_count
+        elif count == CountMode.estimate:
+            # the plan of the rows themselves: an Aggregate on top is always estimated at 1 row
+            plan = pg.execute(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM public.operations o {count_where}", where_params).scalar()
+            count_rows = int(plan[0]['Plan']['Plan Rows'])
+        elif count == CountMode.none:
+            count_rows = None
+        else:
+            count_rows = OPERATIONS_COUNT.get(sql_count, bind_types).execute(pg, **where_params).first()[0]
+        return_data = {'items': [], 'totalCount': count_rows, 'next_cursor': None}
+        if count_rows is None or count_rows:
+            result = OPERATIONS_LIST.get(sql, bind_types).execute(pg, **params)
+            items = rows_to_dicts(result.keys(), result)
+            return_data['items'] = items[:limit]
+            if cursor is not None and len(items) > limit:
+                return_data['next_cursor'] = encode_cursor(keyset_fields, keyset_order,
+                                                           [items[limit - 1][f] for f in keyset_fields])
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
-    return return_data
+    # rows go straight to orjson, response_model only documents the shape
+    return ORJSONResponse(return_data)
+
+
+EXPORT_COLUMNS = ('id', 'created', 'operation_type', 'amount', 'owner_balance_id', 'more_balance_id')
+
+
+@router.get("/operations/{balance_id}/export", name="operations:export")
+def export_operations(*,
+                      balance_id: int,
+                      format: ExportFormat = Query(ExportFormat.ndjson),
+                      date_from: datetime = Query(None, alias='from'),
+                      date_to: datetime = Query(None, alias='to'),
+                      pg: Session = Depends(get_db)
+                      ):
+    """Выгрузка всех операций кошелька потоком, без постраничной выборки и подсчета
+
+    Args:
+        balance_id: операции по балансу
+        format: ndjson - строка JSON на операцию, csv - CSV с заголовком
+        date_from: операции начиная с момента (включительно), ?from=
+        date_to: операции до момента (не включительно), ?to=
+        pg: сессия к БД postgres, открыта до конца выгрузки
+
+    Returns:
+        StreamingResponse
+    """
+    if not pg.query(Balance.id).filter(Balance.id == balance_id).first():
+        raise HTTPException(status_code=400, detail=f"Not found balance id: {balance_id}")
+    where = "WHERE o.owner_balance_id = :balance_id"
+    params = {'balance_id': balance_id}
+    if date_from is not None:
+        where = f"{where} AND o.created >= :date_from"
+        params['date_from'] = date_from
+    if date_to is not None:
+        where = f"{where} AND o.created < :date_to"
+        params['date_to'] = date_to
+    sql = f''' SELECT {", ".join(f"o.{c}" for c in EXPORT_COLUMNS)}
+               FROM operations o {where} ORDER BY o.created, o.id'''
+    chunks = stream_rows(pg, sql, params, settings.EXPORT_CHUNK_SIZE)
+    content = iter_csv(chunks, EXPORT_COLUMNS) if format == ExportFormat.csv else iter_ndjson(chunks, EXPORT_COLUMNS)
+    return StreamingResponse(content, media_type=MEDIA_TYPES[format], headers={
+        'Content-Disposition': f'attachment; filename="operations_{balance_id}.{format.value}"'
+    })
 
 
 @router.put("/{balance_id}", response_model=AddBalanceResponceShema, name="balances:adding")
-async def adding_money(*, balance_id: int, data: AddBalanceSchema, pg: Session = Depends(get_db)):
+def adding_money(*, balance_id: int, data: AddBalanceSchema,
+                 idempotency_key: Optional[str] = Header(None, max_length=255),
+                 pg: Session = Depends(get_db)):
     """Зачисление денежных средств на кошелек клиента
 
     Args:
         balance_id: баланс на который зачислить средства
         data: данные о кол-ве зачисляемых средств
+        idempotency_key: заголовок Idempotency-Key, повтор с тем же ключом отдает первый ответ
         pg: сессия к БД postgres
 
     Returns:
         BalanceSchema
     """
-    db_balance = pg.query(Balance).join(User).filter(Balance.id == balance_id).first()
+    if data.amount <= 0:
+        raise HTTPException(status_code=400, detail=f"Amount must be positive: {data.amount}")
+    fingerprint = get_fingerprint('balances:adding_money', balance_id, data.dict())
+    replay = get_replay(pg, idempotency_key, fingerprint)
+    if replay is not None:
+        return replay
+
+    db_balance = Balance.select(pg, balance_id)
     if not db_balance:
         raise HTTPException(status_code=400, detail=f"Not found balance id: {balance_id}")
 
-    # patch
-    if db_balance:
-        pg.begin(subtransactions=True)
+    username, currency = db_balance.username, db_balance.currency
+    amount = Decimal(str(data.amount))
+    if coalescer.enabled() and not idempotency_key:
+        pg.commit()  # ends the read transaction, the connection goes back to the pool while we wait
         try:
-            system_balance = Balance.get_system_balance(pg)
-            operation_from=Operations(amount=data.amount, operation_type=Operations.OperationsType.DEBIT,
-                                      owner_balance=system_balance, more_balance=db_balance, created=datetime.now())
-            pg.add(operation_from)
-            operation_in=Operations(amount=data.amount, operation_type=Operations.OperationsType.CREDIT,
-                                    owner_balance=db_balance, more_balance=system_balance, created=datetime.now())
-            pg.add(operation_in)
-            pg.commit()  # transaction is committed here
-            # pg.flush()
-            if not system_balance.check_operation(db_balance, pg) or not db_balance.check_operation(system_balance, pg):
-                raise ValueError('Error when checking operations')
+            error, total = coalescer.submit(None, balance_id, amount)
+        except coalescer.CoalesceTimeout as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except coalescer.CoalesceOutcomeUnknown as e:
+            raise HTTPException(status_code=504, detail=str(e))
         except Exception as e:
-            pg.rollback() # rolls back the transaction
             raise HTTPException(status_code=400, detail=str(e))
-        
-        system_balance.set_amount(pg)
-        db_balance.set_amount(pg)
-        pg.add(system_balance)
-        pg.add(db_balance)
-        pg.commit()
-
-        pg.refresh(system_balance)
-        pg.refresh(db_balance)
-    return AddBalanceResponceShema(
-            id=db_balance.id,
-            username=db_balance.user.username,
-            total=db_balance.amount,
-            added=data.amount,
-            currency=db_balance.currency.name
+        if error:
+            raise HTTPException(status_code=400, detail=error)
+        return AddBalanceResponceShema(id=balance_id, username=username, total=total,
+                                       added=data.amount, currency=currency)
+
+    def _deposit():
+        if not claim_key(pg, idempotency_key, fingerprint):
+            return None
+        if settings.LEDGER_PROCEDURE:
+            _, total = call_transfer(pg, system_balance_id, balance_id, amount, check_funds=False)
+        else:
+            lock_balances(pg, [system_balance_id, balance_id])
+            Operations.add_transfer(pg, system_balance_id, balance_id, amount)
+            total = Balance.change_amounts(pg, [(system_balance_id, -amount), (balance_id, amount)])[balance_id]
+        response = AddBalanceResponceShema(
+                id=balance_id,
+                username=username,
+                total=total,
+                added=data.amount,
+                currency=currency
+            ).dict()
+        save_response(pg, idempotency_key, response)
+        return response
+
+    try:
+        system_balance_id = Balance.get_system_balance(pg, key=balance_id).id
+        # operations, balances and the idempotency key are committed together
+        response = run_in_transaction(pg, _deposit)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if response is None:
+        # the same key was committed by a concurrent request while we were waiting on it
+        return get_replay(pg, idempotency_key, fingerprint)
+    remember(idempotency_key, fingerprint, response)
+    return response
+
+
+@router.post("/deposits:batch", response_model=BatchDepositResponceShema, name="balances:deposits_batch")
+def adding_money_batch(*, data: BatchDepositSchema, pg: Session = Depends(get_db)):
+    """Зачисление денежных средств на много кошельков одной пачкой (например зарплата)
+
+    Операции вставляются многострочными INSERT (большие пачки - через COPY),
+    остаток каждого кошелька и системного кошелька меняется один раз за пачку.
+
+    Args:
+        data: зачисления; partial=true - записать прошедшие проверку зачисления,
+              иначе при любой ошибке пачка отклоняется целиком
+        pg: сессия к БД postgres
+
+    Returns:
+        BatchDepositResponceShema
+    """
+    if len(data.items) > settings.BATCH_DEPOSIT_MAX_ITEMS:
+        raise HTTPException(status_code=400,
+                            detail=f"Too many deposits in the batch, max: {settings.BATCH_DEPOSIT_MAX_ITEMS}")
+    deposits = [(item.balance_id, Decimal(str(item.amount))) for item in data.items]
+    try:
+        system_balance_id = Balance.get_system_balance(pg).id
+        errors = run_in_transaction(pg, lambda: apply_deposits(pg, system_balance_id, deposits, partial=data.partial))
+    except LedgerError as e:
+        raise HTTPException(status_code=400,
+                            detail=[{'index': i, 'detail': error} for i, error in enumerate(e.errors) if error])
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return BatchDepositResponceShema(
+            items=[BatchDepositItemResponceShema(
+                balance_id=balance_id,
+                amount=amount,
+                status='error' if error else 'ok',
+                detail=error
+            ) for (balance_id, amount), error in zip(deposits, errors)],
+            applied=errors.count(None),
+            added=sum(amount for (_, amount), error in zip(deposits, errors) if error is None),
+            currency=Сurrency.USD.name
         )
 
 
 @router.put("/transfer/{balance_id}", response_model=TransferBalanceResponceShema, name="balances:transfer")
-async def transfer_money(*, balance_id: int, data: TransferBalanceSchema, pg: Session = Depends(get_db)):
+def transfer_money(*, balance_id: int, data: TransferBalanceSchema,
+                   idempotency_key: Optional[str] = Header(None, max_length=255),
+                   pg: Session = Depends(get_db)):
     """Перевод денежных средств с одного кошелька на другой
 
     Args:
         balance_id: баланс c которого списываем средства
         data: данные о перечислении
+        idempotency_key: заголовок Idempotency-Key, повтор с тем же ключом отдает первый ответ
         pg: сессия к БД postgres
 
     Returns:
         TransferBalanceSchema
     """
-    db_balance = pg.query(Balance).join(User).filter(Balance.id == balance_id).first()
-    if not db_balance:
-        raise HTTPException(status_code=400, detail=f"Not found balance id: {balance_id}")
-    if db_balance.amount < data.amount:
-        raise HTTPException(status_code=400, detail=f"Insufficient funds on the balance: {balance_id}")
-    db_to_balance = pg.query(Balance).filter(Balance.id == data.to_balance).first()
-    if not db_to_balance:
-        raise HTTPException(status_code=400, detail=f"Not found recipient's balance id: {data.to_balance}")
-
-    # patch
-    if db_balance:
-        pg.begin(subtransactions=True)
+    if data.amount <= 0:
+        raise HTTPException(status_code=400, detail=f"Amount must be positive: {data.amount}")
+    fingerprint = get_fingerprint('balances:transfer_money', balance_id, data.dict())
+    replay = get_replay(pg, idempotency_key, fingerprint)
+    if replay is not None:
+        return replay
+
+    if not settings.LEDGER_PROCEDURE:
+        # ledger_transfer does these checks itself, under the row locks
+        db_balance = Balance.select(pg, balance_id)
+        if not db_balance:
+            raise HTTPException(status_code=400, detail=f"Not found balance id: {balance_id}")
+        if db_balance.amount < data.amount:
+            raise HTTPException(status_code=400, detail=f"Insufficient funds on the balance: {balance_id}")
+        db_to_balance = Balance.select(pg, data.to_balance)
+        if not db_to_balance:
+            raise HTTPException(status_code=400, detail=f"Not found recipient's balance id: {data.to_balance}")
+
+    amount = Decimal(str(data.amount))
+    response = TransferBalanceResponceShema(
+            id=balance_id,
+            recipient_balance=data.to_balance,
+            amount=data.amount,
+            currency=Сurrency.USD.name
+        ).dict()
+    if coalescer.enabled() and not idempotency_key:
+        pg.commit()  # ends the read transaction, the connection goes back to the pool while we wait
         try:
-            operation_from=Operations(amount=data.amount, operation_type=Operations.OperationsType.DEBIT,
-                                      owner_balance=db_balance, more_balance=db_to_balance, created=datetime.now())
-            pg.add(operation_from)
-            operation_in=Operations(amount=data.amount, operation_type=Operations.OperationsType.CREDIT,
-                                    owner_balance=db_to_balance, more_balance=db_balance, created=datetime.now())
-            pg.add(operation_in)
-            pg.commit()  # transaction is committed here
-            # pg.flush()
-            if not db_to_balance.check_operation(db_balance, pg) or not db_balance.check_operation(db_to_balance, pg):
-                raise ValueError('Error when checking operations')
+            error, _ = coalescer.submit(balance_id, data.to_balance, amount)
+        except coalescer.CoalesceTimeout as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except coalescer.CoalesceOutcomeUnknown as e:
+            raise HTTPException(status_code=504, detail=str(e))
         except Exception as e:
-            pg.rollback() # rolls back the transaction
             raise HTTPException(status_code=400, detail=str(e))
-        
-        db_to_balance.set_amount(pg)
-        db_balance.set_amount(pg)
-        pg.add(db_to_balance)
-        pg.add(db_balance)
-        pg.commit()
-
-        pg.refresh(db_to_balance)
-        pg.refresh(db_balance)
-    return TransferBalanceResponceShema(
-            id=db_balance.id,
-            recipient_balance=db_to_balance.id,
-            amount=data.amount,
-            currency=db_balance.currency.name
+        if error:
+            raise HTTPException(status_code=400, detail=error)
+        return response
+
+    def _transfer():
+        if not claim_key(pg, idempotency_key, fingerprint):
+            return False
+        if settings.LEDGER_PROCEDURE:
+            call_transfer(pg, balance_id, data.to_balance, amount)
+        else:
+            # both wallets in ascending id order, so opposite transfers cannot deadlock
+            amounts = lock_balances(pg, [balance_id, data.to_balance])
+            if amounts.get(balance_id, 0) < amount:
+                raise HTTPException(status_code=400, detail=f"Insufficient funds on the balance: {balance_id}")
+            Operations.add_transfer(pg, balance_id, data.to_balance, amount)
+            Balance.change_amounts(pg, [(balance_id, -amount), (data.to_balance, amount)])
+        save_response(pg, idempotency_key, response)
+        return True
+
+    try:
+        # operations, balances and the idempotency key are committed together
+        claimed = run_in_transaction(pg, _transfer)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if not claimed:
+        # the same key was committed by a concurrent request while we were waiting on it
+        return get_replay(pg, idempotency_key, fingerprint)
+    remember(idempotency_key, fingerprint, response)
+    return response
+
+
+@router.post("/transfers:batch", response_model=BatchTransferResponceShema, name="balances:transfers_batch")
+def transfer_money_batch(*, data: BatchTransferSchema, pg: Session = Depends(get_db)):
+    """Пачка переводов в одной транзакции
+
+    Кошельки блокируются в порядке возрастания id, операции вставляются
+    многострочными INSERT, остаток каждого кошелька меняется один раз.
+
+    Args:
+        data: переводы; partial=true - записать прошедшие проверку переводы,
+              иначе при любой ошибке пачка отклоняется целиком
+        pg: сессия к БД postgres
+
+    Returns:
+        BatchTransferResponceShema
+    """
+    if len(data.items) > settings.BATCH_TRANSFER_MAX_ITEMS:
+        raise HTTPException(status_code=400,
+                            detail=f"Too many transfers in the batch, max: {settings.BATCH_TRANSFER_MAX_ITEMS}")
+    transfers = [(item.from_balance, item.to_balance, Decimal(str(item.amount))) for item in data.items]
+    try:
+        errors = run_in_transaction(pg, lambda: apply_transfers(pg, transfers, partial=data.partial))
+    except LedgerError as e:
+        raise HTTPException(status_code=400,
+                            detail=[{'index': i, 'detail': error} for i, error in enumerate(e.errors) if error])
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return BatchTransferResponceShema(
+            items=[BatchTransferItemResponceShema(
+                from_balance=from_id,
+                to_balance=to_id,
+                amount=amount,
+                status='error' if error else 'ok',
+                detail=error
+            ) for (from_id, to_id, amount), error in zip(transfers, errors)],
+            applied=errors.count(None),
+            currency=Сurrency.USD.name
         )
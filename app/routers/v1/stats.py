@@ -0,0 +1,41 @@
+import os
+
+from fastapi import APIRouter
+
+from app.connects.postgres.pool import get_pool_stats
+from app.connects.postgres.session import engine
+from app.schemas import PoolStatsSchema, RetryStatsSchema, PreparedStatsSchema
+from app.utils import prepared, retry
+
+
+router = APIRouter()
+
+
+@router.get("/pool", response_model=PoolStatsSchema, name="stats:pool")
+def pool_stats():
+    """Статистика пула соединений к БД текущего процесса
+
+    Returns:
+        PoolStatsSchema
+    """
+    return get_pool_stats(engine.pool)
+
+
+@router.get("/retries", response_model=RetryStatsSchema, name="stats:retries")
+def retry_stats():
+    """Повторы транзакций записи текущего процесса (конфликты сериализации и взаимоблокировки)
+
+    Returns:
+        RetryStatsSchema
+    """
+    return {'pid': os.getpid(), **retry.stats.as_dict()}
+
+
+@router.get("/prepared", response_model=PreparedStatsSchema, name="stats:prepared")
+def prepared_stats():
+    """Prepared statements текущего процесса: hits - выполнения готового запроса, misses - PREPARE на соединении
+
+    Returns:
+        PreparedStatsSchema
+    """
+    return {'pid': os.getpid(), **prepared.stats.as_dict()}
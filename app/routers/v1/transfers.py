@@ -0,0 +1,77 @@
+from decimal import Decimal
+
+from fastapi import Depends, APIRouter, HTTPException
+
+from sqlalchemy.orm import Session
+
+from app.connects.postgres.utils import get_db
+from app.schemas import (
+    AsyncTransferSchema,
+    AsyncTransferResponceShema
+)
+from app.models.balance import Balance
+from app.models.transfer import PendingTransfer
+
+
+router = APIRouter()
+
+
+def to_schema(db_transfer: PendingTransfer) -> AsyncTransferResponceShema:
+    return AsyncTransferResponceShema(
+            id=db_transfer.id,
+            from_balance=db_transfer.from_balance_id,
+            to_balance=db_transfer.to_balance_id,
+            amount=db_transfer.amount,
+            status=db_transfer.status.name,
+            detail=db_transfer.detail,
+            created=db_transfer.created,
+            processed=db_transfer.processed
+        )
+
+
+@router.post("/async", response_model=AsyncTransferResponceShema, status_code=202, name="transfers:async")
+def transfer_money_async(*, data: AsyncTransferSchema, pg: Session = Depends(get_db)):
+    """Прием перевода без ожидания записи в журнал
+
+    Перевод сохраняется в pending_transfers и записывается воркером
+    (app/commands/transfer_worker.py), результат - GET /v1/transfers/{transfer_id}.
+    Остаток отправителя проверяется воркером в момент записи.
+
+    Args:
+        data: данные о перечислении
+        pg: сессия к БД postgres
+
+    Returns:
+        AsyncTransferResponceShema
+    """
+    if data.amount <= 0:
+        raise HTTPException(status_code=400, detail=f"Amount must be positive: {data.amount}")
+    found = {balance_id for balance_id, in pg.query(Balance.id).filter(
+        Balance.id.in_([data.from_balance, data.to_balance]))}
+    if data.from_balance not in found:
+        raise HTTPException(status_code=400, detail=f"Not found balance id: {data.from_balance}")
+    if data.to_balance not in found:
+        raise HTTPException(status_code=400, detail=f"Not found recipient's balance id: {data.to_balance}")
+
+    db_transfer = PendingTransfer(from_balance_id=data.from_balance, to_balance_id=data.to_balance,
+                                  amount=Decimal(str(data.amount)))
+    pg.add(db_transfer)
+    pg.commit()
+    return to_schema(db_transfer)
+
+
+@router.get("/{transfer_id}", response_model=AsyncTransferResponceShema, name="transfers:details")
+def get_transfer(*, transfer_id: int, pg: Session = Depends(get_db)):
+    """Статус асинхронного перевода
+
+    Args:
+        transfer_id: id перевода
+        pg: сессия к БД postgres
+
+    Returns:
+        AsyncTransferResponceShema
+    """
+    db_transfer = pg.query(PendingTransfer).filter(PendingTransfer.id == transfer_id).first()
+    if not db_transfer:
+        raise HTTPException(status_code=400, detail=f"Not found transfer id: {transfer_id}")
+    return to_schema(db_transfer)
@@ -1,2 +1,4 @@
 from .balance import *
-from .auth import *
\ No newline at end of file
+from .auth import *
+from .stats import *
+from .transfer import *
\ No newline at end of file
@@ -1,3 +1,5 @@
+from typing import List
+
 from pydantic import BaseModel
 
 
@@ -6,3 +8,27 @@ class CreateBalanceSchema(BaseModel):
     Model for balance create
     """
     username: str
+
+
+class BulkCreateBalanceSchema(BaseModel):
+    """
+    Model for bulk balance create
+    """
+    usernames: List[str]
+
+
+class BulkCreateBalanceItemResponceShema(BaseModel):
+    """
+    Model for one item of bulk balance create
+    """
+    username: str
+    id: int
+    created: bool
+
+
+class BulkCreateBalanceResponceShema(BaseModel):
+    """
+    Model for bulk balance create response, items are in the order of usernames
+    """
+    items: List[BulkCreateBalanceItemResponceShema]
+    created: int
@@ -14,6 +14,14 @@ class BalanceSchema(BaseModel):
     amount: condecimal(max_digits=12, decimal_places=2)
     currency: str
 
+class SystemBalanceSchema(BaseModel):
+    """
+    Model for system balances total
+    """
+    amount: condecimal(max_digits=12, decimal_places=2)
+    shards: int
+    currency: str
+
 class AddBalanceSchema(BaseModel):
     """
     Model for adding balance
@@ -31,6 +39,39 @@ class AddBalanceResponceShema(BaseModel):
     currency: str
 
 
+class BatchDepositItemSchema(BaseModel):
+    """
+    Model for one deposit of a batch
+    """
+    balance_id: int
+    amount: float
+
+class BatchDepositSchema(BaseModel):
+    """
+    Model for batch of deposits
+    """
+    items: List[BatchDepositItemSchema]
+    partial: bool = False
+
+class BatchDepositItemResponceShema(BaseModel):
+    """
+    Responce for one deposit of a batch
+    """
+    balance_id: int
+    amount: condecimal(max_digits=12, decimal_places=2)
+    status: str
+    detail: Optional[str] = None
+
+class BatchDepositResponceShema(BaseModel):
+    """
+    Responce for batch of deposits
+    """
+    items: List[BatchDepositItemResponceShema]
+    applied: int
+    added: condecimal(max_digits=14, decimal_places=2)
+    currency: str
+
+
 class TransferBalanceSchema(BaseModel):
     """
     Model for money transfer
@@ -47,11 +88,50 @@ class TransferBalanceResponceShema(BaseModel):
     amount: condecimal(max_digits=12, decimal_places=2)
     currency: str
 
+class BatchTransferItemSchema(BaseModel):
+    """
+    Model for one transfer of a batch
+    """
+    from_balance: int
+    to_balance: int
+    amount: float
+
+class BatchTransferSchema(BaseModel):
+    """
+    Model for batch of transfers
+    """
+    items: List[BatchTransferItemSchema]
+    partial: bool = False
+
+class BatchTransferItemResponceShema(BaseModel):
+    """
+    Responce for one transfer of a batch
+    """
+    from_balance: int
+    to_balance: int
+    amount: condecimal(max_digits=12, decimal_places=2)
+    status: str
+    detail: Optional[str] = None
+
+class BatchTransferResponceShema(BaseModel):
+    """
+    Responce for batch of transfers
+    """
+    items: List[BatchTransferItemResponceShema]
+    applied: int
+    currency: str
+
 class OperationsTypeType(str, Enum):
     """типы операций """
     DEBIT = "DEBIT"
     CREDIT = "CREDIT"
 
+class CountMode(str, Enum):
+    """способ подсчета totalCount"""
+    exact = "exact"
+    estimate = "estimate"
+    none = "none"
+
 class OperationShema(BaseModel):
     """Схема для одной операции"""
     id: int
@@ -64,4 +144,5 @@ class OperationShema(BaseModel):
 class OperationsListSchema(BaseModel):
     """Схема ответа список операций пльзователя"""
     items: List[OperationShema] = None
-    totalCount: int = 0
+    totalCount: Optional[int] = 0
+    next_cursor: Optional[str] = None
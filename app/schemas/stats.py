@@ -0,0 +1,41 @@
+from typing import Dict
+
+from pydantic import BaseModel
+
+
+class PoolStatsSchema(BaseModel):
+    """
+    Model for connection pool stats of the worker process
+    """
+    pid: int
+    size: int
+    max_overflow: int
+    timeout: float
+    checked_in: int
+    checked_out: int
+    overflow: int
+    checkouts: int
+    checkout_timeouts: int
+    wait_avg_ms: float
+    wait_max_ms: float
+
+
+class RetryStatsSchema(BaseModel):
+    """
+    Model for transaction retry counters of the worker process
+    """
+    pid: int
+    transactions: int
+    retries: Dict[str, int]
+    exhausted: int
+
+
+class PreparedStatsSchema(BaseModel):
+    """
+    Model for prepared statement counters of the worker process
+    """
+    pid: int
+    enabled: bool
+    hits: int
+    misses: int
+    statements: Dict[str, Dict[str, int]]
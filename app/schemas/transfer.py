@@ -0,0 +1,32 @@
+from datetime import datetime
+from typing import Optional
+from enum import Enum
+from pydantic import BaseModel, condecimal
+
+
+class AsyncTransferSchema(BaseModel):
+    """
+    Model for asynchronous money transfer
+    """
+    from_balance: int
+    to_balance: int
+    amount: float
+
+class TransferStatus(str, Enum):
+    """статусы асинхронного перевода"""
+    PENDING = "PENDING"
+    DONE = "DONE"
+    FAILED = "FAILED"
+
+class AsyncTransferResponceShema(BaseModel):
+    """
+    Responce for asynchronous money transfer
+    """
+    id: int
+    from_balance: int
+    to_balance: int
+    amount: condecimal(max_digits=12, decimal_places=2)
+    status: TransferStatus
+    detail: Optional[str] = None
+    created: datetime
+    processed: Optional[datetime] = None
@@ -5,7 +5,66 @@ from urllib.parse import urlparse
 load_dotenv()
 POSTGRES_CONNECT: str = urlparse(os.environ.get('POSTGRES_CONNECT_URL', '//test_user:password@db:5432/test_db'))
 
+# пул соединений к БД на процесс: постоянные соединения, сверх них временные, пересоздание через N секунд
+# (-1 - без пересоздания), проверка соединения запросом при каждой выдаче, ожидание свободного соединения
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", -1))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+
 DEBUG = os.getenv("DEBUG", True)
 API_PREFIX = '/v1'
 PROJECT_NAME = 'web-api'
 VERSION = '0.1'
+
+# кол-во системных кошельков, с которых списываются зачисления, и способ выбора кошелька (hash | round_robin)
+SYSTEM_BALANCE_SHARDS = int(os.getenv("SYSTEM_BALANCE_SHARDS", 1))
+SYSTEM_BALANCE_STRATEGY = os.getenv("SYSTEM_BALANCE_STRATEGY", "hash")
+
+# максимальное кол-во переводов в POST /v1/balances/transfers:batch и зачислений в POST /v1/balances/deposits:batch
+BATCH_TRANSFER_MAX_ITEMS = int(os.getenv("BATCH_TRANSFER_MAX_ITEMS", 10000))
+BATCH_DEPOSIT_MAX_ITEMS = int(os.getenv("BATCH_DEPOSIT_MAX_ITEMS", 100000))
+# максимальное кол-во логинов в POST /v1/auth/bulk и кол-во логинов в одном запросе к БД
+AUTH_BULK_MAX_ITEMS = int(os.getenv("AUTH_BULK_MAX_ITEMS", 100000))
+AUTH_BULK_CHUNK_SIZE = int(os.getenv("AUTH_BULK_CHUNK_SIZE", 5000))
+# с какого кол-ва строк операции пачки вставляются через COPY, а не многострочными INSERT
+LEDGER_COPY_THRESHOLD = int(os.getenv("LEDGER_COPY_THRESHOLD", 5000))
+
+# обработчики API синхронные (SQLAlchemy Session) и выполняются в пуле потоков,
+# размер пула - сколько запросов к БД одновременно обслуживает один процесс
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", 40))
+
+# сколько секунд хранится ключ Idempotency-Key, и сколько ответов по ключам держать в памяти процесса
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 24 * 60 * 60))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 10000))
+
+# кэш GET /v1/balances/{balance_id}: кол-во кошельков в памяти процесса (0 - без кэша), время жизни записи
+# и канал, которым процессы сообщают друг другу об изменении остатков (postgres | memory)
+BALANCE_CACHE_SIZE = int(os.getenv("BALANCE_CACHE_SIZE", 10000))
+BALANCE_CACHE_TTL = float(os.getenv("BALANCE_CACHE_TTL", 30))
+BALANCE_CACHE_CHANNEL = os.getenv("BALANCE_CACHE_CHANNEL", "postgres")
+
+# повтор транзакций записи при конфликте сериализации (40001) и взаимоблокировке (40P01):
+# максимум попыток и границы случайной паузы между ними в секундах
+DB_RETRY_ATTEMPTS = int(os.getenv("DB_RETRY_ATTEMPTS", 5))
+DB_RETRY_BASE_DELAY = float(os.getenv("DB_RETRY_BASE_DELAY", 0.01))
+DB_RETRY_MAX_DELAY = float(os.getenv("DB_RETRY_MAX_DELAY", 0.5))
+
+# групповая запись одиночных переводов и зачислений: запросы без Idempotency-Key копятся
+# до LEDGER_COALESCE_MAX_ITEMS штук или LEDGER_COALESCE_MAX_DELAY_MS и пишутся одной транзакцией
+LEDGER_COALESCE = os.getenv("LEDGER_COALESCE", "false").lower() in ("1", "true", "yes")
+LEDGER_COALESCE_MAX_ITEMS = int(os.getenv("LEDGER_COALESCE_MAX_ITEMS", 500))
+LEDGER_COALESCE_MAX_DELAY_MS = float(os.getenv("LEDGER_COALESCE_MAX_DELAY_MS", 5))
+# сколько секунд запрос ждет commit своей группы
+LEDGER_COALESCE_TIMEOUT = float(os.getenv("LEDGER_COALESCE_TIMEOUT", 30))
+
+# одиночные переводы и зачисления одним вызовом функции БД ledger_transfer вместо ORM
+LEDGER_PROCEDURE = os.getenv("LEDGER_PROCEDURE", "false").lower() in ("1", "true", "yes")
+
+# сколько строк читает за раз серверный курсор выгрузки операций
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 1000))
+
+# частые запросы переводов (app/utils/prepared.py) через PREPARE/EXECUTE на соединение;
+# выключить за pgbouncer в режиме transaction, там соединение сервера меняется между транзакциями
+DB_PREPARED_STATEMENTS = os.getenv("DB_PREPARED_STATEMENTS", "true").lower() in ("1", "true", "yes")
@@ -46,4 +46,37 @@ class TestAuthApi():
         assert db_session.query(func.count(User.id)).scalar() == 2
         assert db_session.query(func.count(Balance.id)).scalar() == 2
 
+        # повтор отдает тот же кошелек и ничего не создает
+        response = client.post(url, json=post_date)
+        assert response.status_code == 200
+        assert response.json() == new_user
+        response = client.post(url, json={"username": "test_case"})
+        assert response.status_code == 200
+        assert response.json()['id'] == db_session.query(Balance.id).join(User).filter(User.username == 'test_case').scalar()
+        assert db_session.query(func.count(User.id)).scalar() == 2
+        assert db_session.query(func.count(Balance.id)).scalar() == 2
+
+        self._teardown(db_session)
+
+    def test_create_balances_bulk(self,
+                  db_session: Session,
+                  client: TestClient
+                  ):
+        """Создание клиентов с кошельками пачкой, ответ в порядке логинов"""
+        self._setup(db_session)
+        url = '/v1/auth/bulk'
+        response = client.post(url, json={"usernames": ["bulk_1", "test_case", "bulk_2", "bulk_1"]})
+        assert response.status_code == 200
+        data = response.json()
+        assert [(i['username'], i['created']) for i in data['items']] == [
+            ("bulk_1", True), ("test_case", False), ("bulk_2", True), ("bulk_1", False)
+        ]
+        assert data['created'] == 2
+        assert data['items'][0]['id'] == data['items'][3]['id']
+        assert data['items'][1]['id'] == db_session.query(Balance.id).join(User).filter(User.username == 'test_case').scalar()
+        assert db_session.query(func.count(Balance.id)).scalar() == 3
+
+        response = client.post(url, json={"usernames": ["bulk_2", "bulk_3"]})
+        assert [i['created'] for i in response.json()['items']] == [False, True]
+
         self._teardown(db_session)
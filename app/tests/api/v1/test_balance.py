@@ -1,11 +1,15 @@
 import json
+from decimal import Decimal
 
 from fastapi.testclient import TestClient
 from sqlalchemy.orm import Session
 
+from app import settings
 from app.models.auth import User
-from app.models.balance import Balance
+from app.models.balance import Balance, Operations
 from app.tests.api.test_case import TestCase
+from app.utils import balance_cache, prepared
+from app.utils.idempotency import clear_cache
 
 
 class TestBalanceApi(TestCase):
@@ -75,6 +79,109 @@ class TestBalanceApi(TestCase):
 
         self._teardown(db_session)
 
+    def test_adding_money_system_shards(self,
+                  db_session: Session,
+                  client: TestClient,
+                  monkeypatch
+                  ):
+        """Зачисление с нескольких системных кошельков"""
+        monkeypatch.setattr(settings, 'SYSTEM_BALANCE_SHARDS', 3)
+        monkeypatch.setattr(settings, 'SYSTEM_BALANCE_STRATEGY', 'round_robin')
+        self._setup(db_session)
+
+        db_balance = db_session.query(Balance).join(User).first()
+        for _ in range(3):
+            self.add_money(db_session, client, db_balance.id)
+
+        db_system_balances = db_session.query(Balance).join(User).filter(User.username.like('system_user%')).all()
+        assert sorted(b.amount for b in db_system_balances) == [-22, -22, -22]
+
+        response = client.get('/v1/balances/system')
+        assert response.status_code == 200
+        data_detail = response.json()
+        assert data_detail['amount'] == -66
+        assert data_detail['shards'] == 3
+
+        self._teardown(db_session)
+
+    def test_adding_money_idempotency_key(self,
+                  db_session: Session,
+                  client: TestClient
+                  ):
+        """Повтор зачисления с тем же Idempotency-Key не создает операций"""
+        self._setup(db_session)
+
+        db_balance = db_session.query(Balance).join(User).first()
+        balance_id = db_balance.id
+        url = f"/v1/balances/{balance_id}"
+        headers = {'Idempotency-Key': 'deposit-1'}
+        response = client.put(url, json={'amount': 22}, headers=headers)
+        assert response.status_code == 200
+        first = response.json()
+
+        replay = client.put(url, json={'amount': 22}, headers=headers)
+        assert replay.status_code == 200
+        assert replay.json() == first
+        clear_cache()  # ответ берется из idempotency_keys
+        replay = client.put(url, json={'amount': 22}, headers=headers)
+        assert replay.status_code == 200
+        assert replay.json() == first
+
+        assert db_session.query(Operations).filter(Operations.owner_balance_id == balance_id).count() == 1
+        db_session.refresh(db_balance)
+        assert db_balance.amount == 22
+
+        response = client.put(url, json={'amount': 10}, headers=headers)
+        assert response.status_code == 422
+
+        response = client.put(url, json={'amount': 10}, headers={'Idempotency-Key': 'deposit-2'})
+        assert response.status_code == 200
+        assert response.json()['total'] == 32
+
+        self._teardown(db_session)
+
+    def test_adding_money_batch(self,
+                  db_session: Session,
+                  client: TestClient,
+                  monkeypatch
+                  ):
+        """Зачисление на много кошельков одной пачкой"""
+        self._setup(db_session)
+        db_balance = db_session.query(Balance).first()
+        db_user = User(username='recipient_user', is_active=True)
+        db_session.add(db_user)
+        db_recipient_balance = Balance(user=db_user)
+        db_session.add(db_recipient_balance)
+        db_session.commit()
+        balance_ids = [db_balance.id, db_recipient_balance.id]
+
+        url = "/v1/balances/deposits:batch"
+        for copy_threshold in (5000, 1):
+            monkeypatch.setattr(settings, 'LEDGER_COPY_THRESHOLD', copy_threshold)
+            post_date = {'partial': True, 'items': [
+                {'balance_id': balance_ids[0], 'amount': 22},
+                {'balance_id': balance_ids[1], 'amount': 10},
+                {'balance_id': 121212, 'amount': 1},
+            ]}
+            response = client.post(url, json=post_date)
+            assert response.status_code == 200
+            data_detail = response.json()
+            assert data_detail['applied'] == 2
+            assert data_detail['added'] == 32
+            assert [i['status'] for i in data_detail['items']] == ['ok', 'ok', 'error']
+            assert data_detail['items'][2]['detail'] == "Not found balance id: 121212"
+
+        amounts = {b.id: (b.amount, b.operations_count) for b in db_session.query(Balance)}
+        assert amounts[balance_ids[0]] == (44, 2)
+        assert amounts[balance_ids[1]] == (20, 2)
+        db_system_balance = db_session.query(Balance).join(User).filter(User.username=='system_user').first()
+        assert (db_system_balance.amount, db_system_balance.operations_count) == (-64, 4)
+
+        post_date['partial'] = False
+        response = client.post(url, json=post_date)
+        assert response.status_code == 400
+        assert response.json()['detail'] == [{'index': 2, 'detail': "Not found balance id: 121212"}]
+
     def test_adding_money_faild_balance(self,
                   db_session: Session,
                   client: TestClient
@@ -126,6 +233,79 @@ class TestBalanceApi(TestCase):
 
         self._teardown(db_session)
 
+    def test_transfer_money_idempotency_key(self,
+                    db_session: Session,
+                    client: TestClient
+                  ):
+        """Повтор перевода с тем же Idempotency-Key не создает операций"""
+        self._setup(db_session)
+        db_balance = db_session.query(Balance).first()
+        balance_id = db_balance.id
+        self.add_money(db_session, client, balance_id)
+
+        db_recipient_balance = Balance(user=User(username='recipient_user', is_active=True))
+        db_session.add(db_recipient_balance)
+        db_session.commit()
+        recipient_id = db_recipient_balance.id
+
+        url = f"/v1/balances/transfer/{balance_id}"
+        post_date = {'amount': 10, 'to_balance': recipient_id}
+        headers = {'Idempotency-Key': 'transfer-1'}
+        response = client.put(url, json=post_date, headers=headers)
+        assert response.status_code == 200
+        first = response.json()
+
+        # повтор после таймаута клиента
+        replay = client.put(url, json=post_date, headers=headers)
+        assert replay.status_code == 200
+        assert replay.json() == first
+        clear_cache()  # ответ берется из idempotency_keys
+        replay = client.put(url, json=post_date, headers=headers)
+        assert replay.status_code == 200
+        assert replay.json() == first
+
+        assert db_session.query(Operations).filter(Operations.owner_balance_id == recipient_id).count() == 1
+        db_session.expire_all()
+        assert db_session.query(Balance).filter(Balance.id==balance_id).first().amount == 12
+        assert db_session.query(Balance).filter(Balance.id==recipient_id).first().amount == 10
+
+        response = client.put(url, json={'amount': 5, 'to_balance': recipient_id}, headers=headers)
+        assert response.status_code == 422
+
+        self._teardown(db_session)
+
+    def test_transfer_money_procedure(self,
+                    db_session: Session,
+                    client: TestClient,
+                    monkeypatch
+                  ):
+        """Зачисление и перевод через функцию БД ledger_transfer"""
+        monkeypatch.setattr(settings, 'LEDGER_PROCEDURE', True)
+        self._setup(db_session)
+        db_balance = db_session.query(Balance).first()
+        balance_id = db_balance.id
+        data_detail = self.add_money(db_session, client, balance_id)
+        assert data_detail['total'] == 22
+
+        db_recipient_balance = Balance(user=User(username='recipient_user', is_active=True))
+        db_session.add(db_recipient_balance)
+        db_session.commit()
+        recipient_id = db_recipient_balance.id
+
+        url = f"/v1/balances/transfer/{balance_id}"
+        response = client.put(url, json={'amount': 10, 'to_balance': recipient_id})
+        assert response.status_code == 200
+        assert response.json()['currency'] == "USD"
+        assert client.get(f"/v1/balances/{balance_id}").json()['amount'] == 12
+        assert client.get(f"/v1/balances/{recipient_id}").json()['amount'] == 10
+        data = client.get(f"/v1/balances/operations/{recipient_id}").json()
+        assert data['totalCount'] == 1
+        assert data['items'][0]['operation_type'] == 'CREDIT'
+
+        response = client.put(url, json={'amount': 100, 'to_balance': recipient_id})
+        assert response.status_code == 400
+        assert response.json()['detail'] == f"Insufficient funds on the balance: {balance_id}"
+
     def test_transfer_money_not_found_from_user(self,
                     db_session: Session,
                     client: TestClient
@@ -195,6 +375,35 @@ class TestBalanceApi(TestCase):
 
         self._teardown(db_session)
 
+    def test_not_positive_amount(self,
+                    db_session: Session,
+                    client: TestClient
+                  ):
+        """Зачисление и перевод нулевой или отрицательной суммы"""
+        self._setup(db_session)
+        db_balance = db_session.query(Balance).first()
+        data_detail = self.add_money(db_session, client, db_balance.id)
+        db_recipient_balance = Balance(user=User(username='recipient_user', is_active=True))
+        db_session.add(db_recipient_balance)
+        db_session.commit()
+        db_session.refresh(db_recipient_balance)
+
+        for amount in (0, -5):
+            response = client.put(f"/v1/balances/{db_balance.id}", json={'amount': amount})
+            assert response.status_code == 400
+            assert response.json()['detail'] == f"Amount must be positive: {float(amount)}"
+
+            url = f"/v1/balances/transfer/{db_balance.id}"
+            response = client.put(url, json={'amount': amount, 'to_balance': db_recipient_balance.id})
+            assert response.status_code == 400
+            assert response.json()['detail'] == f"Amount must be positive: {float(amount)}"
+
+        db_session.expire_all()
+        assert db_session.query(Balance).filter(Balance.id==db_balance.id).first().amount == 22
+        assert db_session.query(Balance).filter(Balance.id==db_recipient_balance.id).first().amount == 0
+
+        self._teardown(db_session)
+
 
     def test_detail(self,
                   db_session: Session,
@@ -217,6 +426,31 @@ class TestBalanceApi(TestCase):
 
         self._teardown(db_session)
 
+    def test_detail_cache(self,
+                  db_session: Session,
+                  client: TestClient
+                  ):
+        """Остаток отдается из кэша и сбрасывается после зачисления"""
+        self._setup(db_session)
+        db_balance = db_session.query(Balance).join(User).first()
+        balance_id = db_balance.id
+        url = f"/v1/balances/{balance_id}"
+        assert client.get(url).json()['amount'] == 0
+
+        # изменение в обход Balance.change_amount(s) кэш не сбрасывает
+        db_session.execute('UPDATE balances SET amount = 5 WHERE id = :id', {'id': balance_id})
+        db_session.commit()
+        assert client.get(url).json()['amount'] == 0
+        assert client.get(f"{url}?max_age=0").json()['amount'] == 5
+
+        invalidated = []
+        balance_cache._channel.listen(invalidated.append)
+        self.add_money(db_session, client, balance_id)
+        assert balance_id in invalidated[0]
+        assert client.get(url).json()['amount'] == 27
+
+        self._teardown(db_session)
+
     def test_detail_not_exist_balance(self,
                   db_session: Session,
                   client: TestClient
@@ -291,6 +525,35 @@ class TestBalanceApi(TestCase):
         assert balance2.id in [o['more_balance_id'] for o in data_list['items']]
 
 
+        for count, total_count in (('exact', 1), ('none', None)):
+            response = client.get(f'{url}?field=more_balance_id&value={db_system_balance.id}&op=!%3D&count={count}')
+            assert response.status_code == 200
+            data_list = response.json()
+            assert len(data_list['items']) == 1
+            assert data_list['totalCount'] == total_count
+        db_session.execute('ANALYZE operations')
+        response = client.get(f'{url}?field=amount&value=0&op=%3E&count=estimate')
+        assert response.status_code == 200
+        assert response.json()['totalCount'] == 2
+
+        response = client.get(f'{url}?field=more_balance_id&value={db_system_balance.id}|{balance2.id}&op=in')
+        assert response.json()['totalCount'] == 2
+        # та же форма с другими значениями - EXECUTE уже подготовленных запросов
+        misses = dict(prepared.stats.misses)
+        response = client.get(f'{url}?field=more_balance_id&value={balance2.id}&op=in')
+        assert response.json()['totalCount'] == 1
+        if settings.DB_PREPARED_STATEMENTS:
+            assert prepared.stats.misses['operations_list'] == misses['operations_list']
+            assert prepared.stats.misses['operations_count'] == misses['operations_count']
+        response = client.get(f'{url}?field=amount&value=0|100&op=between&field=operation_type&value=CRED%25&op=like')
+        assert response.status_code == 200, response.text
+        assert {o['operation_type'] for o in response.json()['items']} == {'CREDIT'}
+        response = client.get(f'{url}?field=owner_balance_id%20OR%201%3D1&value=1&op=%3D')
+        assert response.status_code == 400
+
+        db_session.refresh(balance1)
+        assert balance1.operations_count == 2
+
         response = client.get(f'{url}?sort_by=id&sort_order=asc')
         assert response.status_code == 200
         data_list = response.json()
@@ -301,3 +564,146 @@ class TestBalanceApi(TestCase):
         assert [3, 2] == [o['id'] for o in data_list['items']]
 
         self._teardown(db_session)
+
+
+    def test_operations_export(self,
+                  db_session: Session,
+                  client: TestClient,
+                  monkeypatch
+                  ):
+        """Потоковая выгрузка операций кошелька в NDJSON и CSV"""
+        monkeypatch.setattr(settings, 'EXPORT_CHUNK_SIZE', 2)
+        self._setup(db_session)
+        balance_id = db_session.query(Balance).join(User).first().id
+        for _ in range(5):
+            self.add_money(db_session, client, balance_id)
+
+        url = f"/v1/balances/operations/{balance_id}/export"
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'application/x-ndjson'
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert len(rows) == 5
+        assert [row['id'] for row in rows] == sorted(row['id'] for row in rows)
+        assert rows[0]['operation_type'] == 'CREDIT'
+        assert Decimal(rows[0]['amount']) == 22
+        assert rows[0]['owner_balance_id'] == balance_id
+
+        response = client.get(f"{url}?format=csv")
+        assert response.status_code == 200
+        assert response.headers['content-disposition'] == f'attachment; filename="operations_{balance_id}.csv"'
+        lines = response.text.splitlines()
+        assert lines[0] == 'id,created,operation_type,amount,owner_balance_id,more_balance_id'
+        assert len(lines) == 6
+
+        response = client.get(f"{url}?from=2100-01-01T00:00:00")
+        assert response.text == ''
+        assert client.get("/v1/balances/operations/-1/export").status_code == 400
+
+        self._teardown(db_session)
+
+    def test_operations_list_cursor(self,
+                  db_session: Session,
+                  client: TestClient
+                  ):
+        """список операций по курсору"""
+        self._setup(db_session)
+        balance1 = db_session.query(Balance).first()
+        for _ in range(3):
+            self.add_money(db_session, client, balance1.id)
+        db_ids = [o.id for o in db_session.query(Operations).filter(Operations.owner_balance_id == balance1.id)]
+
+        url = f"/v1/balances/operations/{balance1.id}"
+        for query, expected in (('', sorted(db_ids)),
+                                ('&sort_by=id&sort_order=desc', sorted(db_ids, reverse=True)),
+                                ('&sort_by=created&sort_order=asc', sorted(db_ids))):
+            response = client.get(f'{url}?limit=2&cursor={query}')
+            assert response.status_code == 200
+            data_list = response.json()
+            assert data_list['totalCount'] == 3
+            assert [o['id'] for o in data_list['items']] == expected[:2]
+
+            response = client.get(f"{url}?limit=2{query}", params={'cursor': data_list['next_cursor']})
+            assert response.status_code == 200
+            data_list = response.json()
+            assert [o['id'] for o in data_list['items']] == expected[2:]
+            assert data_list['next_cursor'] is None
+
+        # totalCount следующих страниц считается без условия курсора
+        db_session.execute('ANALYZE operations')
+        for count in ('estimate', 'exact'):
+            query = f'&field=amount&value=0&op=%3E&count={count}'
+            response = client.get(f'{url}?limit=2&cursor={query}')
+            next_cursor = response.json()['next_cursor']
+            response = client.get(f'{url}?limit=2{query}', params={'cursor': next_cursor})
+            assert response.status_code == 200, response.text
+            data_list = response.json()
+            assert data_list['totalCount'] == 3
+            assert [o['id'] for o in data_list['items']] == sorted(db_ids)[2:]
+
+        response = client.get(f"{url}?limit=2&cursor=&sort_by=id&sort_order=asc")
+        next_cursor = response.json()['next_cursor']
+        response = client.get(f"{url}?limit=2&sort_by=id&sort_order=desc", params={'cursor': next_cursor})
+        assert response.status_code == 400
+        assert response.json()['detail'] == 'cursor does not match sort_by/sort_order'
+
+        # поле сортировки подставляется в ORDER BY и ключ курсора, только из белого списка
+        for query in ('', '&cursor='):
+            response = client.get(f"{url}?limit=2&sort_by=username&sort_order=asc{query}")
+            assert response.status_code == 400
+            assert response.json()['detail'] == 'Bad sort field: username'
+        # more_balance_id может быть NULL: по курсору такие строки потерялись бы
+        response = client.get(f"{url}?limit=2&sort_by=more_balance_id&sort_order=asc")
+        assert response.status_code == 200
+        response = client.get(f"{url}?limit=2&sort_by=more_balance_id&sort_order=asc&cursor=")
+        assert response.status_code == 400
+        assert response.json()['detail'] == 'Bad sort field: more_balance_id'
+
+        self._teardown(db_session)
+
+
+    def test_transfer_money_batch(self,
+                  db_session: Session,
+                  client: TestClient
+                  ):
+        """Пачка переводов"""
+        self._setup(db_session)
+        db_balance = db_session.query(Balance).first()
+        self.add_money(db_session, client, db_balance.id)
+        recipients = []
+        for username in ('recipient_1', 'recipient_2'):
+            db_user = User(username=username, is_active=True)
+            db_session.add(db_user)
+            recipients.append(Balance(user=db_user))
+            db_session.add(recipients[-1])
+        db_session.commit()
+        r1, r2 = recipients[0].id, recipients[1].id
+
+        url = "/v1/balances/transfers:batch"
+        post_date = {'partial': True, 'items': [
+            {'from_balance': db_balance.id, 'to_balance': r1, 'amount': 10},
+            {'from_balance': r1, 'to_balance': r2, 'amount': 4},
+            {'from_balance': db_balance.id, 'to_balance': r2, 'amount': 100},
+            {'from_balance': db_balance.id, 'to_balance': 121212, 'amount': 1},
+        ]}
+        response = client.post(url, json=post_date)
+        assert response.status_code == 200
+        data_detail = response.json()
+        assert data_detail['applied'] == 2
+        assert [i['status'] for i in data_detail['items']] == ['ok', 'ok', 'error', 'error']
+        assert data_detail['items'][2]['detail'] == f"Insufficient funds on the balance: {db_balance.id}"
+        assert data_detail['items'][3]['detail'] == "Not found recipient's balance id: 121212"
+
+        amounts = {b.id: (b.amount, b.operations_count) for b in db_session.query(Balance)}
+        assert amounts[db_balance.id] == (12, 2)
+        assert amounts[r1] == (6, 2)
+        assert amounts[r2] == (4, 1)
+
+        balance_id = db_balance.id
+        post_date['partial'] = False
+        response = client.post(url, json=post_date)
+        assert response.status_code == 400
+        assert response.json()['detail'] == [
+            {'index': 2, 'detail': f"Insufficient funds on the balance: {balance_id}"},
+            {'index': 3, 'detail': "Not found recipient's balance id: 121212"},
+        ]
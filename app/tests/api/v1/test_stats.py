@@ -0,0 +1,30 @@
+from fastapi.testclient import TestClient
+
+from app import settings
+
+
+class TestStatsApi():
+
+    def test_pool_stats(self, client: TestClient):
+        """Статистика пула соединений процесса"""
+        response = client.get('/v1/stats/pool')
+        assert response.status_code == 200
+        data = response.json()
+        assert data['size'] == settings.DB_POOL_SIZE
+        assert data['max_overflow'] == settings.DB_MAX_OVERFLOW
+        assert data['checkout_timeouts'] == 0
+
+    def test_retry_stats(self, client: TestClient):
+        """Счётчики повторов транзакций процесса"""
+        response = client.get('/v1/stats/retries')
+        assert response.status_code == 200
+        data = response.json()
+        assert set(data['retries']) == {'serialization_failure', 'deadlock_detected'}
+
+    def test_prepared_stats(self, client: TestClient):
+        """Счётчики prepared statements процесса"""
+        response = client.get('/v1/stats/prepared')
+        assert response.status_code == 200
+        data = response.json()
+        assert 'balances_lock' in data['statements']
+        assert data['hits'] == sum(s['hits'] for s in data['statements'].values())
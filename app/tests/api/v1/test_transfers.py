@@ -0,0 +1,49 @@
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+
+from app.commands.transfer_worker import process_pending
+from app.models.auth import User
+from app.models.balance import Balance
+
+
+class TestTransfersApi():
+    def _create_balance(self, db_session: Session, username: str, amount: int = 0) -> int:
+        db_user = User(username=username, is_active=True)
+        db_session.add(db_user)
+        db_balance = Balance(user=db_user, amount=amount)
+        db_session.add(db_balance)
+        db_session.commit()
+        return db_balance.id
+
+    def test_transfer_money_async(self,
+                  db_session: Session,
+                  client: TestClient
+                  ):
+        """Асинхронный перевод: 202, запись воркером и статус"""
+        from_id = self._create_balance(db_session, 'async_from', 15)
+        to_id = self._create_balance(db_session, 'async_to')
+
+        response = client.post('/v1/transfers/async', json={'from_balance': from_id, 'to_balance': to_id, 'amount': 10})
+        assert response.status_code == 202
+        first = response.json()
+        assert first['status'] == 'PENDING'
+        response = client.post('/v1/transfers/async', json={'from_balance': from_id, 'to_balance': to_id, 'amount': 10})
+        second = response.json()
+
+        response = client.post('/v1/transfers/async', json={'from_balance': from_id, 'to_balance': -1, 'amount': 10})
+        assert response.status_code == 400
+        assert response.json()['detail'] == "Not found recipient's balance id: -1"
+
+        assert process_pending(db_session) == (1, 1)
+        assert process_pending(db_session) == (0, 0)
+
+        data = client.get(f"/v1/transfers/{first['id']}").json()
+        assert data['status'] == 'DONE'
+        assert data['processed'] is not None
+        data = client.get(f"/v1/transfers/{second['id']}").json()
+        assert data['status'] == 'FAILED'
+        assert data['detail'] == f"Insufficient funds on the balance: {from_id}"
+
+        assert client.get(f"/v1/balances/{from_id}").json()['amount'] == 5
+        assert client.get(f"/v1/balances/{to_id}").json()['amount'] == 10
+        assert client.get(f"/v1/balances/operations/{to_id}").json()['totalCount'] == 1
@@ -3,6 +3,9 @@ from typing import Any, Generator
 
 import pytest
 
+# кэш остатков в тестах рассылает инвалидации в памяти процесса
+os.environ.setdefault('BALANCE_CACHE_CHANNEL', 'memory')
+
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy_utils import database_exists, create_database
@@ -14,6 +17,8 @@ from fastapi import FastAPI
 from app.connects.postgres.base import DBBase
 from app.main import get_application
 from app.connects.postgres.utils import get_db
+from app.utils import balance_cache
+from app.utils.idempotency import clear_cache as clear_idempotency_cache
 
 
 SQLALCHEMY_DATABASE_URL = os.getenv('TEST_DATABASE_URL', "sqlite://")
@@ -35,6 +40,8 @@ def app() -> Generator[FastAPI, Any, None]:
     DBBase.metadata.create_all(engine)  # Create the tables.
     _app = get_application()
     yield _app
+    clear_idempotency_cache()
+    balance_cache.clear()
     DBBase.metadata.drop_all(engine)
 
 
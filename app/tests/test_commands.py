@@ -0,0 +1,165 @@
+"""
+test_commands.py
+====================================
+Тесты для папки app/commands/
+"""
+import io
+import csv
+
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+
+from datetime import date, datetime
+
+from app.commands.checkpoint_balances import create_snapshots
+from app.commands.onboard_users import onboard
+from app.commands.partitions import create_partitions, detach_partitions, get_partitions, month_start
+from app.commands.reconcile_operations import reconcile
+from app.commands.verify_balances import get_mismatches
+from app.models.auth import User
+from app.models.balance import Balance, BalanceSnapshot, LedgerWatermark, Operations
+
+
+def _create_balance(db_session: Session, username: str = 'test_case') -> Balance:
+    db_user = User(username=username, is_active=True)
+    db_session.add(db_user)
+    db_balance = Balance(user=db_user)
+    db_session.add(db_balance)
+    db_session.commit()
+    return db_balance
+
+
+class TestVerifyBalances:
+    """тесты для verify_balances.py"""
+    def test_get_mismatches(self,
+                  db_session: Session,
+                  client: TestClient
+                  ):
+        """сверка остатков с историей операций"""
+        db_balance = _create_balance(db_session)
+
+        response = client.put(f"/v1/balances/{db_balance.id}", json={'amount': 22})
+        assert response.status_code == 200
+        assert get_mismatches(db_session) == []
+
+        db_session.query(Balance).filter(Balance.id == db_balance.id).update({Balance.amount: 100})
+        mismatches = get_mismatches(db_session)
+        assert [(m[0], m[1], m[2]) for m in mismatches] == [(db_balance.id, 100, 22)]
+        assert db_balance.calculate_amount(db_session) == 22
+
+
+class TestCheckpointBalances:
+    """тесты для checkpoint_balances.py"""
+    def test_create_snapshots(self,
+                  db_session: Session,
+                  client: TestClient
+                  ):
+        """снимки остатков и остаток на момент времени"""
+        db_balance = _create_balance(db_session)
+        assert create_snapshots(db_session, lag=0) == 0
+
+        assert client.put(f"/v1/balances/{db_balance.id}", json={'amount': 22}).status_code == 200
+        # кошелек пользователя и системный кошелек
+        assert create_snapshots(db_session, lag=0) == 2
+        assert create_snapshots(db_session, lag=0) == 0
+        snapshot = db_balance.get_snapshot(db_session)
+        assert snapshot.amount == 22
+
+        assert client.put(f"/v1/balances/{db_balance.id}", json={'amount': 10}).status_code == 200
+        assert db_balance.calculate_amount(db_session) == 32
+        assert db_balance.calculate_amount(db_session, at=snapshot.created) == 22
+        assert get_mismatches(db_session) == []
+
+        assert create_snapshots(db_session, lag=0) == 2
+        assert db_session.query(BalanceSnapshot).filter(BalanceSnapshot.balance_id == db_balance.id).count() == 2
+        assert db_balance.get_snapshot(db_session).amount == 32
+
+
+class TestReconcileOperations:
+    """тесты для reconcile_operations.py"""
+    def test_reconcile(self,
+                  db_session: Session,
+                  client: TestClient
+                  ):
+        """сверка двойной записи пачками"""
+        db_balance = _create_balance(db_session)
+        db_recipient_balance = _create_balance(db_session, 'recipient_user')
+        assert client.put(f"/v1/balances/{db_balance.id}", json={'amount': 22}).status_code == 200
+        assert client.put(f"/v1/balances/transfer/{db_balance.id}",
+                          json={'amount': 10, 'to_balance': db_recipient_balance.id}).status_code == 200
+
+        assert reconcile(db_session, batch_size=1, lag=0) == []
+        watermark = db_session.query(LedgerWatermark).one()
+        assert watermark.operation_id == db_session.query(Operations).count()
+        assert watermark.amount == 0
+
+        operation = Operations(amount=5, operation_type=Operations.OperationsType.CREDIT,
+                               owner_balance_id=db_recipient_balance.id, more_balance_id=db_balance.id)
+        db_session.add(operation)
+        db_session.commit()
+        mismatches = reconcile(db_session, lag=0)
+        assert ('pair', db_balance.id, db_recipient_balance.id, 10, 15) in mismatches
+        assert ('operations', 5) in mismatches
+
+
+class TestPartitions:
+    """тесты для partitions.py"""
+    def test_month_start(self):
+        """сдвиг по месяцам"""
+        assert month_start(date(2020, 12, 7)) == date(2020, 12, 1)
+        assert month_start(date(2020, 12, 7), 1) == date(2021, 1, 1)
+        assert month_start(date(2020, 1, 7), -13) == date(2018, 12, 1)
+
+    def test_create_and_detach_partitions(self,
+                  db_session: Session,
+                  client: TestClient
+                  ):
+        """создание секций с переносом строк из секции по умолчанию и отсоединение старых"""
+        db_balance = _create_balance(db_session)
+        assert client.put(f"/v1/balances/{db_balance.id}", json={'amount': 22}).status_code == 200
+        db_session.add(Operations(amount=5, operation_type=Operations.OperationsType.CREDIT,
+                                  owner_balance_id=db_balance.id, more_balance_id=db_balance.id,
+                                  created=datetime(2020, 12, 7)))
+        db_balance.operations_count = Balance.operations_count + 1
+        db_session.commit()
+        assert db_session.execute('SELECT count(*) FROM operations_default').scalar() == 3
+
+        today = date.today()
+        assert create_partitions(db_session, months_ahead=1, today=date(2020, 12, 1)) == [
+            'operations_y2020m12', 'operations_y2021m01'
+        ]
+        assert len(create_partitions(db_session, months_ahead=2)) == 3
+        assert create_partitions(db_session, months_ahead=2) == []
+        assert db_session.execute('SELECT count(*) FROM operations_default').scalar() == 0
+        assert db_session.query(Operations).count() == 3
+
+        url = f"/v1/balances/operations/{db_balance.id}"
+        response = client.get(f"{url}?date_from={today.isoformat()}T00:00:00")
+        assert response.status_code == 200
+        assert response.json()['totalCount'] == 1
+        response = client.get(f"{url}?date_from=2020-12-01T00:00:00&date_to=2021-01-01T00:00:00")
+        assert [o['amount'] for o in response.json()['items']] == [5]
+
+        assert detach_partitions(db_session, retention_months=3) == ['operations_y2020m12', 'operations_y2021m01']
+        assert 'operations_y2020m12' not in get_partitions(db_session)
+        assert db_session.execute('SELECT count(*) FROM archive.operations_y2020m12').scalar() == 1
+        assert db_session.query(Operations).count() == 2
+        db_session.refresh(db_balance)
+        assert db_balance.operations_count == 1
+        response = client.get(url)
+        assert response.json()['totalCount'] == len(response.json()['items']) == 1
+
+
+class TestOnboardUsers:
+
+    def test_onboard(self, db_session: Session):
+        """Пользователи с кошельками из файла, пачками, в порядке файла"""
+        output = io.StringIO()
+        lines = ['user_a\n', 'user_b\n', '\n', 'user_a\n', 'user_c\n']
+        assert onboard(db_session, lines, output, batch_size=2) == (4, 3)
+        rows = list(csv.reader(io.StringIO(output.getvalue())))
+        assert rows[0] == ['username', 'balance_id', 'created']
+        assert [(r[0], r[2]) for r in rows[1:]] == [('user_a', 'true'), ('user_b', 'true'),
+                                                   ('user_a', 'false'), ('user_c', 'true')]
+        assert rows[1][1] == rows[3][1]
+        assert db_session.query(Balance).join(User).filter(User.username.in_(['user_a', 'user_b', 'user_c'])).count() == 3
@@ -0,0 +1,52 @@
+"""
+test_connects.py
+====================================
+Тесты для папки app/connects/
+"""
+import os
+
+import pytest
+from sqlalchemy import create_engine, exc
+
+from app.connects.postgres.pool import InstrumentedQueuePool, get_pool_stats
+from app.connects.postgres.session import engine
+from app.connects.postgres.utils import get_db
+
+
+class TestInstrumentedQueuePool:
+
+    def test_pool_stats(self):
+        """Подсчёт выдачи соединений и таймаутов ожидания"""
+        engine = create_engine(os.getenv('TEST_DATABASE_URL'), poolclass=InstrumentedQueuePool,
+                               pool_size=1, max_overflow=0, pool_timeout=0.1)
+        conn = engine.connect()
+        stats = get_pool_stats(engine.pool)
+        assert stats['size'] == 1
+        assert stats['checked_out'] == 1
+        assert stats['checkouts'] == 1
+
+        with pytest.raises(exc.TimeoutError):
+            engine.connect()
+        stats = get_pool_stats(engine.pool)
+        assert stats['checkouts'] == 2
+        assert stats['checkout_timeouts'] == 1
+        assert stats['wait_max_ms'] >= 100
+
+        conn.close()
+        assert get_pool_stats(engine.pool)['checked_in'] == 1
+        engine.dispose()
+
+
+class TestGetDb:
+
+    def test_session_closed_on_error(self):
+        """Соединение возвращается в пул, если обработчик упал"""
+        checked_out = engine.pool.checkedout()
+        dependency = get_db()
+        db = next(dependency)
+        db.execute('SELECT 1')
+        assert engine.pool.checkedout() == checked_out + 1
+
+        with pytest.raises(ValueError):
+            dependency.throw(ValueError())
+        assert engine.pool.checkedout() == checked_out
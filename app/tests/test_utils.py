@@ -4,7 +4,48 @@ test_utils.py
 Тесты для папки app/utils/
 """
 
-from app.utils.pgsql import generate_order_by, PGsqlOrderByExcept
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from app.utils.pgsql import (
+    FilterCompiler,
+    generate_order_by,
+    get_keyset_fields,
+    generate_keyset,
+    encode_cursor,
+    decode_cursor,
+    PGsqlOrderByExcept,
+    PGsqlFilterExcept,
+    PGsqlCursorExcept
+)
+from app.models.auth import User
+from app.models.balance import Balance, Operations
+from app.utils import balance_cache
+from app.utils.balance_cache import PostgresChannel
+from app.utils.cache import LRUCache
+from app.utils.db_utils import get_or_create, insert_or_update
+from app.utils import coalescer as coalescer_module
+from app.utils.coalescer import Coalescer, CoalesceTimeout, CoalesceOutcomeUnknown
+from app.utils import retry
+from app.utils import prepared
+from app.utils.responses import ORJSONResponse, rows_to_dicts
+from app.utils.idempotency import (
+    IdempotencyError,
+    get_fingerprint,
+    get_response,
+    claim_key,
+    save_response,
+    purge_expired,
+    clear_cache
+)
 
 
 class TestUtilsPgsql:
@@ -17,4 +58,321 @@ class TestUtilsPgsql:
         try:
             generate_order_by(['id'], ['wrong_value'])
         except PGsqlOrderByExcept as e:
-            assert 'sort_order value should consist of ASC or DESC but he wrong_value'
\ No newline at end of file
+            assert 'sort_order value should consist of ASC or DESC but he wrong_value'
+        assert generate_order_by(['amount'], ['desc'], 'o', allowed=('id', 'amount')) == "ORDER BY o.amount DESC"
+        with pytest.raises(PGsqlOrderByExcept, match='Bad sort field: id; DROP'):
+            generate_order_by(['id; DROP'], ['asc'], allowed=('id', 'amount'))
+        with pytest.raises(PGsqlOrderByExcept):
+            generate_order_by(['id', 'amount'], ['asc'])
+
+    def test_filter_compiler(self):
+        """условие WHERE с параметрами, текст зависит только от полей и операторов"""
+        compiler = FilterCompiler(Operations.__table__, ['id', 'created', 'more_balance_id'], table_pre='o')
+        sql, params = compiler.compile([{'field': 'more_balance_id', 'value': '2', 'op': '!='},
+                                        {'field': 'id', 'value': '1|2|3', 'op': 'in'},
+                                        {'field': 'created', 'value': '2020-12-01|2021-01-01', 'op': 'between'}])
+        assert sql == ("o.more_balance_id <> CAST(:filter_0 AS INTEGER) AND o.id = ANY(CAST(:filter_1 AS INTEGER[])) "
+                       "AND o.created BETWEEN CAST(:filter_2_0 AS TIMESTAMP WITH TIME ZONE) "
+                       "AND CAST(:filter_2_1 AS TIMESTAMP WITH TIME ZONE)")
+        assert params == {'filter_0': '2', 'filter_1': ['1', '2', '3'],
+                          'filter_2_0': '2020-12-01', 'filter_2_1': '2021-01-01'}
+        assert compiler.compile([{'field': 'id', 'value': '7', 'op': None}]) == (
+            "o.id = CAST(:filter_0 AS INTEGER)", {'filter_0': '7'}
+        )
+        for bad in ({'field': 'amount', 'value': '1', 'op': '='},
+                    {'field': 'id; DROP TABLE balances', 'value': '1', 'op': '='},
+                    {'field': 'id', 'value': '1', 'op': 'OR 1=1 --'},
+                    {'field': 'id', 'value': '1', 'op': 'between'}):
+            with pytest.raises(PGsqlFilterExcept):
+                compiler.compile([bad])
+
+    def test_generate_keyset(self):
+        """условие WHERE для выборки по курсору"""
+        assert get_keyset_fields(None, None) == (['id'], 'ASC')
+        assert get_keyset_fields(['created'], ['desc']) == (['created', 'id'], 'DESC')
+        with pytest.raises(PGsqlCursorExcept):
+            get_keyset_fields(['created', 'amount'], ['asc', 'asc'])
+        with pytest.raises(PGsqlOrderByExcept, match='Bad sort field: name'):
+            get_keyset_fields(['name'], ['asc'], allowed=('id', 'created'))
+        assert generate_keyset(['created', 'id'], 'DESC', ['2020-12-07', 5], 'o') == (
+            "(o.created, o.id) < (:cursor_0, :cursor_1)", {'cursor_0': '2020-12-07', 'cursor_1': 5}
+        )
+        assert generate_keyset(['id'], 'ASC', [5], types={'id': 'INTEGER'})[0] == "(id) > (CAST(:cursor_0 AS INTEGER))"
+
+    def test_cursor(self):
+        """упаковка и распаковка курсора"""
+        cursor = encode_cursor(['created', 'id'], 'ASC', ['2020-12-07', 5])
+        assert decode_cursor(cursor, ['created', 'id'], 'ASC') == ['2020-12-07', 5]
+        with pytest.raises(PGsqlCursorExcept):
+            decode_cursor(cursor, ['created', 'id'], 'DESC')
+        with pytest.raises(PGsqlCursorExcept):
+            decode_cursor('not a cursor', ['id'], 'ASC')
+
+
+class TestUtilsDb:
+
+    def test_get_or_create(self, db_session: Session):
+        """создание через INSERT ... ON CONFLICT, повтор отдает ту же запись"""
+        user, created = get_or_create(db_session, User, defaults={'is_active': True}, username='upsert_user')
+        assert created and user.id and user.is_active
+        same, created = get_or_create(db_session, User, username='upsert_user')
+        assert not created and same.id == user.id
+        balance, created = get_or_create(db_session, Balance, user_id=user.id)
+        assert created and balance.amount == 0 and balance.currency.name == 'USD'
+        assert get_or_create(db_session, Balance, user_id=user.id) == (balance, False)
+
+        assert insert_or_update(db_session, User, defaults={'is_active': False}, username='upsert_user')
+        db_session.refresh(user)
+        assert not user.is_active
+        assert db_session.query(User).filter(User.username == 'upsert_user').count() == 1
+
+
+class TestUtilsCache:
+
+    def test_lru_cache(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)  # вытесняется b, к a обращались позже
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        cache.set('d', 4, ttl=0)
+        assert cache.get('d', 'expired') == 'expired'
+
+
+class TestUtilsIdempotency:
+
+    def test_idempotency_key(self, db_session: Session):
+        fingerprint = get_fingerprint('test', 1, {'amount': 22})
+        assert fingerprint == get_fingerprint('test', 1, {'amount': 22})
+        assert get_response(db_session, 'key-1', fingerprint) is None
+
+        assert claim_key(db_session, 'key-1', fingerprint)
+        save_response(db_session, 'key-1', {'total': 22})
+        assert not claim_key(db_session, 'key-1', fingerprint)
+        assert get_response(db_session, 'key-1', fingerprint) == {'total': 22}
+        with pytest.raises(IdempotencyError):
+            get_response(db_session, 'key-1', get_fingerprint('test', 1, {'amount': 10}))
+
+        db_session.execute("UPDATE idempotency_keys SET created = now() - interval '2 days'")
+        clear_cache()
+        assert get_response(db_session, 'key-1', fingerprint) is None
+        assert purge_expired(db_session) == 1
+
+
+class TestUtilsResponses:
+
+    def test_orjson_response(self):
+        """Decimal числом, datetime в ISO 8601 - как у jsonable_encoder"""
+        created = datetime(2020, 12, 7, 10, 30, tzinfo=timezone.utc)
+        items = rows_to_dicts(('id', 'created', 'amount'), [(1, created, Decimal('22.50'))])
+        response = ORJSONResponse({'items': items, 'next_cursor': None})
+        assert response.body == b'{"items":[{"id":1,"created":"2020-12-07T10:30:00+00:00","amount":22.5}],"next_cursor":null}'
+
+
+class TestUtilsPrepared:
+
+    def test_prepared_statement(self, db_session: Session, monkeypatch):
+        """PREPARE один раз на соединение, дальше EXECUTE, в том числе после отката"""
+        statement = prepared.PreparedStatement('test_add', 'SELECT :a + :b', a='integer', b='integer')
+        hits, misses = prepared.stats.hits.get('test_add', 0), prepared.stats.misses.get('test_add', 0)
+        assert statement.execute(db_session, a=1, b=2).scalar() == 3
+        db_session.execute('SAVEPOINT s')
+        assert statement.execute(db_session, a=2, b=2).scalar() == 4
+        db_session.execute('ROLLBACK TO SAVEPOINT s')
+        assert statement.execute(db_session, a=3, b=2).scalar() == 5
+        assert prepared.stats.misses['test_add'] - misses == 1
+        assert prepared.stats.hits['test_add'] - hits == 2
+
+        monkeypatch.setattr(prepared.settings, 'DB_PREPARED_STATEMENTS', False)
+        assert statement.execute(db_session, a=4, b=2).scalar() == 6
+        assert prepared.stats.hits['test_add'] - hits == 2
+        with pytest.raises(ValueError):
+            prepared.PreparedStatement('test_bad', 'SELECT :a + :b', a='integer')
+        prepared.STATEMENTS.pop('test_add')
+
+    def test_prepared_shapes(self, db_session: Session, monkeypatch):
+        """Одна форма запроса - одно имя, в том числе в новом кэше; статистика по группе"""
+        monkeypatch.setattr(prepared.settings, 'DB_PREPARED_STATEMENTS', True)
+        shapes = prepared.PreparedShapes('test_shapes')
+        types = {'a': 'integer', 'b': 'integer', 'c': 'text'}
+        statement = shapes.get('SELECT :a + :b', types)
+        assert statement is shapes.get('SELECT :a + :b', types)
+        assert statement.name.startswith('test_shapes_') and statement.params == ['a', 'b']
+        assert prepared.PreparedShapes('test_shapes').get('SELECT :a + :b', types).name == statement.name
+        assert shapes.get('SELECT :a * :b', types).name != statement.name
+
+        misses = prepared.stats.misses.get('test_shapes', 0)
+        assert statement.execute(db_session, a=1, b=2).scalar() == 3
+        assert shapes.get('SELECT :a + :b', types).execute(db_session, a=2, b=2).scalar() == 4
+        assert prepared.stats.misses['test_shapes'] - misses == 1
+        prepared.STATEMENTS.pop('test_shapes')
+
+
+class TestUtilsBalanceCache:
+
+    def test_postgres_channel(self):
+        """Уведомление об изменении остатков доходит до слушателя после commit"""
+        engine = create_engine(os.getenv('TEST_DATABASE_URL'))
+        channel = PostgresChannel(engine.url.translate_connect_args(username='user', database='dbname'),
+                                  name='balance_cache_test')
+        received = []
+        channel.listen(received.append)
+        try:
+            for _ in range(50):
+                if received:
+                    break
+                time.sleep(0.1)
+            assert received == [None]  # после подключения кэш сбрасывается целиком
+
+            db_session = Session(bind=engine)
+            channel.publish(db_session, {2, 1})
+            db_session.rollback()
+            channel.publish(db_session, {3})
+            db_session.commit()
+            db_session.close()
+            for _ in range(50):
+                if len(received) > 1:
+                    break
+                time.sleep(0.1)
+            assert received == [None, {3}]
+        finally:
+            channel.close()
+            engine.dispose()
+
+    def test_start_publish_only(self, monkeypatch):
+        """Фоновые команды только рассылают инвалидации, без потока LISTEN"""
+        monkeypatch.setattr(balance_cache.settings, 'BALANCE_CACHE_CHANNEL', 'postgres')
+        balance_cache.start(listen=False)
+        try:
+            assert isinstance(balance_cache._channel, PostgresChannel)
+            assert balance_cache._channel._thread is None
+        finally:
+            balance_cache.stop()
+
+
+class _PgError(Exception):
+    def __init__(self, pgcode):
+        self.pgcode = pgcode
+
+
+class TestUtilsRetry:
+
+    def test_run_in_transaction(self, db_session: Session):
+        """Повтор при взаимоблокировке, остальные ошибки пробрасываются сразу"""
+        calls = []
+
+        def _deadlock_once():
+            calls.append(1)
+            if len(calls) == 1:
+                raise OperationalError('UPDATE balances', {}, _PgError('40P01'))
+            return 'ok'
+
+        before = retry.stats.as_dict()
+        assert retry.run_in_transaction(db_session, _deadlock_once, base_delay=0) == 'ok'
+        assert len(calls) == 2
+        after = retry.stats.as_dict()
+        assert after['retries']['deadlock_detected'] == before['retries']['deadlock_detected'] + 1
+
+        def _serialization_failure():
+            calls.append(1)
+            raise OperationalError('UPDATE balances', {}, _PgError('40001'))
+
+        calls.clear()
+        with pytest.raises(OperationalError):
+            retry.run_in_transaction(db_session, _serialization_failure, attempts=3, base_delay=0)
+        assert len(calls) == 3
+        assert retry.stats.as_dict()['exhausted'] == after['exhausted'] + 1
+
+        def _unique_violation():
+            calls.append(1)
+            raise OperationalError('INSERT', {}, _PgError('23505'))
+
+        calls.clear()
+        with pytest.raises(OperationalError):
+            retry.run_in_transaction(db_session, _unique_violation, base_delay=0)
+        assert len(calls) == 1
+
+
+class TestUtilsCoalescer:
+
+    def test_group_commit(self):
+        """Записи из разных потоков пишутся группами, ошибка одной записи не отклоняет группу"""
+        engine = create_engine(os.getenv('TEST_DATABASE_URL'))
+        db_session = Session(bind=engine)
+        balances = [Balance(user=User(username=f'coalescer_{i}', is_active=True)) for i in range(2)]
+        db_session.add_all(balances)
+        db_session.commit()
+        first, second = [b.id for b in balances]
+
+        coalescer = Coalescer(lambda: Session(bind=engine), max_items=50, max_delay=0.05)
+        coalescer.start()
+        try:
+            deposits = [coalescer.submit((None, first, Decimal(10))) for _ in range(10)]
+            results = [future.result(timeout=10) for future in deposits]
+            with ThreadPoolExecutor(10) as executor:
+                transfers = list(executor.map(coalescer.submit, [(first, second, Decimal(1))] * 10))
+            results += [future.result(timeout=10) for future in transfers]
+            error, _ = coalescer.submit((second, first, Decimal(1000))).result(timeout=10)
+        finally:
+            coalescer.stop()
+
+        assert [error for error, _ in results] == [None] * 20
+        assert error == f"Insufficient funds on the balance: {second}"
+        assert coalescer.items == 21
+        assert coalescer.flushes < 21
+        db_session.expire_all()
+        assert [b.amount for b in balances] == [90, 10]
+        assert db_session.query(Operations).count() == 40
+        db_session.close()
+        engine.dispose()
+
+    def test_group_commit_system_shards(self, monkeypatch):
+        """Зачисления группы списываются с системного кошелька по хешу id получателя, как одиночные"""
+        monkeypatch.setattr(coalescer_module.settings, 'SYSTEM_BALANCE_SHARDS', 3)
+        monkeypatch.setattr(coalescer_module.settings, 'SYSTEM_BALANCE_STRATEGY', 'hash')
+        engine = create_engine(os.getenv('TEST_DATABASE_URL'))
+        db_session = Session(bind=engine)
+        balances = [Balance(user=User(username=f'coalescer_shard_{i}', is_active=True)) for i in range(3)]
+        db_session.add_all(balances)
+        db_session.commit()
+        balance_ids = [b.id for b in balances]
+
+        coalescer = Coalescer(lambda: Session(bind=engine), max_items=50, max_delay=0.05)
+        coalescer.start()
+        try:
+            deposits = [coalescer.submit((None, balance_id, Decimal(10))) for balance_id in balance_ids]
+            assert [future.result(timeout=10)[0] for future in deposits] == [None] * 3
+        finally:
+            coalescer.stop()
+
+        try:
+            system_ids = [Balance.get_system_balance(db_session, key=balance_id).id for balance_id in balance_ids]
+            assert len(set(system_ids)) == 3
+            credits = db_session.query(Operations.owner_balance_id, Operations.more_balance_id).filter(
+                Operations.owner_balance_id.in_(balance_ids),
+                Operations.operation_type == Operations.OperationsType.CREDIT
+            )
+            assert dict(credits) == dict(zip(balance_ids, system_ids))
+        finally:
+            db_session.close()
+            engine.dispose()
+
+    def test_submit_timeout(self, monkeypatch):
+        """Запись, не попавшая в группу за таймаут, снимается с очереди; начатая группа - исход неизвестен"""
+        def _no_session():
+            raise AssertionError('a cancelled entry must not be written')
+
+        coalescer = Coalescer(_no_session, max_items=50, max_delay=0.05)  # поток записи не запущен
+        monkeypatch.setattr(coalescer_module, '_coalescer', coalescer)
+        monkeypatch.setattr(coalescer_module.settings, 'LEDGER_COALESCE_TIMEOUT', 0.05)
+        with pytest.raises(CoalesceTimeout):
+            coalescer_module.submit(None, 1, Decimal(10))
+        coalescer._flush([coalescer._queue.get_nowait()])
+
+        running = Future()
+        running.set_running_or_notify_cancel()
+        monkeypatch.setattr(coalescer, 'submit', lambda entry: running)
+        with pytest.raises(CoalesceOutcomeUnknown):
+            coalescer_module.submit(None, 1, Decimal(10))
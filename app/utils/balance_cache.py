@@ -0,0 +1,227 @@
+"""
+balance_cache.py
+====================================
+Кэш ответов GET /v1/balances/{balance_id} в памяти процесса
+
+Остаток меняется только через Balance.change_amount(s), они и вызывают invalidate:
+записи кошельков удаляются из кэша этого процесса после commit, а остальным процессам
+рассылаются через канал инвалидации (Postgres LISTEN/NOTIFY, в тестах - в памяти).
+"""
+import time
+import select
+import logging
+import threading
+from typing import Callable, Iterable, List, Optional, Set
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app import settings
+from app.utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# ключ в Session.info: кошельки, измененные в текущей транзакции
+PENDING_KEY = 'balance_cache_invalidate'
+
+_balances = LRUCache(settings.BALANCE_CACHE_SIZE, settings.BALANCE_CACHE_TTL)
+
+
+class InvalidationChannel:
+    """Канал рассылки инвалидаций между процессами API"""
+
+    def publish(self, db_session: Session, balance_ids: Set[int]):
+        """Вызывается в транзакции записи, до commit"""
+        pass
+
+    def committed(self, balance_ids: Set[int]):
+        """Вызывается после commit транзакции записи"""
+        pass
+
+    def listen(self, callback: Callable[[Optional[Set[int]]], None]):
+        """Подписка на инвалидации других процессов, None - сбросить весь кэш"""
+        pass
+
+    def close(self):
+        pass
+
+
+class MemoryChannel(InvalidationChannel):
+    """Рассылка подписчикам в том же процессе (для тестов и одного воркера)"""
+
+    def __init__(self):
+        self.subscribers: List[Callable] = []
+
+    def committed(self, balance_ids: Set[int]):
+        for callback in self.subscribers:
+            callback(balance_ids)
+
+    def listen(self, callback: Callable[[Optional[Set[int]]], None]):
+        self.subscribers.append(callback)
+
+
+class PostgresChannel(InvalidationChannel):
+    """Рассылка через NOTIFY: уведомление уходит только при commit транзакции записи
+
+    Args:
+        connect_params: параметры psycopg2.connect для отдельного соединения LISTEN
+        name: имя канала
+    """
+    # NOTIFY ограничен 8000 байт, при длинном списке процессы сбрасывают кэш целиком
+    MAX_PAYLOAD = 7900
+
+    def __init__(self, connect_params: dict, name: str = 'balance_cache'):
+        self.connect_params = connect_params
+        self.name = name
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def publish(self, db_session: Session, balance_ids: Set[int]):
+        payload = ','.join(str(balance_id) for balance_id in sorted(balance_ids))
+        if len(payload) > self.MAX_PAYLOAD:
+            payload = '*'
+        db_session.execute('SELECT pg_notify(:channel, :payload)', {'channel': self.name, 'payload': payload})
+
+    def listen(self, callback: Callable[[Optional[Set[int]]], None]):
+        self._thread = threading.Thread(target=self._run, args=(callback,), name='balance-cache-listen', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def _run(self, callback: Callable[[Optional[Set[int]]], None]):
+        while not self._stopped.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.connect_params)
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(f'LISTEN {self.name}')
+                # пока соединения не было, уведомления могли потеряться
+                callback(None)
+                while not self._stopped.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        payload = conn.notifies.pop(0).payload
+                        callback(None if payload == '*' else {int(balance_id) for balance_id in payload.split(',')})
+            except psycopg2.Error:
+                logger.exception('balance cache listener failed, reconnecting')
+                callback(None)
+                self._stopped.wait(1)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+_channel: InvalidationChannel = MemoryChannel()
+
+
+def get(balance_id: int, max_age: float = None) -> Optional[dict]:
+    """Закэшированный ответ
+
+    Args:
+        balance_id: id кошелька
+        max_age: допустимый возраст записи в секундах, None - BALANCE_CACHE_TTL
+
+    Returns:
+        BalanceSchema в виде dict или None
+    """
+    item = _balances.get(balance_id)
+    if item is None:
+        return None
+    cached_at, payload = item
+    if payload is None or (max_age is not None and time.monotonic() - cached_at > max_age):
+        return None
+    return payload
+
+
+def put(balance_id: int, payload: dict, started: float):
+    """Кладет ответ в кэш, если кошелек не менялся с начала чтения
+
+    Args:
+        balance_id: id кошелька
+        payload: BalanceSchema в виде dict
+        started: time.monotonic() до запроса к БД
+    """
+    item = _balances.get(balance_id)
+    if item is not None and item[1] is None and item[0] >= started:
+        return
+    _balances.set(balance_id, (time.monotonic(), payload))
+
+
+def drop(balance_ids: Optional[Iterable[int]]):
+    """Удаляет записи из кэша процесса, None - весь кэш
+
+    Вместо записи остается отметка времени: чтение, начатое раньше, не вернет старый остаток в кэш.
+    """
+    if balance_ids is None:
+        _balances.clear()
+        return
+    now = time.monotonic()
+    for balance_id in balance_ids:
+        _balances.set(balance_id, (now, None))
+
+
+def invalidate(db_session: Session, balance_ids: Iterable[int]):
+    """Сбрасывает кэш кошельков, измененных в текущей транзакции
+
+    Args:
+        db_session: сессия с транзакцией записи
+        balance_ids: измененные кошельки
+    """
+    db_session.info.setdefault(PENDING_KEY, set()).update(balance_ids)
+
+
+@event.listens_for(Session, 'before_commit')
+def _before_commit(db_session: Session):
+    # одно уведомление на транзакцию, а не на каждое изменение остатка
+    balance_ids = db_session.info.get(PENDING_KEY)
+    if balance_ids:
+        _channel.publish(db_session, balance_ids)
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(db_session: Session):
+    balance_ids = db_session.info.pop(PENDING_KEY, None)
+    if balance_ids:
+        drop(balance_ids)
+        _channel.committed(balance_ids)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _after_rollback(db_session: Session, previous_transaction):
+    db_session.info.pop(PENDING_KEY, None)
+
+
+def start(listen: bool = True):
+    """Подключает канал инвалидации из BALANCE_CACHE_CHANNEL (при старте приложения)
+
+    Args:
+        listen: подписаться на инвалидации других процессов; False - только рассылать
+                (фоновые команды, которые меняют остатки, но не отдают их из кэша)
+    """
+    global _channel
+    if settings.BALANCE_CACHE_CHANNEL == 'postgres':
+        from app.connects.postgres.session import engine
+
+        _channel = PostgresChannel(engine.url.translate_connect_args(username='user', database='dbname'))
+    else:
+        _channel = MemoryChannel()
+    if listen:
+        _channel.listen(drop)
+
+
+def stop():
+    global _channel
+    _channel.close()
+    _channel = MemoryChannel()
+    _balances.clear()
+
+
+def clear():
+    _balances.clear()
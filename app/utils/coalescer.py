@@ -0,0 +1,174 @@
+"""
+coalescer.py
+====================================
+Групповая запись переводов и зачислений (group commit)
+
+Обработчики кладут запись в очередь и ждут future. Поток записи собирает записи
+не дольше LEDGER_COALESCE_MAX_DELAY_MS или до LEDGER_COALESCE_MAX_ITEMS штук и пишет
+их одной транзакцией (app/utils/ledger.py:apply_entries): один commit и одно
+изменение остатка на кошелек вместо пары на каждый запрос. Future получает
+результат только после commit.
+"""
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from decimal import Decimal
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app import settings
+from app.models.balance import Balance
+from app.utils.ledger import Entry, apply_entries
+from app.utils.retry import run_in_transaction
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class CoalesceTimeout(Exception):
+    """Запись не дождалась группы и снята с очереди: перевод не записан, запрос можно повторить"""
+
+
+class CoalesceOutcomeUnknown(Exception):
+    """Группа с записью уже пишется: перевод может быть записан, повторять без проверки нельзя"""
+
+
+class Coalescer:
+    """Очередь записей и поток, который пишет их группами
+
+    Args:
+        session_factory: создает сессию к БД для каждой группы
+        max_items: максимальный размер группы
+        max_delay: сколько секунд группа ждет новые записи после первой
+    """
+
+    def __init__(self, session_factory: Callable[[], Session], max_items: int, max_delay: float):
+        self.session_factory = session_factory
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.flushes = 0
+        self.items = 0
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='ledger-coalescer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Дописывает очередь и останавливает поток"""
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, entry: Entry) -> Future:
+        """Ставит перевод (или зачисление, если отправитель None) в очередь
+
+        Returns:
+            Future с (ошибка или None, остаток получателя после записи)
+        """
+        future = Future()
+        self._queue.put((entry, future))
+        return future
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_items:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch: List[Tuple[Entry, Future]]):
+        # записи, снятые по таймауту ожидания, не пишутся; остальные больше снять нельзя
+        batch = [(entry, future) for entry, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        db_session = self.session_factory()
+        try:
+            entries = [entry for entry, _ in batch]
+            # the same system wallet as a single deposit, chosen by the recipient
+            system_balances = {}
+            for from_id, to_id, _ in entries:
+                if from_id is None and to_id not in system_balances:
+                    system_balances[to_id] = Balance.get_system_balance(db_session, key=to_id).id
+            errors, totals = run_in_transaction(db_session, lambda: apply_entries(db_session, system_balances, entries))
+        except Exception as e:
+            logger.exception('ledger group commit failed')
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        finally:
+            db_session.close()
+        self.flushes += 1
+        self.items += len(batch)
+        for (_, future), error, total in zip(batch, errors, totals):
+            future.set_result((error, total))
+
+
+_coalescer: Optional[Coalescer] = None
+
+
+def enabled() -> bool:
+    return _coalescer is not None
+
+
+def submit(from_id: Optional[int], to_id: int, amount: Decimal) -> Tuple[Optional[str], Optional[Decimal]]:
+    """Записывает перевод через групповую запись и ждет commit
+
+    Returns:
+        (ошибка или None, остаток получателя после записи)
+
+    Raises:
+        CoalesceTimeout: за LEDGER_COALESCE_TIMEOUT запись не попала в группу и не будет записана
+        CoalesceOutcomeUnknown: группа с записью пишется дольше LEDGER_COALESCE_TIMEOUT
+    """
+    future = _coalescer.submit((from_id, to_id, amount))
+    try:
+        return future.result(timeout=settings.LEDGER_COALESCE_TIMEOUT)
+    except FutureTimeoutError:
+        if future.cancel():
+            raise CoalesceTimeout('Ledger queue timeout, the operation was not applied')
+    try:
+        # the group may have committed between the timeout and cancel()
+        return future.result(timeout=0)
+    except FutureTimeoutError:
+        raise CoalesceOutcomeUnknown('Ledger write timeout, the operation may have been applied')
+
+
+def start(session_factory: Callable[[], Session] = None):
+    """Запускает поток групповой записи, если включен LEDGER_COALESCE (при старте приложения)"""
+    global _coalescer
+    if not settings.LEDGER_COALESCE or _coalescer is not None:
+        return
+    if session_factory is None:
+        from app.connects.postgres.session import Session as session_factory
+    _coalescer = Coalescer(session_factory, settings.LEDGER_COALESCE_MAX_ITEMS,
+                           settings.LEDGER_COALESCE_MAX_DELAY_MS / 1000)
+    _coalescer.start()
+
+
+def stop():
+    global _coalescer
+    if _coalescer is not None:
+        _coalescer.stop()
+        _coalescer = None
@@ -5,40 +5,56 @@ db_utils.py
 """
 from typing import List, Any, Tuple
 
-from sqlalchemy.orm import Session
+from sqlalchemy import inspect
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session, make_transient_to_detached
 from sqlalchemy.sql.expression import ClauseElement
 
 
 def get_or_create(session: Session, model: Any, defaults:dict = None, **kwargs)-> Tuple[Any, bool]:
     """
     Отдает или создает запись в БД
+
+    Поля kwargs должны быть покрыты уникальным индексом: запись создается
+    INSERT ... ON CONFLICT DO NOTHING, поэтому параллельный вызов с теми же kwargs
+    не создаст дубль и не упадет на нарушении уникальности, а получит существующую запись.
+    Существующая запись читается одним SELECT, новая - одним INSERT ... RETURNING и commit.
     """
     instance = session.query(model).filter_by(**kwargs).first()
     if instance:
         return instance, False
-    else:
-        params = dict((k, v) for k, v in kwargs.items() if not isinstance(v, ClauseElement))
-        params.update(defaults or {})
-        instance = model(**params)
+    params = dict((k, v) for k, v in kwargs.items() if not isinstance(v, ClauseElement))
+    params.update(defaults or {})
+    stmt = insert(model.__table__).values(**params).on_conflict_do_nothing(
+        index_elements=list(kwargs)
+    )
+    attrs = inspect(model).column_attrs
+    row = session.execute(stmt.returning(*(attr.columns[0] for attr in attrs))).first()
+    session.commit()
+    if row:
+        # the RETURNING row becomes a persistent object without another SELECT
+        instance = model(**{attr.key: value for attr, value in zip(attrs, row)})
+        make_transient_to_detached(instance)
         session.add(instance)
-        session.commit()
         return instance, True
+    # created by a concurrent call between our SELECT and INSERT
+    return session.query(model).filter_by(**kwargs).first(), False
 
 def insert_or_update(session: Session, model: Any, defaults:dict = None, **kwargs)-> Tuple[Any, bool]:
     """
     Создать или обновить запись в БД
+
+    Один INSERT ... ON CONFLICT (поля kwargs) DO UPDATE SET поля defaults,
+    поля kwargs должны быть покрыты уникальным индексом.
     """
     params = dict((k, v) for k, v in kwargs.items() if not isinstance(v, ClauseElement))
     params.update(defaults or {})
-    instance = session.query(model).filter_by(**kwargs).first()
-    if not instance:
-        instance = model(**params)
-        session.add(instance)
+    stmt = insert(model.__table__).values(**params)
+    if defaults:
+        stmt = stmt.on_conflict_do_update(index_elements=list(kwargs), set_=defaults)
     else:
-        for k, v in defaults.items():
-            if hasattr(instance, k):
-                setattr(instance, k, v)
-        session.merge(instance)
+        stmt = stmt.on_conflict_do_nothing(index_elements=list(kwargs))
+    session.execute(stmt)
     session.commit()
     return True
 
@@ -0,0 +1,73 @@
+"""
+export.py
+====================================
+Потоковая выгрузка результатов запроса в NDJSON и CSV
+
+Строки читаются серверным курсором psycopg2 (stream_results) пачками по chunk_size,
+в памяти процесса одновременно держится одна пачка независимо от размера выгрузки.
+"""
+import io
+import csv
+import json
+from enum import Enum
+from typing import Iterator, List, Sequence
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+
+class ExportFormat(str, Enum):
+    """формат выгрузки"""
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+MEDIA_TYPES = {
+    ExportFormat.ndjson: 'application/x-ndjson',
+    ExportFormat.csv: 'text/csv',
+}
+
+
+def _value(value):
+    if isinstance(value, Enum):
+        return value.name
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value if value is None or isinstance(value, (int, str)) else str(value)
+
+
+def stream_rows(db_session: Session, sql: str, params: dict, chunk_size: int = 1000) -> Iterator[List[Sequence]]:
+    """Читает результат запроса серверным курсором
+
+    Returns:
+        итератор пачек строк
+    """
+    result = db_session.execute(text(sql).execution_options(stream_results=True), params)
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield rows
+    finally:
+        result.close()
+
+
+def iter_ndjson(chunks: Iterator[List[Sequence]], columns: Sequence[str]) -> Iterator[str]:
+    """Строка JSON на запись, числа Numeric - строкой без потери точности"""
+    for rows in chunks:
+        yield ''.join(json.dumps(dict(zip(columns, map(_value, row)))) + '\n' for row in rows)
+
+
+def iter_csv(chunks: Iterator[List[Sequence]], columns: Sequence[str]) -> Iterator[str]:
+    """CSV с заголовком"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in chunks:
+        writer.writerows([_value(value) for value in row] for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,123 @@
+"""
+idempotency.py
+====================================
+Ключи идемпотентности (заголовок Idempotency-Key) для зачислений и переводов
+
+Повтор запроса с тем же ключом и телом отдает сохраненный ответ, не трогая журнал операций.
+Ключ захватывается вставкой в idempotency_keys в той же транзакции, что и операции:
+параллельный повтор ждет на первичном ключе, пока первая транзакция не завершится.
+Ответы по ключам кэшируются в памяти процесса, БД остается источником истины.
+"""
+import json
+import hashlib
+from typing import Any, Optional
+
+from sqlalchemy.orm import Session
+
+from app import settings
+from app.models.idempotency import IdempotencyKey  # noqa: таблица для create_all
+from app.utils.cache import LRUCache
+
+SQL_GET = '''
+    SELECT fingerprint, response,
+           EXTRACT(EPOCH FROM created + make_interval(secs => :ttl) - now()) AS ttl
+    FROM idempotency_keys
+    WHERE key = :key AND created > now() - make_interval(secs => :ttl)
+'''
+
+# просроченный ключ захватывается заново
+SQL_CLAIM = '''
+    INSERT INTO idempotency_keys (key, fingerprint, status_code, created)
+    VALUES (:key, :fingerprint, 200, now())
+    ON CONFLICT (key) DO UPDATE
+        SET fingerprint = EXCLUDED.fingerprint, response = NULL, created = EXCLUDED.created
+        WHERE idempotency_keys.created <= now() - make_interval(secs => :ttl)
+    RETURNING key
+'''
+
+SQL_SAVE = 'UPDATE idempotency_keys SET response = CAST(:response AS JSONB) WHERE key = :key'
+
+SQL_PURGE = 'DELETE FROM idempotency_keys WHERE created <= now() - make_interval(secs => :ttl)'
+
+_responses = LRUCache(settings.IDEMPOTENCY_CACHE_SIZE, settings.IDEMPOTENCY_TTL)
+
+
+class IdempotencyError(Exception):
+    """Ключ уже использован с другим запросом"""
+
+    def __init__(self, key: str):
+        super().__init__(f"Idempotency key was used with another request: {key}")
+
+
+def get_fingerprint(*parts: Any) -> str:
+    """Отпечаток запроса: обработчик, параметры пути и тело
+
+    Returns:
+        sha256 в hex
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_response(db_session: Session, key: Optional[str], fingerprint: str) -> Optional[dict]:
+    """Сохраненный ответ по ключу
+
+    Args:
+        db_session: сессия к БД postgres
+        key: ключ идемпотентности, None - запрос без ключа
+        fingerprint: отпечаток текущего запроса
+
+    Returns:
+        ответ первого запроса или None, если ключ еще не использовался или просрочен
+
+    Raises:
+        IdempotencyError: ключ использован с другим запросом
+    """
+    if not key:
+        return None
+    cached = _responses.get(key)
+    if cached is None:
+        row = db_session.execute(SQL_GET, {'key': key, 'ttl': settings.IDEMPOTENCY_TTL}).first()
+        if not row or row.response is None:
+            return None
+        cached = (row.fingerprint, row.response)
+        _responses.set(key, cached, ttl=float(row.ttl))
+    if cached[0] != fingerprint:
+        raise IdempotencyError(key)
+    return cached[1]
+
+
+def claim_key(db_session: Session, key: Optional[str], fingerprint: str) -> bool:
+    """Захватывает ключ в текущей транзакции
+
+    Returns:
+        False - ключ уже использован (параллельный запрос успел раньше)
+    """
+    if not key:
+        return True
+    params = {'key': key, 'fingerprint': fingerprint, 'ttl': settings.IDEMPOTENCY_TTL}
+    return db_session.execute(SQL_CLAIM, params).first() is not None
+
+
+def save_response(db_session: Session, key: Optional[str], response: dict):
+    """Записывает ответ по захваченному ключу, фиксируется вместе с транзакцией операций"""
+    if key:
+        db_session.execute(SQL_SAVE, {'key': key, 'response': json.dumps(response, default=str)})
+
+
+def remember(key: Optional[str], fingerprint: str, response: dict):
+    """Кладет ответ в кэш процесса, вызывается после commit"""
+    if key:
+        _responses.set(key, (fingerprint, json.loads(json.dumps(response, default=str))))
+
+
+def purge_expired(db_session: Session) -> int:
+    """Удаляет просроченные ключи
+
+    Returns:
+        кол-во удаленных ключей
+    """
+    return db_session.execute(SQL_PURGE, {'ttl': settings.IDEMPOTENCY_TTL}).rowcount
+
+
+def clear_cache():
+    _responses.clear()
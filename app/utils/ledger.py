@@ -0,0 +1,248 @@
+"""
+ledger.py
+====================================
+Запись переводов в журнал операций пачками
+"""
+import io
+import csv
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+from app import settings
+from app.models.balance import Balance, Operations
+from app.utils import balance_cache
+from app.utils.prepared import PreparedStatement
+from app.utils.retry import get_sqlstate
+
+LOCK_BALANCES = PreparedStatement(
+    'balances_lock', 'SELECT id, amount FROM balances WHERE id = ANY(:balance_ids) ORDER BY id FOR UPDATE',
+    balance_ids='integer[]'
+)
+
+Transfer = Tuple[int, int, Decimal]
+"""(id кошелька отправителя, id кошелька получателя, сумма)"""
+
+
+class LedgerError(Exception):
+    """Пачка переводов отклонена целиком
+
+    Attributes:
+        errors: ошибка по каждому переводу пачки (None - перевод прошел проверку)
+    """
+    def __init__(self, errors: List[Optional[str]]):
+        self.errors = errors
+        super().__init__('; '.join(f"{i}: {e}" for i, e in enumerate(errors) if e))
+
+
+def lock_balances(db_session: Session, balance_ids: Iterable[int]) -> Dict[int, Decimal]:
+    """Блокирует кошельки (SELECT ... FOR UPDATE) в порядке возрастания id
+
+    Единый порядок блокировок исключает взаимоблокировки встречных переводов.
+
+    Returns:
+        {id кошелька: остаток} для найденных кошельков
+    """
+    balance_ids = sorted(set(balance_ids))
+    if not balance_ids:
+        return {}
+    rows = LOCK_BALANCES.execute(db_session, balance_ids=balance_ids)
+    return {balance_id: amount for balance_id, amount in rows}
+
+
+class TransferError(Exception):
+    """Перевод отклонен функцией ledger_transfer"""
+
+
+def call_transfer(db_session: Session, from_id: int, to_id: int, amount: Decimal,
+                  check_funds: bool = True) -> Tuple[Decimal, Decimal]:
+    """Перевод одним запросом через функцию БД ledger_transfer
+
+    Блокировки, проверки, пара операций и оба остатка - на стороне БД, в текущей транзакции.
+
+    Args:
+        db_session: сессия к БД postgres
+        from_id: кошелек отправителя (для зачисления - системный)
+        to_id: кошелек получателя
+        amount: сумма
+        check_funds: проверять остаток отправителя
+
+    Returns:
+        новые остатки (отправителя, получателя)
+
+    Raises:
+        TransferError: кошелек не найден, недостаточно средств, неположительная сумма
+    """
+    try:
+        row = db_session.execute(
+            'SELECT from_amount, to_amount FROM ledger_transfer(:from_id, :to_id, :amount, :check_funds)',
+            {'from_id': from_id, 'to_id': to_id, 'amount': amount, 'check_funds': check_funds}
+        ).first()
+    except DBAPIError as e:
+        if get_sqlstate(e) == 'P0001':  # RAISE EXCEPTION
+            raise TransferError(e.orig.diag.message_primary) from e
+        raise
+    balance_cache.invalidate(db_session, [from_id, to_id])
+    return row.from_amount, row.to_amount
+
+
+def _operation_rows(transfers: List[Transfer]) -> List[dict]:
+    """Пары строк DEBIT/CREDIT для переводов"""
+    created = datetime.now()
+    rows = []
+    for from_id, to_id, amount in transfers:
+        rows.append({'owner_balance_id': from_id, 'more_balance_id': to_id, 'amount': amount,
+                     'operation_type': Operations.OperationsType.DEBIT, 'created': created})
+        rows.append({'owner_balance_id': to_id, 'more_balance_id': from_id, 'amount': amount,
+                     'operation_type': Operations.OperationsType.CREDIT, 'created': created})
+    return rows
+
+
+def copy_operations(db_session: Session, rows: List[dict]):
+    """Вставляет строки операций через COPY в текущей транзакции сессии"""
+    columns = ('owner_balance_id', 'more_balance_id', 'amount', 'operation_type', 'created')
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow((row['owner_balance_id'], row['more_balance_id'], row['amount'],
+                         row['operation_type'].name, row['created'].isoformat()))
+    buffer.seek(0)
+    cursor = db_session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY operations ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    finally:
+        cursor.close()
+
+
+def insert_operations(db_session: Session, transfers: List[Transfer], chunk_size: int = 1000):
+    """Вставляет пары DEBIT/CREDIT многострочными INSERT по chunk_size строк,
+    большие пачки (от settings.LEDGER_COPY_THRESHOLD строк) - через COPY"""
+    rows = _operation_rows(transfers)
+    if len(rows) >= settings.LEDGER_COPY_THRESHOLD:
+        return copy_operations(db_session, rows)
+    for start in range(0, len(rows), chunk_size):
+        db_session.execute(Operations.__table__.insert().values(rows[start:start + chunk_size]))
+
+
+def post_transfers(db_session: Session, transfers: List[Transfer]) -> Dict[int, Decimal]:
+    """Записывает переводы без проверок: операции и одно изменение остатка на кошелек
+
+    Returns:
+        {id кошелька: новый остаток}
+    """
+    if not transfers:
+        return {}
+    insert_operations(db_session, transfers)
+    changes = []
+    for from_id, to_id, amount in transfers:
+        changes.append((from_id, -amount))
+        changes.append((to_id, amount))
+    return Balance.change_amounts(db_session, changes)
+
+
+Entry = Tuple[Optional[int], int, Decimal]
+"""(id кошелька отправителя или None - зачисление с системного кошелька, id кошелька получателя, сумма)"""
+
+
+def _check_entries(amounts: Dict[int, Decimal], entries: List[Entry],
+                   system_balances: Dict[int, int] = None) -> Tuple[List[Optional[str]], List[Transfer], List[Optional[Decimal]]]:
+    """Проверяет переводы и зачисления по порядку с учетом предыдущих
+
+    Args:
+        amounts: остатки заблокированных кошельков, меняются по мере проверки
+        entries: переводы и зачисления
+        system_balances: системный кошелек зачисления по id пополняемого кошелька
+
+    Returns:
+        ошибки по каждой записи, прошедшие проверку переводы, остаток получателя после каждой записи
+    """
+    errors, accepted, totals = [], [], []
+    for from_id, to_id, amount in entries:
+        deposit = from_id is None
+        if deposit and to_id not in amounts:
+            error = f"Not found balance id: {to_id}"
+        elif not deposit and from_id not in amounts:
+            error = f"Not found balance id: {from_id}"
+        elif not deposit and to_id not in amounts:
+            error = f"Not found recipient's balance id: {to_id}"
+        elif amount <= 0:
+            error = f"Amount must be positive: {amount}"
+        elif not deposit and amounts[from_id] < amount:
+            error = f"Insufficient funds on the balance: {from_id}"
+        else:
+            error = None
+            from_id = system_balances[to_id] if deposit else from_id
+            amounts[from_id] -= amount
+            amounts[to_id] += amount
+            accepted.append((from_id, to_id, amount))
+        errors.append(error)
+        totals.append(None if error else amounts[to_id])
+    return errors, accepted, totals
+
+
+def apply_transfers(db_session: Session, transfers: List[Transfer], partial: bool = False) -> List[Optional[str]]:
+    """Проверяет и записывает пачку переводов в одной транзакции
+
+    Кошельки блокируются заранее в порядке возрастания id, переводы
+    проверяются по порядку с учетом предыдущих переводов пачки.
+
+    Args:
+        db_session: сессия к БД postgres
+        transfers: переводы
+        partial: записать прошедшие проверку переводы, иначе при любой ошибке
+                 отклоняется вся пачка (LedgerError)
+
+    Returns:
+        ошибка по каждому переводу (None - перевод записан)
+    """
+    amounts = lock_balances(db_session, [i for from_id, to_id, _ in transfers for i in (from_id, to_id)])
+    errors, accepted, _ = _check_entries(amounts, transfers)
+    if not partial and any(errors):
+        raise LedgerError(errors)
+    post_transfers(db_session, accepted)
+    return errors
+
+
+def apply_deposits(db_session: Session, system_balance_id: int, deposits: List[Tuple[int, Decimal]],
+                   partial: bool = False) -> List[Optional[str]]:
+    """Проверяет и записывает пачку зачислений с системного кошелька в одной транзакции
+
+    Args:
+        db_session: сессия к БД postgres
+        system_balance_id: системный кошелек, с которого списываются зачисления
+        deposits: список (id кошелька, сумма)
+        partial: записать прошедшие проверку зачисления, иначе при любой ошибке
+                 отклоняется вся пачка (LedgerError)
+
+    Returns:
+        ошибка по каждому зачислению (None - зачисление записано)
+    """
+    amounts = lock_balances(db_session, [system_balance_id] + [balance_id for balance_id, _ in deposits])
+    errors, accepted, _ = _check_entries(amounts, [(None, balance_id, amount) for balance_id, amount in deposits],
+                                         {balance_id: system_balance_id for balance_id, _ in deposits})
+    if not partial and any(errors):
+        raise LedgerError(errors)
+    post_transfers(db_session, accepted)
+    return errors
+
+
+def apply_entries(db_session: Session, system_balances: Optional[Dict[int, int]],
+                  entries: List[Entry]) -> Tuple[List[Optional[str]], List[Optional[Decimal]]]:
+    """Записывает независимые переводы и зачисления разных запросов в одной транзакции
+
+    Ошибка одной записи не отклоняет остальные (см. app/utils/coalescer.py).
+    system_balances (системный кошелек по id пополняемого кошелька) нужен только для зачислений.
+
+    Returns:
+        ошибка по каждой записи (None - записана), остаток получателя после записи
+    """
+    balance_ids = [i for from_id, to_id, _ in entries for i in (from_id, to_id) if i is not None]
+    if system_balances:
+        balance_ids.extend(set(system_balances.values()))
+    amounts = lock_balances(db_session, balance_ids)
+    errors, accepted, totals = _check_entries(amounts, entries, system_balances)
+    post_transfers(db_session, accepted)
+    return errors, totals
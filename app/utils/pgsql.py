@@ -3,129 +3,147 @@ pgsql.py
 ====================================
 Вспомагательные функции для построения SQL postgres
 """
-from typing import Union, Tuple, List
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from typing import Any, Dict, Iterable, Union, Tuple, List
+
+from sqlalchemy import Table
+from sqlalchemy.dialects import postgresql
+
+from app.utils.cache import LRUCache
+
 
 class PGsqlOrderByExcept(Exception):
     pass
 
 
-def _quote_ident(ident):
-    return '"{}"'.format(ident.replace('"', '""'))
+class PGsqlFilterExcept(Exception):
+    pass
 
 
-def _quote_literal(string):
-    return "'{}'".format(string.replace("'", "''"))
+class PGsqlCursorExcept(Exception):
+    pass
 
 
-def quote(field_value) -> str:
-    """Escape a value to be able to insert into PostgreSQL
-    :param field_value:
-    :return:
-    """
-    if isinstance(field_value, str):
-        return _quote_literal(field_value)
-    if field_value is None:
-        return 'NULL'
-    if isinstance(field_value, (int, float, complex)):
-        return str(field_value)
-    # Applicable for date, time, text, varchar
-    return _quote_literal(str(field_value))
-
-
-def quote_array(values, wrap=True) -> str:
-    """Convert Python value into string that is compatible with PostgreSQL's query
-    first_name = "Name 01" => 'Name 01'
-    this_date = datetime.datetime.now() => '2018-07-30 11:54:25.161946'
-    this_date = datetime.datetime.now(datetime.timezone.utc) => '2018-07-30 05:12:30.279286+00:00'
-    See: https://paquier.xyz/postgresql-2/manipulating-arrays-in-postgresql/
-    :param list values:
-    :param bool wrap:
-    :return:
+# операторы фильтра: шаблон условия и как разбирать значение
+# one - одно значение, many - список значений через |, pair - два значения через |
+FILTER_OPS = {
+    "=": ("{column} = {value}", "one"),
+    ">": ("{column} > {value}", "one"),
+    ">=": ("{column} >= {value}", "one"),
+    "<": ("{column} < {value}", "one"),
+    "<=": ("{column} <= {value}", "one"),
+    "<>": ("{column} <> {value}", "one"),
+    "!=": ("{column} <> {value}", "one"),
+    "in": ("{column} = ANY({values})", "many"),
+    "not in": ("{column} <> ALL({values})", "many"),
+    "between": ("{column} BETWEEN {value_0} AND {value_1}", "pair"),
+    # для полей-диапазонов и массивов, значение - литерал типа поля, например [1,5)
+    "contain": ("{column} @> {value}", "one"),
+    "not contain": ("NOT ({column} @> {value})", "one"),
+    "overlap": ("{column} && {value}", "one"),
+    "not overlap": ("NOT ({column} && {value})", "one"),
+    "like": ("CAST({column} AS text) LIKE {text}", "one"),
+}
+
+
+class FilterCompiler:
+    """Построение условия WHERE из фильтров запроса с параметрами вместо литералов
+
+    Поля проверяются по белому списку, значения передаются параметрами :filter_N
+    с приведением к типу поля, поэтому текст SQL зависит только от набора (поле, оператор):
+    одинаковые фильтры с разными значениями дают один и тот же запрос. Приведение типа
+    в самом запросе позволяет передавать значения как text (bind_types), а план
+    переиспользуется, если запрос выполняется через prepared.PreparedShapes.
+    Собранные условия кэшируются по этому набору.
+
+    Args:
+        table: таблица SQLAlchemy, из нее берутся типы полей
+        fields: поля, по которым разрешено фильтровать
+        table_pre: префикс таблицы в запросе
+        cache_size: сколько собранных условий хранить
     """
-    if wrap:
-        ret = "'{%s}'"
-    else:
-        ret = "%s"
-    quoted_values = []
-    for v in values:
-        quoted_values.append(quote(v))
-    return ret % ",".join(quoted_values)
-
-def generate_filter(field: str, value: Union[str, Tuple], op: Union[str, None]) -> str:
-    """Функция генерит WHERE запрос для SQL
+
+    def __init__(self, table: Table, fields: Iterable[str], table_pre: str = '', cache_size: int = 1024):
+        self.types = {f: table.c[f].type.compile(dialect=postgresql.dialect()) for f in fields}
+        self.table_pre = table_pre
+        self._shapes = LRUCache(cache_size, float('inf'))
+
+    def compile(self, filters: List[dict]) -> Tuple[str, dict]:
+        """Условие и параметры к нему
+
+        Args:
+            filters: список {'field': поле, 'value': значение, 'op': оператор или None ('=')}
+
+        Returns:
+            sql между WHERE и AND (пустая строка без фильтров) и параметры
+        """
+        shape = tuple((f['field'], f['op'] or '=') for f in filters)
+        sql = self._shapes.get(shape)
+        if sql is None:
+            sql = " AND ".join(self._compile_one(i, field, op) for i, (field, op) in enumerate(shape))
+            self._shapes.set(shape, sql)
+        params = {}
+        for i, (f, (_, op)) in enumerate(zip(filters, shape)):
+            params.update(self._bind_values(i, op, f['value']))
+        return sql, params
+
+    @staticmethod
+    def bind_types(params: dict) -> Dict[str, str]:
+        """Типы параметров условия для PREPARE: text или text[], к типу поля их приводит сам запрос"""
+        return {name: 'text[]' if isinstance(value, list) else 'text' for name, value in params.items()}
+
+    def _compile_one(self, i: int, field: str, op: str) -> str:
+        if field not in self.types:
+            raise PGsqlFilterExcept(f'Bad filter field: {field}')
+        if op not in FILTER_OPS:
+            raise PGsqlFilterExcept(f'Bad filter operation: {op}')
+        template, _ = FILTER_OPS[op]
+        column_type = self.types[field]
+        return template.format(
+            column=f"{self.table_pre}.{field}" if self.table_pre else field,
+            value=f"CAST(:filter_{i} AS {column_type})",
+            values=f"CAST(:filter_{i} AS {column_type}[])",
+            text=f"CAST(:filter_{i} AS text)",
+            value_0=f"CAST(:filter_{i}_0 AS {column_type})",
+            value_1=f"CAST(:filter_{i}_1 AS {column_type})",
+        )
+
+    @staticmethod
+    def _bind_values(i: int, op: str, value: Union[str, List, Tuple]) -> dict:
+        kind = FILTER_OPS[op][1]
+        if kind == "one":
+            return {f"filter_{i}": value}
+        values = value.split("|") if isinstance(value, str) else list(value)
+        if kind == "many":
+            return {f"filter_{i}": values}
+        if len(values) != 2:
+            raise PGsqlFilterExcept(f'between requires two values separated by |, got: {value}')
+        return {f"filter_{i}_0": values[0], f"filter_{i}_1": values[1]}
+
+
+def check_sort_fields(fields: List[str], allowed: Iterable[str] = None) -> None:
+    """Функция проверяет поля сортировки по белому списку, поля подставляются в SQL как есть
     Args:
-        field: поле в таблице
-        value: значение
-        op: оператор
-    Return:
-        sql между WHERE и AND
+        fields: список полей для сортировки
+        allowed: разрешенные поля, None - без проверки
     """
+    if allowed is None:
+        return
+    allowed = set(allowed)
+    for f in fields or []:
+        if f not in allowed:
+            raise PGsqlOrderByExcept(f'Bad sort field: {f}')
 
-    and_list = []
-    op = op or "="  # op can be None (default value)
-    simple_ops = {
-        "=": 1,
-        ">": 2,
-        ">=": 3,
-        "<": 4,
-        "<=": 5,
-        "<>": 6,
-        "!=": 7,
-        "in": 8,
-        "not in": 9,
-        "between": 10,
-        "contain": 11,
-        "not contain": 12,
-        "overlap": 13,
-        "not overlap": 14,
-        "like": 15
-    }
-    try:
-        op_position = simple_ops[op]
-    except IndexError:
-        raise UserWarning("Bad operation: %s", op)
-    if op_position < 8:
-        if value.isdigit():
-            return u"%s %s %d" % (field,  op, int(value))
-        else:
-            return u"%s %s %s" % (field, op, quote(value))
-    if op_position < 9:
-        return u"%s = ANY(%s)" % (field, quote_array(value))
-    if op_position < 10:
-        return u"%s != ALL(%s)" % (field, quote_array(value))
-    if op_position < 11:
-        return u"%s BETWEEN %s AND %s" % (field, quote(value[0]), quote(value[1]))
-    if op_position < 12:
-        # applicable for range field
-        return u"%s @> %s" % (field, quote(value))
-    if op_position < 13:
-        # applicable for range field
-        return u"NOT (%s @> %s)" % (field, quote(value))
-    if op_position < 14:
-        # applicable for range field
-        # value must be a function: int4range, int8range, tsrange ...
-        # https://www.postgresql.org/docs/10/static/rangetypes.html
-        if not isinstance(value, str):
-            raise UserWarning("Bad value compared against the field %s: string is required", field)
-        if not "range(" in value:
-            raise UserWarning("Bad value compared against the field %s: range function is required", field)
-        return u"%s && %s" % (field, value.replace("'", ""))
-    if op_position < 15:
-        if not isinstance(value, str):
-            raise UserWarning("Bad value compared against the field %s: string is required", field)
-        if not "range(" in value:
-            raise UserWarning("Bad value compared against the field %s: range function is required", field)
-        return u"NOT (%s && %s)" % (field, value.replace("'", ""))
-    else:
-        # LIKE
-        return u"%s LIKE %s" % (field, quote(value))
-
-def generate_order_by(fields: List[str], sort_orders: List[str], table_pre: str = '') -> str:
+
+def generate_order_by(fields: List[str], sort_orders: List[str], table_pre: str = '',
+                      allowed: Iterable[str] = None) -> str:
     """Функция генерит ORDER BY запрос для SQL
     Args:
         fields: список полей для сортировки
         sort_orders: список (asc\desc) значений
         table_pre: префикс таблицы в запросе
+        allowed: разрешенные для сортировки поля, None - без проверки
     Return:
         sql ORBER BY
     """
@@ -139,7 +157,72 @@ def generate_order_by(fields: List[str], sort_orders: List[str], table_pre: str
 
     if not fields:
         return ''
+    check_sort_fields(fields, allowed)
+    if len(sort_orders or []) != len(fields):
+        raise PGsqlOrderByExcept('sort_order should be given for each sort_by field')
     orders_clause = []
     for i, f in enumerate(fields):
         orders_clause.append(_get_str_order(f, sort_orders[i], table_pre))
     return "ORDER BY " + ", ".join(orders_clause)
+
+
+def get_keyset_fields(fields: List[str], sort_orders: List[str],
+                      allowed: Iterable[str] = None) -> Tuple[List[str], str]:
+    """Функция определяет ключ для постраничной выборки по курсору
+    Args:
+        fields: список полей для сортировки (не более одного)
+        sort_orders: список (asc\\desc) значений
+        allowed: разрешенные для сортировки поля, None - без проверки; только NOT NULL поля,
+                 строки с NULL в поле ключа не попадают ни на одну следующую страницу
+    Return:
+        поля ключа (поле сортировки + id) и направление сортировки
+    """
+    fields = fields or ['id']
+    if len(fields) > 1:
+        raise PGsqlCursorExcept('cursor pagination supports sorting by one field only')
+    check_sort_fields(fields, allowed)
+    sort_order = (sort_orders[0] if sort_orders else 'asc').upper()
+    if sort_order not in ['ASC', 'DESC']:
+        raise PGsqlOrderByExcept(f'sort_order value should consist of ASC or DESC but he {sort_order}')
+    if fields[0] == 'id':
+        return ['id'], sort_order
+    return [fields[0], 'id'], sort_order
+
+
+def generate_keyset(fields: List[str], sort_order: str, values: List[Any], table_pre: str = '',
+                    types: Dict[str, str] = None) -> Tuple[str, dict]:
+    """Функция генерит условие WHERE для страницы после курсора
+    Args:
+        fields: поля ключа
+        sort_order: направление сортировки (ASC\\DESC)
+        values: значения ключа последней записи предыдущей страницы
+        table_pre: префикс таблицы в запросе
+        types: типы полей, значения приводятся к ним (CAST), как в FilterCompiler
+    Return:
+        sql условие и параметры к нему, например (o.created, o.id) > (:cursor_0, :cursor_1)
+    """
+    columns = ", ".join(f"{table_pre}.{f}" if table_pre else f for f in fields)
+    binds = ", ".join(f"CAST(:cursor_{i} AS {types[f]})" if types else f":cursor_{i}" for i, f in enumerate(fields))
+    op = '>' if sort_order == 'ASC' else '<'
+    return f"({columns}) {op} ({binds})", {f"cursor_{i}": v for i, v in enumerate(values)}
+
+
+def encode_cursor(fields: List[str], sort_order: str, values: List[Any]) -> str:
+    """Функция упаковывает ключ последней записи страницы в непрозрачный курсор"""
+    data = json.dumps({'f': fields, 'o': sort_order, 'v': values}, default=str, separators=(',', ':'))
+    return urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor: str, fields: List[str], sort_order: str) -> List[Any]:
+    """Функция распаковывает курсор и проверяет, что он выдан для той же сортировки
+    Return:
+        значения ключа
+    """
+    try:
+        data = json.loads(urlsafe_b64decode(cursor.encode()))
+        values = data['v']
+    except (ValueError, TypeError, KeyError):
+        raise PGsqlCursorExcept(f'Bad cursor: {cursor}')
+    if data.get('f') != fields or data.get('o') != sort_order or len(values) != len(fields):
+        raise PGsqlCursorExcept('cursor does not match sort_by/sort_order')
+    return values
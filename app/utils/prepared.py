@@ -0,0 +1,143 @@
+"""
+prepared.py
+====================================
+Серверные prepared statements для частых запросов переводов
+
+Запрос готовится (PREPARE) на соединении при первом выполнении и дальше выполняется
+через EXECUTE, пока соединение живо: postgres не разбирает его заново, а после
+нескольких выполнений может перейти на общий план. Подготовленные на соединении
+запросы хранятся в Connection.info, он очищается при пересоздании соединения пулом.
+
+Запросы, собираемые из частей (фильтры и сортировка списков), готовятся по форме:
+PreparedShapes выдает одно имя на один текст запроса.
+"""
+import re
+import hashlib
+import threading
+from typing import Dict
+
+from sqlalchemy import text
+from sqlalchemy.engine import ResultProxy
+from sqlalchemy.orm import Session
+
+from app import settings
+from app.utils.cache import LRUCache
+
+# ключ в Connection.info: имена запросов, подготовленных на соединении
+PREPARED_KEY = 'prepared_statements'
+
+_BIND = re.compile(r'(?<![:\w]):(\w+)')
+
+
+class PreparedStats:
+    """Счётчики prepared statements процесса: hits - EXECUTE готового запроса, misses - PREPARE"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits: Dict[str, int] = {}
+        self.misses: Dict[str, int] = {}
+
+    def add(self, name: str, hit: bool):
+        with self._lock:
+            counter = self.hits if hit else self.misses
+            counter[name] = counter.get(name, 0) + 1
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                'enabled': settings.DB_PREPARED_STATEMENTS,
+                'hits': sum(self.hits.values()),
+                'misses': sum(self.misses.values()),
+                'statements': {name: {'hits': self.hits.get(name, 0), 'misses': self.misses.get(name, 0)}
+                               for name in STATEMENTS},
+            }
+
+
+stats = PreparedStats()
+
+STATEMENTS: Dict[str, 'PreparedStatement'] = {}
+
+
+class PreparedStatement:
+    """Запрос с именованными параметрами и их типами postgres
+
+    Args:
+        name: имя prepared statement, уникальное в приложении
+        sql: запрос с параметрами :name
+        group: имя в статистике, по умолчанию name
+        types: тип каждого параметра, например balance_ids='integer[]'
+    """
+
+    def __init__(self, name: str, sql: str, *, group: str = None, **types: str):
+        names = _BIND.findall(sql)
+        if set(names) != set(types):
+            raise ValueError(f'{name}: types are required for the parameters {sorted(set(names))}')
+        self.name = name
+        self.group = group or name
+        self.params = list(types)
+        position = {param: i + 1 for i, param in enumerate(self.params)}
+        self.prepare_sql = 'PREPARE {}({}) AS {}'.format(
+            name, ', '.join(types.values()), _BIND.sub(lambda m: f'${position[m.group(1)]}', sql)
+        )
+        self.execute_sql = text('EXECUTE {}({})'.format(name, ', '.join(f':{param}' for param in self.params)))
+        # тот же запрос без PREPARE, если DB_PREPARED_STATEMENTS выключен
+        self.plain_sql = text(_BIND.sub(lambda m: f'CAST(:{m.group(1)} AS {types[m.group(1)]})', sql))
+        STATEMENTS[self.group] = self
+
+    def execute(self, db_session: Session, **params) -> ResultProxy:
+        """Выполняет запрос в текущей транзакции сессии
+
+        Args:
+            db_session: сессия к БД postgres
+            params: значения параметров
+
+        Returns:
+            ResultProxy
+        """
+        if not settings.DB_PREPARED_STATEMENTS:
+            return db_session.execute(self.plain_sql, params)
+        connection = db_session.connection()
+        prepared = connection.info.setdefault(PREPARED_KEY, set())
+        hit = self.name in prepared
+        if not hit:
+            # PREPARE не транзакционный: запрос остается и после отката транзакции
+            connection.execute(self.prepare_sql)
+            prepared.add(self.name)
+        stats.add(self.group, hit)
+        return connection.execute(self.execute_sql, params)
+
+
+class PreparedShapes:
+    """Prepared statements для запросов одной группы, собранных из частей
+
+    Имя запроса - группа и хэш его текста и типов: запросы одной формы с разными
+    значениями выполняются одним prepared statement, в том числе после вытеснения
+    формы из кэша. В статистике формы учитываются под именем группы.
+
+    Args:
+        group: имя группы, префикс имен запросов
+        cache_size: сколько форм хранить
+    """
+
+    def __init__(self, group: str, cache_size: int = 256):
+        self.group = group
+        self._statements = LRUCache(cache_size, float('inf'))
+
+    def get(self, sql: str, types: Dict[str, str]) -> PreparedStatement:
+        """Prepared statement для текста запроса
+
+        Args:
+            sql: запрос с параметрами :name
+            types: типы параметров, лишние (не встречающиеся в запросе) не учитываются
+
+        Returns:
+            PreparedStatement
+        """
+        types = {param: types[param] for param in dict.fromkeys(_BIND.findall(sql)) if param in types}
+        key = (sql, tuple(types.items()))
+        statement = self._statements.get(key)
+        if statement is None:
+            digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+            statement = PreparedStatement(f'{self.group}_{digest}', sql, group=self.group, **types)
+            self._statements.set(key, statement)
+        return statement
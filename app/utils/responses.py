@@ -0,0 +1,41 @@
+"""
+responses.py
+====================================
+JSON ответы через orjson, минуя pydantic модели и jsonable_encoder
+
+Для горячих GET: обработчик отдает ORJSONResponse из dict/строк БД, FastAPI не валидирует
+ответ по response_model (она остается только для документации). Decimal кодируется
+числом, как и в jsonable_encoder, datetime - в ISO 8601 самим orjson.
+"""
+from decimal import Decimal
+from typing import Any, Iterable, List, Sequence
+
+import orjson
+from fastapi.responses import JSONResponse
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f'Type is not JSON serializable: {type(value).__name__}')
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class ORJSONResponse(JSONResponse):
+    """JSONResponse, который кодирует содержимое через orjson"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def rows_to_dicts(columns: Sequence[str], rows: Iterable[tuple]) -> List[dict]:
+    """Строки результата запроса в dict без RowProxy.__getitem__ на каждое поле
+
+    Args:
+        columns: имена колонок (ResultProxy.keys())
+        rows: строки результата
+    """
+    return [dict(zip(columns, row)) for row in rows]
@@ -0,0 +1,95 @@
+"""
+retry.py
+====================================
+Повтор транзакции при конфликте сериализации и взаимоблокировке
+"""
+import time
+import random
+import threading
+from typing import Callable, Dict, TypeVar
+
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+from app import settings
+
+T = TypeVar('T')
+
+# SQLSTATE, после которых транзакцию можно безопасно выполнить заново
+RETRY_SQLSTATES = {
+    '40001': 'serialization_failure',
+    '40P01': 'deadlock_detected',
+}
+
+
+class RetryStats:
+    """Счётчики повторов транзакций процесса"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.transactions = 0
+        self.retries: Dict[str, int] = {name: 0 for name in RETRY_SQLSTATES.values()}
+        self.exhausted = 0
+
+    def add(self, transaction: bool = False, retry: str = None, exhausted: bool = False):
+        with self._lock:
+            self.transactions += transaction
+            if retry:
+                self.retries[retry] += 1
+            self.exhausted += exhausted
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {'transactions': self.transactions, 'retries': dict(self.retries), 'exhausted': self.exhausted}
+
+
+stats = RetryStats()
+
+
+def get_sqlstate(error: DBAPIError) -> str:
+    return getattr(error.orig, 'pgcode', None)
+
+
+def run_in_transaction(db_session: Session, fn: Callable[[], T],
+                       attempts: int = None, base_delay: float = None, max_delay: float = None) -> T:
+    """Выполняет fn и commit, при 40001/40P01 откатывает и повторяет
+
+    fn должна выполнять всю транзакцию целиком (чтения под блокировкой, проверки и запись),
+    после отката ORM объекты сессии устаревают. Пауза перед повтором - случайная в
+    [0, min(max_delay, base_delay * 2^попытка)], чтобы конфликтующие запросы разошлись.
+    При любой ошибке транзакция откатывается и ошибка пробрасывается.
+
+    Args:
+        db_session: сессия к БД postgres
+        fn: тело транзакции
+        attempts: максимум попыток (DB_RETRY_ATTEMPTS)
+        base_delay: начальная пауза в секундах (DB_RETRY_BASE_DELAY)
+        max_delay: максимальная пауза в секундах (DB_RETRY_MAX_DELAY)
+
+    Returns:
+        результат fn
+    """
+    attempts = settings.DB_RETRY_ATTEMPTS if attempts is None else attempts
+    base_delay = settings.DB_RETRY_BASE_DELAY if base_delay is None else base_delay
+    max_delay = settings.DB_RETRY_MAX_DELAY if max_delay is None else max_delay
+    stats.add(transaction=True)
+    attempt = 1
+    while True:
+        try:
+            result = fn()
+            db_session.commit()
+            return result
+        except DBAPIError as e:
+            db_session.rollback()
+            reason = RETRY_SQLSTATES.get(get_sqlstate(e))
+            if reason is None:
+                raise
+            if attempt >= attempts:
+                stats.add(exhausted=True)
+                raise
+            stats.add(retry=reason)
+        except Exception:
+            db_session.rollback()
+            raise
+        time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1))))
+        attempt += 1
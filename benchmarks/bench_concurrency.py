@@ -0,0 +1,112 @@
+"""
+bench_concurrency.py
+====================================
+Пропускная способность при конкурентных запросах к БД в одном процессе:
+
+    blocking   - синхронная Session внутри async def (так были написаны обработчики),
+                 каждый запрос к БД останавливает цикл событий;
+    threadpool - тот же код в обычном def, FastAPI выполняет его в пуле потоков;
+    api        - GET /v1/balances/{balance_id} приложения.
+
+Запуск (нужна БД из POSTGRES_CONNECT_URL):
+    python -m benchmarks.bench_concurrency [--requests 2000] [--concurrency 50] [--latency-ms 2]
+
+--latency-ms добавляет pg_sleep к каждому запросу, имитируя сетевую задержку до БД.
+"""
+import time
+import asyncio
+import argparse
+
+import httpx
+from fastapi import FastAPI
+
+from app.connects.postgres.session import Session
+from app.main import app as api_app, set_threadpool_size
+from app.models.auth import User
+from app.models.balance import Balance
+from app.utils.db_utils import get_or_create
+
+SQL_BALANCE = '''
+    SELECT b.id, b.amount, u.username FROM balances b JOIN users u ON u.id = b.user_id WHERE b.id = :balance_id
+'''
+
+
+def get_bench_app(latency: float) -> FastAPI:
+    bench_app = FastAPI()
+
+    # сессия закрывается внутри обработчика: закрытие в yield-зависимости идёт через цикл событий,
+    # и blocking упирается в таймаут пула, пока цикл стоит в ожидании соединения
+    def _query(balance_id: int) -> dict:
+        pg = Session()
+        try:
+            if latency:
+                pg.execute('SELECT pg_sleep(:latency)', {'latency': latency})
+            return dict(pg.execute(SQL_BALANCE, {'balance_id': balance_id}).first())
+        finally:
+            pg.close()
+
+    @bench_app.get("/blocking/{balance_id}")
+    async def blocking(balance_id: int):
+        return _query(balance_id)
+
+    @bench_app.get("/threadpool/{balance_id}")
+    def threadpool(balance_id: int):
+        return _query(balance_id)
+
+    return bench_app
+
+
+async def run(app: FastAPI, url: str, requests: int, concurrency: int) -> float:
+    """Выполняет requests запросов не более concurrency одновременно
+
+    Returns:
+        запросов в секунду
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(app=app, base_url='http://bench') as client:
+        async def _request():
+            async with semaphore:
+                response = await client.get(url)
+                assert response.status_code == 200, response.text
+
+        started = time.perf_counter()
+        await asyncio.gather(*(_request() for _ in range(requests)))
+        return requests / (time.perf_counter() - started)
+
+
+def get_bench_balance_id() -> int:
+    db = Session()
+    try:
+        db_user, _ = get_or_create(db, User, defaults={"is_active": True}, username='bench_user')
+        db_balance, _ = get_or_create(db, Balance, user_id=db_user.id)
+        return db_balance.id
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Конкурентная пропускная способность')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--latency-ms', type=float, default=2)
+    args = parser.parse_args()
+
+    balance_id = get_bench_balance_id()
+    bench_app = get_bench_app(args.latency_ms / 1000)
+
+    async def _main():
+        set_threadpool_size()
+        for name, app, url in (('blocking', bench_app, f'/blocking/{balance_id}'),
+                               ('threadpool', bench_app, f'/threadpool/{balance_id}')):
+            rps = await run(app, url, args.requests, args.concurrency)
+            print(f"{name:<12} {rps:8.1f} req/s")
+        if not args.latency_ms:
+            rps = await run(api_app, f'/v1/balances/{balance_id}', args.requests, args.concurrency)
+            print(f"{'api':<12} {rps:8.1f} req/s")
+
+    asyncio.run(_main())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+bench_group_commit.py
+====================================
+Одиночные переводы: транзакция на перевод против групповой записи (app/utils/coalescer.py)
+
+Запуск (нужна БД из POSTGRES_CONNECT_URL):
+    python -m benchmarks.bench_group_commit [--transfers 2000] [--threads 32] [--wallets 100]
+"""
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from random import Random
+
+from app import settings
+from app.connects.postgres.session import Session, engine
+from app.models.auth import User
+from app.models.balance import Balance
+from app.utils.coalescer import Coalescer
+from app.utils.ledger import apply_deposits, apply_transfers
+from app.utils.retry import run_in_transaction
+
+
+def create_wallets(count: int) -> list:
+    db = Session()
+    try:
+        suffix = int(time.time())
+        balances = [Balance(user=User(username=f'bench_gc_{suffix}_{i}', is_active=True)) for i in range(count)]
+        db.add_all(balances)
+        db.commit()
+        balance_ids = [b.id for b in balances]
+        system_balance_id = Balance.get_system_balance(db).id
+        run_in_transaction(db, lambda: apply_deposits(db, system_balance_id, [(i, Decimal(10 ** 6)) for i in balance_ids]))
+        return balance_ids
+    finally:
+        db.close()
+
+
+def transfer_direct(transfer) -> None:
+    db = Session()
+    try:
+        run_in_transaction(db, lambda: apply_transfers(db, [transfer]))
+    finally:
+        db.close()
+
+
+def run(fn, transfers: list, threads: int) -> float:
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(fn, transfers))
+    return len(transfers) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Групповая запись переводов')
+    parser.add_argument('--transfers', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--wallets', type=int, default=100)
+    args = parser.parse_args()
+
+    balance_ids = create_wallets(args.wallets)
+    rnd = Random(0)
+    transfers = []
+    while len(transfers) < args.transfers:
+        from_id, to_id = rnd.sample(balance_ids, 2)
+        transfers.append((from_id, to_id, Decimal(1)))
+    engine.pool.dispose()
+
+    print(f"direct      {run(transfer_direct, transfers, args.threads):8.1f} transfers/s")
+    coalescer = Coalescer(Session, settings.LEDGER_COALESCE_MAX_ITEMS, settings.LEDGER_COALESCE_MAX_DELAY_MS / 1000)
+    coalescer.start()
+    try:
+        rps = run(lambda t: coalescer.submit(t).result(), transfers, args.threads)
+    finally:
+        coalescer.stop()
+    print(f"coalesced   {rps:8.1f} transfers/s ({coalescer.items / coalescer.flushes:.1f} per commit)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+bench_prepared.py
+====================================
+Запросы одиночного перевода с prepared statements и без (settings.DB_PREPARED_STATEMENTS)
+
+Выполняет те же запросы, что PUT /v1/balances/transfer/{balance_id} без Idempotency-Key:
+Balance.select отправителя и получателя, lock_balances, Operations.add_transfer,
+Balance.change_amounts и commit - без HTTP, чтобы разница не терялась в накладных расходах.
+
+Запуск (нужна БД из POSTGRES_CONNECT_URL с примененными миграциями):
+    python -m benchmarks.bench_prepared [--transfers 5000] [--rounds 3]
+"""
+import time
+import argparse
+from decimal import Decimal
+
+from app import settings
+from app.connects.postgres.session import Session
+from app.models.auth import User
+from app.models.balance import Balance, Operations
+from app.utils import prepared
+from app.utils.ledger import apply_deposits, lock_balances
+from app.utils.retry import run_in_transaction
+
+
+def create_wallets() -> tuple:
+    db = Session()
+    try:
+        suffix = int(time.time())
+        balances = [Balance(user=User(username=f'bench_prepared_{suffix}_{i}', is_active=True)) for i in range(2)]
+        db.add_all(balances)
+        db.commit()
+        balance_ids = [b.id for b in balances]
+        system_balance_id = Balance.get_system_balance(db).id
+        run_in_transaction(db, lambda: apply_deposits(db, system_balance_id, [(i, Decimal(10 ** 6)) for i in balance_ids]))
+        return tuple(balance_ids)
+    finally:
+        db.close()
+
+
+def run(balance_ids: tuple, transfers: int) -> float:
+    first, second = balance_ids
+    amount = Decimal(1)
+    db = Session()
+    try:
+        started = time.perf_counter()
+        for i in range(transfers):
+            from_id, to_id = (first, second) if i % 2 else (second, first)
+            assert Balance.select(db, from_id).amount >= amount
+            assert Balance.select(db, to_id)
+            lock_balances(db, [from_id, to_id])
+            Operations.add_transfer(db, from_id, to_id, amount)
+            Balance.change_amounts(db, [(from_id, -amount), (to_id, amount)])
+            db.commit()
+        return time.perf_counter() - started
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Перевод с prepared statements и без')
+    parser.add_argument('--transfers', type=int, default=5000)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    balance_ids = create_wallets()
+    results = {False: [], True: []}
+    for _ in range(args.rounds):
+        for enabled in (False, True):
+            settings.DB_PREPARED_STATEMENTS = enabled
+            results[enabled].append(run(balance_ids, args.transfers))
+    for enabled, name in ((False, 'plain'), (True, 'prepared')):
+        best = min(results[enabled])
+        print(f"{name:<10} {args.transfers / best:8.1f} transfers/s {best / args.transfers * 10 ** 6:8.1f} us/transfer")
+    saving = (min(results[False]) - min(results[True])) / args.transfers * 10 ** 6
+    print(f"saving     {saving:8.1f} us/transfer")
+    print(f"counters   {prepared.stats.as_dict()['hits']} hits, {prepared.stats.as_dict()['misses']} misses")
+
+
+if __name__ == "__main__":
+    main()
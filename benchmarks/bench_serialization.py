@@ -0,0 +1,70 @@
+"""
+bench_serialization.py
+====================================
+Кодирование страницы GET /v1/balances/operations/{balance_id}: pydantic + jsonable_encoder против orjson
+
+pydantic - прежний путь ответа: dict на строку, OperationsListSchema (FastAPI валидирует
+ответ по response_model), jsonable_encoder и JSONResponse. orjson - текущий: dict(zip(keys, row))
+и ORJSONResponse. Строки БД имитируются кортежами с теми же типами, что отдает psycopg2.
+
+Запуск:
+    python -m benchmarks.bench_serialization [--rows 500] [--repeat 200]
+"""
+import time
+import argparse
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from app.schemas import OperationsListSchema
+from app.utils.responses import ORJSONResponse, rows_to_dicts
+
+COLUMNS = ('id', 'created', 'operation_type', 'amount', 'owner_balance_id', 'more_balance_id')
+
+
+def make_rows(count: int) -> list:
+    start = datetime(2020, 12, 1, tzinfo=timezone.utc)
+    return [(i, start + timedelta(seconds=i), 'CREDIT' if i % 2 else 'DEBIT', Decimal(i % 1000) / 100, 1, 2)
+            for i in range(count)]
+
+
+def pydantic_path(rows: list) -> bytes:
+    items = [dict(zip(COLUMNS, row)) for row in rows]
+    model = OperationsListSchema(items=items, totalCount=len(rows))
+    return JSONResponse(jsonable_encoder(model)).body
+
+
+def orjson_path(rows: list) -> bytes:
+    return ORJSONResponse({'items': rows_to_dicts(COLUMNS, rows), 'totalCount': len(rows), 'next_cursor': None}).body
+
+
+def measure(fn, rows: list, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(5):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            fn(rows)
+        best = min(best, (time.perf_counter() - started) / repeat)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Кодирование страницы списка операций')
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    assert orjson.loads(pydantic_path(rows)) == orjson.loads(orjson_path(rows))
+    results = {name: measure(fn, rows, args.repeat) for name, fn in (('pydantic', pydantic_path),
+                                                                     ('orjson', orjson_path))}
+    for name, seconds in results.items():
+        print(f"{name:<10} {seconds * 1000:8.3f} ms/page {args.rows / seconds:12.0f} rows/s")
+    print(f"speedup    {results['pydantic'] / results['orjson']:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
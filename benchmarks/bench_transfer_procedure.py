@@ -0,0 +1,94 @@
+"""
+bench_transfer_procedure.py
+====================================
+PUT /v1/balances/transfer/{balance_id}: ORM против функции БД ledger_transfer (settings.LEDGER_PROCEDURE)
+
+Считает переводы в секунду и запросы к БД на перевод (с BEGIN/COMMIT).
+
+Запуск (нужна БД из POSTGRES_CONNECT_URL с примененными миграциями):
+    python -m benchmarks.bench_transfer_procedure [--transfers 1000] [--threads 1]
+"""
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from sqlalchemy import event
+from fastapi.testclient import TestClient
+
+from app import settings
+from app.connects.postgres.session import Session, engine
+from app.main import app
+from app.models.auth import User
+from app.models.balance import Balance
+from app.utils.ledger import apply_deposits
+from app.utils.retry import run_in_transaction
+
+statements = 0
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def _count(conn, cursor, statement, parameters, context, executemany):
+    global statements
+    statements += 1
+
+
+@event.listens_for(engine, 'begin')
+def _count_begin(conn):
+    global statements
+    statements += 1
+
+
+@event.listens_for(engine, 'commit')
+def _count_commit(conn):
+    global statements
+    statements += 1
+
+
+def create_wallets() -> tuple:
+    db = Session()
+    try:
+        suffix = int(time.time())
+        balances = [Balance(user=User(username=f'bench_proc_{suffix}_{i}', is_active=True)) for i in range(2)]
+        db.add_all(balances)
+        db.commit()
+        balance_ids = [b.id for b in balances]
+        system_balance_id = Balance.get_system_balance(db).id
+        run_in_transaction(db, lambda: apply_deposits(db, system_balance_id, [(i, Decimal(10 ** 6)) for i in balance_ids]))
+        return tuple(balance_ids)
+    finally:
+        db.close()
+
+
+def run(client: TestClient, balance_ids: tuple, transfers: int, threads: int) -> tuple:
+    global statements
+    first, second = balance_ids
+
+    def _transfer(i):
+        from_id, to_id = (first, second) if i % 2 else (second, first)
+        response = client.put(f'/v1/balances/transfer/{from_id}', json={'amount': 1, 'to_balance': to_id})
+        assert response.status_code == 200, response.text
+
+    statements = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(_transfer, range(transfers)))
+    return transfers / (time.perf_counter() - started), statements / transfers
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Перевод через ORM и через функцию БД')
+    parser.add_argument('--transfers', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=1)
+    args = parser.parse_args()
+
+    balance_ids = create_wallets()
+    with TestClient(app) as client:
+        for name, procedure in (('orm', False), ('procedure', True)):
+            settings.LEDGER_PROCEDURE = procedure
+            rps, per_transfer = run(client, balance_ids, args.transfers, args.threads)
+            print(f"{name:<10} {rps:8.1f} transfers/s {per_transfer:5.1f} statements/transfer")
+
+
+if __name__ == "__main__":
+    main()